@@ -25,6 +25,7 @@ tests_require = [
     'persistent',
     'zope.interface',
     'relstorage',
+    'ZEO',
     'six',  # not declared but used by relstorage 4.0.0
 ]
 
@@ -68,6 +69,10 @@ setup(name='zodbupdate',
       extras_require={'test': tests_require},
       zip_safe=False,
       entry_points={
-          "console_scripts": ['zodbupdate = zodbupdate.main:main']
+          "console_scripts": [
+              'zodbupdate = zodbupdate.main:main',
+              'zodbupdate-benchmark = zodbupdate.benchmark:main',
+              'zodbupdate-merge = zodbupdate.merge:main',
+          ]
       },
       )
@@ -0,0 +1,127 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import array
+import csv
+import json
+
+import ZODB.utils
+
+import zodbupdate.parallel
+
+
+# Name used in reports for records whose class could not be found.
+UNKNOWN = '(unknown)'
+
+
+class Analysis:
+    """Number of records and bytes per class, how many of them would
+    be modified by an update, and the classes and symbols that are
+    missing. ``oids`` are the OIDs of the records that would be
+    modified.
+    """
+
+    def __init__(self):
+        self.classes = {}
+        self.missing = set()
+        self.oids = array.array('Q')
+
+    def add(self, klass, size, changed, oid=None):
+        counts = self.classes.get(klass)
+        if counts is None:
+            counts = self.classes[klass] = [0, 0, 0]
+        counts[0] += 1
+        counts[1] += size
+        if changed:
+            counts[2] += 1
+            if oid is not None:
+                self.oids.append(ZODB.utils.u64(oid))
+
+    def merge(self, other):
+        for klass, (records, size, changed) in other.classes.items():
+            counts = self.classes.get(klass)
+            if counts is None:
+                counts = self.classes[klass] = [0, 0, 0]
+            counts[0] += records
+            counts[1] += size
+            counts[2] += changed
+        self.missing.update(other.missing)
+        self.oids.extend(other.oids)
+
+    def rows(self):
+        """Return a row per class, most used classes first.
+        """
+        rows = []
+        for klass, (records, size, changed) in self.classes.items():
+            name = ' '.join(klass) if klass is not None else UNKNOWN
+            rows.append({
+                'class': name,
+                'records': records,
+                'bytes': size,
+                'changed': changed,
+                'missing': klass in self.missing,
+            })
+        rows.sort(key=lambda row: (-row['records'], row['class']))
+        return rows
+
+    def totals(self):
+        rows = self.rows()
+        return {
+            'records': sum(row['records'] for row in rows),
+            'bytes': sum(row['bytes'] for row in rows),
+            'changed': sum(row['changed'] for row in rows),
+        }
+
+    def save(self, path):
+        """Save the report as CSV, or as JSON if the file name ends
+        with .json.
+        """
+        if path.endswith('.json'):
+            with open(path, 'w') as output:
+                json.dump({
+                    'classes': self.rows(),
+                    'missing': sorted(' '.join(symb) for symb in self.missing),
+                    'totals': self.totals(),
+                }, output, indent=2)
+            return
+        with open(path, 'w', newline='') as output:
+            writer = csv.DictWriter(
+                output, ['class', 'records', 'bytes', 'changed', 'missing'])
+            writer.writeheader()
+            writer.writerows(self.rows())
+
+
+def analyze_records(processor, records):
+    """Analyze records with the given processor, and return a list
+    with the resulting Analysis.
+    """
+    analysis = Analysis()
+    for oid, serial, data in records:
+        klass, changed = processor.analyze(data)
+        analysis.add(klass, len(data), changed, oid)
+    analysis.missing.update(processor.get_missing())
+    return [analysis]
+
+
+def analyze(processor, records, workers=1):
+    """Analyze all the records, using worker processes if asked.
+    """
+    if workers <= 1:
+        analysis, = analyze_records(processor, records)
+        return analysis
+    analysis = Analysis()
+    for partial in zodbupdate.parallel.process(
+            processor, records, workers, analyze_records):
+        analysis.merge(partial)
+    return analysis
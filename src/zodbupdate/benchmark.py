@@ -0,0 +1,506 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Generate synthetic databases and measure how fast zodbupdate
+processes them.
+
+Records are written directly as pickles, so databases looking like
+they were created with Python 2 (binary strings, datetime payloads as
+strings, classes at their old location) can be generated with Python 3.
+"""
+
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+
+import persistent
+import ZODB.FileStorage
+import ZODB.utils
+from ZODB.Connection import TransactionMetaData
+
+import zodbupdate.main
+import zodbupdate.serialize
+import zodbupdate.stats
+import zodbupdate.utils
+
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+
+logger = logging.getLogger('zodbupdate')
+
+STORAGES = ('filestorage', 'relstorage')
+MODES = ('rename', 'convert', 'dry-run')
+KINDS = ('persistent', 'bucket', 'mapping')
+
+# Records written per transaction while generating a database.
+GENERATE_TRANSACTION_SIZE = 10000
+
+# Where classes are, and where they used to be.
+CLASSES = {
+    'persistent': (
+        ('zodbupdate.benchmark', 'Item'),
+        ('zodbupdate.benchmark', 'OldItem')),
+    'bucket': (
+        ('BTrees.OOBTree', 'OOBucket'),
+        ('BTrees._OOBTree', 'OOBucket')),
+    'mapping': (
+        ('persistent.mapping', 'PersistentMapping'),
+        ('PersistentMapping', 'PersistentMapping')),
+}
+RENAMES = {old: new for new, old in CLASSES.values()}
+
+
+class Item(persistent.Persistent):
+    """Objects created by the benchmark.
+    """
+
+
+class Generator:
+    """Write pickles of the given kinds of objects, either as Python 3
+    would or as Python 2 did.
+    """
+
+    def __init__(self, py2=False, seed=0):
+        self.py2 = py2
+        self.random = random.Random(seed)
+        self.protocol = b'\x80\x02' if py2 else b'\x80\x03'
+
+    def string(self, value):
+        if self.py2:
+            return self.binary(value.encode('ascii'))
+        value = value.encode('utf-8')
+        return b'X' + struct.pack('<I', len(value)) + value
+
+    def binary(self, value):
+        if len(value) < 256:
+            return (b'U' if self.py2 else b'C') + bytes([len(value)]) + value
+        return (b'T' if self.py2 else b'B') + struct.pack(
+            '<I', len(value)) + value
+
+    def integer(self, value):
+        return b'J' + struct.pack('<i', value)
+
+    def global_(self, symb):
+        return b'c' + '\n'.join(symb).encode('ascii') + b'\n'
+
+    def datetime(self):
+        # Year, month, day, hour, minutes, seconds and microseconds.
+        value = struct.pack(
+            '>HBBBBB', self.random.randint(1990, 2030),
+            self.random.randint(1, 12), self.random.randint(1, 28),
+            self.random.randint(0, 23), self.random.randint(0, 59),
+            self.random.randint(0, 59)) + b'\x00\x00\x00'
+        return self.global_(('datetime', 'datetime')) + self.binary(
+            value) + b'\x85R'
+
+    def word(self):
+        return ''.join(
+            self.random.choice('abcdefghijklmnopqrstuvwxyz')
+            for count in range(self.random.randint(4, 12)))
+
+    def record(self, kind, symb, previous=None):
+        """Return a record (class and state pickles) for an object of
+        the given kind, using the given class.
+        """
+        klass = self.protocol + self.global_(symb) + b'.'
+        if kind == 'persistent':
+            state = b'}(' + self.string('title') + self.string(
+                ' '.join(self.word() for count in range(5)))
+            state += self.string('created') + self.datetime()
+            state += self.string('count') + self.integer(
+                self.random.randint(0, 1 << 30))
+            if previous is not None:
+                state += self.string('previous') + b'(' + self.binary(
+                    previous) + self.global_(symb) + b'tQ'
+            state += b'u'
+        elif kind == 'bucket':
+            state = b'(' + b''.join(
+                self.string(f'key{count:05d}') + self.integer(count)
+                for count in range(self.random.randint(10, 60))) + b't\x85'
+        else:
+            state = b'}' + self.string('data') + b'}(' + b''.join(
+                self.string(self.word() + str(count)) + self.string(
+                    self.word())
+                for count in range(self.random.randint(2, 10))) + b'us'
+        return klass + self.protocol + state + b'.'
+
+
+def generate(storage, records, mix=None, renamed=0.0, py2=False, seed=0):
+    """Fill a storage with the given number of records. mix gives the
+    weight of each kind of object and renamed the share of objects
+    using the old location of their class.
+    """
+    mix = mix or dict.fromkeys(KINDS, 1)
+    kinds = [kind for kind in KINDS if mix.get(kind)]
+    weights = [mix[kind] for kind in kinds]
+    generator = Generator(py2=py2, seed=seed)
+    choose = generator.random
+    previous = None
+    written = 0
+    while written < records:
+        t = TransactionMetaData()
+        storage.tpc_begin(t)
+        for count in range(min(GENERATE_TRANSACTION_SIZE, records - written)):
+            kind = choose.choices(kinds, weights)[0]
+            symb, old_symb = CLASSES[kind]
+            if choose.random() < renamed:
+                symb = old_symb
+            oid = storage.new_oid()
+            storage.store(
+                oid, ZODB.utils.z64,
+                generator.record(kind, symb, previous), '', t)
+            if kind == 'persistent':
+                previous = oid
+        written += count + 1
+        storage.tpc_vote(t)
+        storage.tpc_finish(t)
+
+
+def open_storage(kind, directory):
+    if kind == 'filestorage':
+        return ZODB.FileStorage.FileStorage(
+            os.path.join(directory, 'Data.fs'))
+    from ZODB import config
+    return config.storageFromString(
+        """
+        %import relstorage
+        <relstorage>
+            keep-history false
+            <sqlite3>
+               data-dir {datadir}
+            </sqlite3>
+        </relstorage>
+        """.format(datadir=directory))
+
+
+def peak_memory():
+    """Return the peak resident memory of this process in MB.
+    """
+    if resource is None:  # pragma: no cover
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS bytes.
+    if os.uname().sysname == 'Darwin':  # pragma: no cover
+        return usage / (1 << 20)
+    return usage / 1024
+
+
+def run(kind, directory, mode, workers=1):
+    """Run an update on the database in directory, and return its
+    statistics.
+    """
+    storage = open_storage(kind, directory)
+    stats = zodbupdate.stats.Stats()
+    updater = zodbupdate.main.create_updater(
+        storage,
+        default_renames=RENAMES,
+        convert_py3=mode == 'convert',
+        encoding='latin1' if mode == 'convert' else None,
+        dry_run=mode == 'dry-run',
+        workers=workers,
+        stats=stats)
+    start = time.perf_counter()
+    updater()
+    elapsed = time.perf_counter() - start
+    storage.close()
+    result = stats.as_dict()
+    records = result['counts'].get('records', 0)
+    return {
+        'storage': kind,
+        'mode': mode,
+        'workers': workers,
+        'records': records,
+        'updated': result['counts'].get('updated', 0),
+        'seconds': elapsed,
+        'records_per_second': records / elapsed if elapsed else 0.0,
+        'mb_per_second': (
+            result['counts'].get('bytes_read', 0) / elapsed / 1e6
+            if elapsed else 0.0),
+        'peak_rss_mb': peak_memory(),
+        'phases': result['phases'],
+    }
+
+
+def _run_in_process(queue, *args):
+    queue.put(run(*args))
+
+
+def run_in_process(*args):
+    """Run a benchmark in a new process, so its peak memory is not
+    affected by what was done before.
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_in_process, args=(queue,) + args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def format_results(results):
+    lines = ['{:<12} {:<8} {:>7} {:>9} {:>9} {:>10} {:>8} {:>8}'.format(
+        'storage', 'mode', 'workers', 'records', 'seconds', 'records/s',
+        'MB/s', 'RSS MB')]
+    for result in results:
+        lines.append(
+            '{storage:<12} {mode:<8} {workers:>7} {records:>9} '
+            '{seconds:>9.2f} {records_per_second:>10.0f} '
+            '{mb_per_second:>8.2f} {peak_rss:>8}'.format(
+                peak_rss='{:.0f}'.format(result['peak_rss_mb'])
+                if result['peak_rss_mb'] is not None else '-',
+                **result))
+    return '\n'.join(lines)
+
+
+class _Reference:
+    """Persistent reference found while unpickling a record.
+    """
+
+    def __init__(self, ref):
+        self.ref = ref
+
+
+def _persistent_id(obj):
+    if isinstance(obj, _Reference):
+        return obj.ref
+    return None
+
+
+def _repickle(module, records, reuse):
+    """Unpickle and repickle records with the given zodbpickle module,
+    creating a new pickler for each of them or reusing the same one.
+    """
+    pickler = None
+    for record in records:
+        unpickler = module.Unpickler(io.BytesIO(record))
+        unpickler.persistent_load = _Reference
+        klass = unpickler.load()
+        state = unpickler.load()
+        if pickler is None or not reuse:
+            output = io.BytesIO()
+            pickler = module.Pickler(output, 3)
+            pickler.persistent_id = _persistent_id
+        else:
+            output.seek(0)
+            output.truncate()
+        pickler.dump(klass)
+        pickler.dump(state)
+        pickler.clear_memo()
+        output.getvalue()
+
+
+def measure_pickling(records=10000, seed=0):
+    """Time unpickling and repickling records, with the C and the pure
+    Python implementations of zodbpickle, with a new pickler for each
+    record or a reused one.
+    """
+    import zodbpickle.slowpickle
+
+    generator = Generator(seed=seed)
+    previous = ZODB.utils.p64(1)
+    data = [
+        generator.record(kind, CLASSES[kind][0], previous)
+        for kind in KINDS for count in range(records // len(KINDS))]
+    implementations = [('python', zodbpickle.slowpickle)]
+    if not zodbupdate.utils.PURE_PYTHON:
+        implementations.insert(0, ('c', zodbupdate.utils.pickle))
+    results = []
+    for implementation, module in implementations:
+        for reuse in (False, True):
+            start = time.perf_counter()
+            _repickle(module, data, reuse)
+            elapsed = time.perf_counter() - start
+            results.append({
+                'implementation': implementation,
+                'pickler': 'reused' if reuse else 'new',
+                'records': len(data),
+                'seconds': elapsed,
+                'records_per_second': len(data) / elapsed if elapsed else 0.0,
+            })
+    return results
+
+
+def format_pickling_results(results):
+    lines = ['{:<15} {:<8} {:>9} {:>9} {:>10}'.format(
+        'implementation', 'pickler', 'records', 'seconds', 'records/s')]
+    for result in results:
+        lines.append(
+            '{implementation:<15} {pickler:<8} {records:>9} '
+            '{seconds:>9.2f} {records_per_second:>10.0f}'.format(**result))
+    return '\n'.join(lines)
+
+
+def _rename(records, scan_opcodes):
+    renamer = zodbupdate.serialize.ObjectRenamer(dict(RENAMES), {})
+    renamer.scan_opcodes = scan_opcodes
+    for record in records:
+        renamer.rename_record(record)
+
+
+def measure_scanning(records=10000, renamed=0.01, seed=0):
+    """Time renaming records in memory, when the given share of them
+    use an old location of their class, by unpickling all of them and
+    by looking at their opcodes first.
+    """
+    generator = Generator(seed=seed)
+    previous = ZODB.utils.p64(1)
+    data = []
+    for count in range(records):
+        kind = KINDS[count % len(KINDS)]
+        symb, old_symb = CLASSES[kind]
+        if generator.random.random() < renamed:
+            symb = old_symb
+        data.append(generator.record(kind, symb, previous))
+    results = []
+    for method, scan_opcodes in (('unpickle', False), ('scan', True)):
+        start = time.perf_counter()
+        _rename(data, scan_opcodes)
+        elapsed = time.perf_counter() - start
+        results.append({
+            'method': method,
+            'records': len(data),
+            'seconds': elapsed,
+            'records_per_second': len(data) / elapsed if elapsed else 0.0,
+        })
+    return results
+
+
+def format_scanning_results(results):
+    lines = ['{:<10} {:>9} {:>9} {:>10}'.format(
+        'method', 'records', 'seconds', 'records/s')]
+    for result in results:
+        lines.append(
+            '{method:<10} {records:>9} {seconds:>9.2f} '
+            '{records_per_second:>10.0f}'.format(**result))
+    return '\n'.join(lines)
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f'Unknown kind of object {kind}')
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+parser = argparse.ArgumentParser(
+    description="Measure how fast zodbupdate processes synthetic databases.")
+parser.add_argument(
+    "--records", type=int, default=100000,
+    help="number of records in the generated databases")
+parser.add_argument(
+    "--storage", choices=STORAGES, action="append",
+    help="storage to benchmark, can be repeated (default: filestorage)")
+parser.add_argument(
+    "--mode", choices=MODES, action="append",
+    help="kind of update to run, can be repeated (default: all)")
+parser.add_argument(
+    "--mix", type=parse_mix, default=dict.fromkeys(KINDS, 1),
+    help=("weight of each kind of object, ex: persistent=2,bucket=1 "
+          "(kinds: {})".format(', '.join(KINDS))))
+parser.add_argument(
+    "--renamed", type=float, default=0.1,
+    help="share of the objects using the old location of their class")
+parser.add_argument(
+    "--py2", action="store_true",
+    help="write records as Python 2 did")
+parser.add_argument(
+    "--seed", type=int, default=0,
+    help="seed of the generated data")
+parser.add_argument(
+    "--workers", type=int, default=1,
+    help="number of worker processes used by the updates")
+parser.add_argument(
+    "--pickling", action="store_true",
+    help=("only time unpickling and repickling records in memory, with "
+          "the C and pure Python implementations of zodbpickle"))
+parser.add_argument(
+    "--scanning", action="store_true",
+    help=("only time renaming the generated records in memory, by "
+          "unpickling all of them or by looking at their opcodes first"))
+parser.add_argument(
+    "--json",
+    help="save the results in this file")
+parser.add_argument(
+    "--directory",
+    help="directory where databases are generated (default: temporary)")
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.pickling:
+        results = measure_pickling(args.records, seed=args.seed)
+        print(format_pickling_results(results))
+        if args.json:
+            with open(args.json, 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        return
+    if args.scanning:
+        results = measure_scanning(
+            args.records, renamed=args.renamed, seed=args.seed)
+        print(format_scanning_results(results))
+        if args.json:
+            with open(args.json, 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        return
+    directory = args.directory or tempfile.mkdtemp('.zodbupdate-benchmark')
+    results = []
+    try:
+        for kind in args.storage or ['filestorage']:
+            original = os.path.join(directory, kind)
+            if not os.path.isdir(original):
+                os.makedirs(original)
+                storage = open_storage(kind, original)
+                start = time.perf_counter()
+                generate(
+                    storage, args.records, mix=args.mix,
+                    renamed=args.renamed, py2=args.py2, seed=args.seed)
+                storage.close()
+                print('Generated {} records in {} in {:.1f}s'.format(
+                    args.records, kind, time.perf_counter() - start))
+            for mode in args.mode or MODES:
+                copy = os.path.join(directory, f'{kind}-{mode}')
+                shutil.rmtree(copy, ignore_errors=True)
+                shutil.copytree(original, copy)
+                try:
+                    results.append(
+                        run_in_process(kind, copy, mode, args.workers))
+                finally:
+                    shutil.rmtree(copy, ignore_errors=True)
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import json
+import os
+import tempfile
+
+import ZODB.utils
+
+
+class Checkpoint:
+    """Progress of an update, saved after each committed transaction
+    so an interrupted run can be resumed where it stopped.
+
+    ``oid`` is the last OID processed in a committed transaction,
+    ``counts`` how many records were processed, updated and
+    transactions committed so far, and ``rules`` the implicit rules
+    found so far. ``tid`` is the last transaction of the storage when
+    the update started. When the records are read in file order,
+    ``position`` is the position of the last record processed,
+    ``end`` the size of the file when the update started.
+    ``first_oid`` is the OID, in hex format, the update started with,
+    and ``end_oid`` the one it stopped before, if it only updated a
+    range of OIDs.
+    """
+
+    def __init__(self, oid=None, counts=None, rules=None, tid=None,
+                 finished=False, position=None, end=None,
+                 first_oid='0x00', end_oid=None):
+        self.oid = oid
+        self.position = position
+        self.end = end
+        self.first_oid = first_oid
+        self.end_oid = end_oid
+        self.counts = {'processed': 0, 'updated': 0, 'commits': 0}
+        if counts:
+            self.counts.update(counts)
+        self.rules = rules or {}
+        self.tid = tid
+        self.finished = finished
+
+    @property
+    def start_at(self):
+        """Return the OID, in hex format, to resume with.
+        """
+        if self.oid is None:
+            return '0x00'
+        return ZODB.utils.oid_repr(
+            ZODB.utils.p64(ZODB.utils.u64(self.oid) + 1))
+
+    def save(self, path):
+        """Atomically write the checkpoint to the given path.
+        """
+        state = {
+            'oid': None if self.oid is None else ZODB.utils.oid_repr(
+                self.oid),
+            'tid': None if self.tid is None else ZODB.utils.tid_repr(
+                self.tid),
+            'counts': self.counts,
+            'rules': {
+                ' '.join(old): ' '.join(new)
+                for old, new in self.rules.items()},
+            'finished': self.finished,
+            'position': self.position,
+            'end': self.end,
+            'first_oid': self.first_oid,
+            'end_oid': self.end_oid,
+        }
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temporary = tempfile.mkstemp(
+            dir=directory, prefix='.zodbupdate-checkpoint')
+        try:
+            with os.fdopen(fd, 'w') as output:
+                json.dump(state, output, indent=2, sort_keys=True)
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Read a checkpoint written by save.
+        """
+        with open(path) as stream:
+            state = json.load(stream)
+        oid = state.get('oid')
+        tid = state.get('tid')
+        return cls(
+            oid=None if oid is None else ZODB.utils.repr_to_oid(oid),
+            counts=state.get('counts'),
+            rules={
+                tuple(old.split(' ')): tuple(new.split(' '))
+                for old, new in state.get('rules', {}).items()},
+            tid=None if tid is None else ZODB.utils.repr_to_oid(tid),
+            finished=state.get('finished', False),
+            position=state.get('position'),
+            end=state.get('end'),
+            first_oid=state.get('first_oid', '0x00'),
+            end_oid=state.get('end_oid'))
+
+    @classmethod
+    def combine(cls, checkpoints):
+        """Combine the checkpoints of updates run at the same time on
+        different ranges of OIDs into one covering all of them. The
+        transaction is the oldest one, so an update started from it
+        with --since-checkpoint catches up with the changes of all the
+        ranges. If some of the updates are not finished, the combined
+        one resumes where the first of them stopped, and the ranges
+        after it are updated again.
+        """
+        def first(checkpoint):
+            return ZODB.utils.u64(
+                ZODB.utils.repr_to_oid(checkpoint.first_oid))
+
+        checkpoints = sorted(checkpoints, key=first)
+        combined = cls(first_oid=checkpoints[0].first_oid)
+        for checkpoint in checkpoints:
+            for name, count in checkpoint.counts.items():
+                combined.counts[name] = combined.counts.get(name, 0) + count
+            for old, new in checkpoint.rules.items():
+                combined.rules.setdefault(old, new)
+        # OIDs only grow from one range to the next: resume after the
+        # last one processed before the first unfinished range.
+        for checkpoint in checkpoints:
+            if checkpoint.oid is not None:
+                combined.oid = checkpoint.oid
+            if not checkpoint.finished:
+                break
+        tids = [
+            checkpoint.tid for checkpoint in checkpoints
+            if checkpoint.tid is not None]
+        combined.tid = min(tids) if tids else None
+        combined.finished = all(
+            checkpoint.finished for checkpoint in checkpoints)
+        combined.end_oid = checkpoints[-1].end_oid
+        return combined
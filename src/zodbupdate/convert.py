@@ -1,11 +1,14 @@
 import builtins
+import codecs
 import datetime
+import functools
 import logging
 import sys
 import types
 
 import zodbpickle
 
+from zodbupdate import logs
 from zodbupdate import utils
 
 
@@ -81,47 +84,71 @@ def default_renames():
         ('datetime', 'time'): ('zodbupdate.convert', 'Time')}
 
 
-def convert_with_fallbacks(value, attribute, encoding, encoding_fallbacks):
-    converted = None
+# Encodings that Python decodes about as fast as ASCII: checking that
+# a value is ASCII before decoding it would only add work.
+FAST_ENCODINGS = frozenset(['ascii', 'utf-8', 'iso8859-1'])
+
+_ASCII = bytes(range(128))
+
+
+@functools.lru_cache(maxsize=None)
+def ascii_shortcut(encoding):
+    """Return true if values made of ASCII characters only can be
+    decoded as ASCII instead of with the given encoding, and that is
+    faster.
+    """
+    if codecs.lookup(encoding).name in FAST_ENCODINGS:
+        return False
+    try:
+        return _ASCII.decode(encoding) == _ASCII.decode('ascii')
+    except UnicodeDecodeError:
+        return False
+
+
+def convert_with_fallbacks(
+        value, attribute, encoding, encoding_fallbacks, fallbacks=None):
+    """Decode value with encoding, or the first of encoding_fallbacks
+    that works.
+
+    If fallbacks is a dictionary, the number of values decoded with
+    each fallback encoding is counted in it, per (attribute, encoding),
+    instead of logging a warning for each of them.
+    """
+    if ascii_shortcut(encoding) and value.isascii():
+        return value.decode('ascii')
     try:
-        converted = value.decode(encoding)
+        return value.decode(encoding)
     except UnicodeDecodeError:
         if not encoding_fallbacks:
             logger.error("No encoding-fallbacks given!")
             raise
-        for encoding_fallback in encoding_fallbacks:
-            try:
-                converted = value.decode(encoding_fallback)
-            except UnicodeDecodeError:
-                continue
-
+    for encoding_fallback in encoding_fallbacks:
+        try:
+            converted = value.decode(encoding_fallback)
+        except UnicodeDecodeError:
+            continue
+        if fallbacks is None:
             logger.warning(
-                'Encoding fallback to "{fallback_encoding:s}" '
-                'while decoding attribute "{attribute:s}" '.format(
-                    fallback_encoding=encoding_fallback,
-                    attribute=attribute,
-                )
-            )
-            logger.debug(
-                "Decoded from: \n{value!r}\nto:\n{converted}".format(
-                    value=value,
-                    converted=converted,
-                )
-            )
-            break
+                'Encoding fallback to "%s" while decoding attribute "%s" ',
+                encoding_fallback, attribute,
+                extra={'kind': logs.ENCODING_FALLBACK})
         else:
-            raise UnicodeDecodeError(
-                'encoding={encoding}, fallback_encodings={fallbacks}'.format(
-                    encoding=encoding,
-                    fallbacks=encoding_fallbacks,
-                ),
-                value,
-                0,
-                0,
-                'Neither with encoding nor with fallbacks.',
-            )
-
-    return converted
+            key = (attribute, encoding_fallback)
+            fallbacks[key] = fallbacks.get(key, 0) + 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Decoded from: \n%r\nto:\n%s", value, converted)
+        return converted
+    raise UnicodeDecodeError(
+        'encoding={encoding}, fallback_encodings={fallbacks}'.format(
+            encoding=encoding,
+            fallbacks=encoding_fallbacks,
+        ),
+        value,
+        0,
+        0,
+        'Neither with encoding nor with fallbacks.',
+    )
 
 
 def decode_attribute(attribute, encoding, encoding_fallbacks=None):
@@ -154,18 +181,119 @@ def encode_binary(attribute):
     return encode
 
 
+class ClassDecoder:
+    """Decode (or encode to binary) all the attributes of a class
+    that need it, in one pass over the state of a record. Other
+    decoders, like the ones created by decode_attribute or
+    encode_binary, can be added too.
+
+    How many records were seen and modified, how many times each
+    attribute was modified, and how many values were decoded with each
+    fallback encoding is counted.
+    """
+
+    def __init__(self):
+        # Encoding (None for binary) and fallbacks, per attribute.
+        self.rules = {}
+        self.decoders = []
+        self.records = 0
+        self.changed = 0
+        self.attributes = {}
+        # Values decoded with a fallback, per (attribute, encoding).
+        self.fallbacks = {}
+
+    def add_text(self, attribute, encoding, encoding_fallbacks=None):
+        self.rules[attribute] = (encoding, encoding_fallbacks)
+
+    def add_binary(self, attribute):
+        self.rules[attribute] = (None, None)
+
+    def add(self, decoder):
+        if isinstance(decoder, ClassDecoder):
+            self.rules.update(decoder.rules)
+            self.decoders.extend(decoder.decoders)
+        else:
+            self.decoders.append(decoder)
+
+    def __call__(self, data):
+        self.records += 1
+        changed = False
+        get = data.get
+        for attribute, (encoding, encoding_fallbacks) in self.rules.items():
+            value = get(attribute)
+            if value is None:
+                continue
+            if encoding is None:
+                if isinstance(value, zodbpickle.binary):
+                    continue
+                data[attribute] = utils.safe_binary(value)
+            else:
+                if isinstance(value, str):
+                    if encoding == utils.ENCODING:
+                        continue
+                    value = utils.safe_binary(value)
+                data[attribute] = convert_with_fallbacks(
+                    value, attribute, encoding, encoding_fallbacks,
+                    self.fallbacks)
+            self.attributes[attribute] = self.attributes.get(attribute, 0) + 1
+            changed = True
+        for decoder in self.decoders:
+            changed = decoder(data) or changed
+        if changed:
+            self.changed += 1
+        return changed
+
+    def get_stats(self, reset=False):
+        stats = {
+            'records': self.records,
+            'changed': self.changed,
+            'attributes': dict(self.attributes),
+            'fallbacks': dict(self.fallbacks),
+        }
+        if reset:
+            self.records = self.changed = 0
+            self.attributes.clear()
+            self.fallbacks.clear()
+        return stats
+
+    def merge_stats(self, stats):
+        self.records += stats['records']
+        self.changed += stats['changed']
+        for attribute, count in stats['attributes'].items():
+            self.attributes[attribute] = (
+                self.attributes.get(attribute, 0) + count)
+        for key, count in stats['fallbacks'].items():
+            self.fallbacks[key] = self.fallbacks.get(key, 0) + count
+
+
+def compile_decoders(decoders):
+    """Return a ClassDecoder for each class, from decoders given as a
+    list of callables (or a single one) per class.
+    """
+    compiled = {}
+    for symb_info, class_decoders in decoders.items():
+        decoder = ClassDecoder()
+        if callable(class_decoders):
+            class_decoders = [class_decoders]
+        for class_decoder in class_decoders:
+            decoder.add(class_decoder)
+        compiled[symb_info] = decoder
+    return compiled
+
+
 def load_decoders(encoding_fallbacks=[]):
     decoders = {}
     for entry_point in entry_points().select(group='zodbupdate.decode'):
         definition = entry_point.load()
         for attribute_path, encoding in definition.items():
             module, cls, attribute = attribute_path.split(' ')
+            decoder = decoders.get((module, cls))
+            if decoder is None:
+                decoder = decoders[module, cls] = ClassDecoder()
             if encoding == 'binary':
-                decoders.setdefault((module, cls), []).append(
-                    encode_binary(attribute))
+                decoder.add_binary(attribute)
             else:
-                decoders.setdefault((module, cls), []).append(
-                    decode_attribute(attribute, encoding, encoding_fallbacks))
+                decoder.add_text(attribute, encoding, encoding_fallbacks)
         logger.info(
             'Loaded %d decode rules from %s',
             len(definition),
@@ -174,7 +302,7 @@ def load_decoders(encoding_fallbacks=[]):
     return decoders
 
 
-def update_magic_data_fs(filename):
+def update_magic_data_fs(filename, magic=b'FS30'):
     if not filename:
         logger.info("We do not know the database file so "
                     "we do not change the magic marker.")
@@ -182,4 +310,4 @@ def update_magic_data_fs(filename):
         logger.info(f"Updating magic marker for {filename}")
         with open(filename, 'r+b') as data_fs:
             # Override the magic.
-            data_fs.write(b'FS30')
+            data_fs.write(magic)
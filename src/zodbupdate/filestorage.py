@@ -0,0 +1,180 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import array
+import collections
+import mmap
+import struct
+
+import ZODB.POSException
+import ZODB.utils
+from ZODB.FileStorage.format import DATA_HDR
+from ZODB.FileStorage.format import DATA_HDR_LEN
+from ZODB.FileStorage.format import TRANS_HDR
+from ZODB.FileStorage.format import TRANS_HDR_LEN
+
+import zodbupdate.logs
+
+
+# Length of the magic string at the beginning of a Data.fs.
+FILE_HEADER_LEN = 4
+
+# Approximate number of records sorted at once by PositionScanner.
+BUCKET_SIZE = 1 << 20
+
+
+class Scanner:
+    """Iterate through the current records of a FileStorage in file
+    order.
+
+    Only the part of the file that existed when the scanner was
+    created is read: records written by the update itself are not
+    seen again.
+
+    Call ``processed`` with the OID of each record once it has been
+    processed: ``position`` is then the position of the last
+    processed record, from where a later scanner can resume with
+    ``start``.
+    """
+
+    def __init__(self, storage, start=None, end=None):
+        self.storage = storage
+        self.start = start
+        self.end = storage._pos if end is None else end
+        self.position = start
+        self.pending = collections.deque()
+
+    def processed(self, oid):
+        pending = self.pending
+        while pending:
+            pending_oid, position = pending.popleft()
+            if pending_oid == oid:
+                self.position = position
+                break
+
+
+class SequentialScanner(Scanner):
+    """Read the records from a memory map of the Data.fs, from its
+    beginning to its end. Records are given as ``(oid, tid, data)``
+    where data is a memoryview on the map.
+    """
+
+    def __iter__(self):
+        if self.end <= FILE_HEADER_LEN:
+            return
+        with open(self.storage._file_name, 'rb') as stream:
+            data = mmap.mmap(
+                stream.fileno(), self.end, access=mmap.ACCESS_READ)
+        # The map is not closed explicitly, records given out might still
+        # reference it. It is released when they are gone.
+        yield from self.__records(data, memoryview(data))
+
+    def __records(self, data, view):
+        index = self.storage._index
+        start = self.start
+        end = self.end
+        pending = self.pending
+        position = FILE_HEADER_LEN
+        while position < end:
+            tid, tlen, status, ulen, dlen, elen = struct.unpack_from(
+                TRANS_HDR, data, position)
+            transaction_end = position + tlen
+            if status == b'c' or transaction_end + 8 > end:
+                # Transaction being committed.
+                break
+            if start is not None and transaction_end <= start:
+                position = transaction_end + 8
+                continue
+            record = position + TRANS_HDR_LEN + ulen + dlen + elen
+            while record < transaction_end:
+                oid, serial, prev, tloc, vlen, plen = struct.unpack_from(
+                    DATA_HDR, data, record)
+                if vlen:
+                    raise ZODB.POSException.StorageSystemError(
+                        'Cannot read records with versions')
+                payload = record + DATA_HDR_LEN
+                next_record = payload + (plen or 8)
+                if ((start is None or record > start) and
+                        index.get(oid) == record):
+                    try:
+                        current = self.__load(data, view, oid, payload, plen)
+                    except ZODB.POSException.POSKeyError as e:
+                        zodbupdate.logs.log_missing_record(oid, e)
+                    else:
+                        pending.append((oid, record))
+                        yield oid, serial, current
+                record = next_record
+            position = transaction_end + 8
+
+    def __load(self, data, view, oid, payload, plen):
+        """Return the data of a record, following back pointers (left
+        by undo or a copy of transactions) if needed.
+        """
+        while not plen:
+            back, = struct.unpack_from('>Q', data, payload)
+            if not back:
+                # The object creation was undone.
+                raise ZODB.POSException.POSKeyError(oid)
+            plen, = struct.unpack_from('>Q', data, back + DATA_HDR_LEN - 8)
+            payload = back + DATA_HDR_LEN
+        return view[payload:payload + plen]
+
+
+class PositionScanner(Scanner):
+    """Read the records whose OID is at least ``start_at`` in the
+    order of their position in the file, using the index to find
+    them.
+
+    Positions are kept in arrays, grouped by range in the file so that
+    only one of them is sorted at a time.
+    """
+
+    def __init__(self, storage, start=None, end=None, start_at=None):
+        super().__init__(storage, start=start, end=end)
+        self.start_at = start_at
+
+    def buckets(self):
+        index = self.storage._index
+        count = max(len(index) // BUCKET_SIZE, 1)
+        buckets = [array.array('Q') for bucket in range(count)]
+        start = self.start or 0
+        end = self.end
+        start_at = self.start_at
+        for oid, position in index.iteritems():
+            if start_at is not None and oid < start_at:
+                continue
+            if start < position < end:
+                buckets[position * count // end].append(position)
+        for bucket in buckets:
+            yield sorted(bucket)
+
+    def __iter__(self):
+        storage = self.storage
+        pending = self.pending
+        with open(storage._file_name, 'rb') as _file:
+            for bucket in self.buckets():
+                for position in bucket:
+                    header = storage._read_data_header(position, _file=_file)
+                    oid = header.oid
+                    try:
+                        if header.plen:
+                            data = _file.read(header.plen)
+                        else:
+                            data = storage._loadBack_impl(
+                                oid, header.back, _file=_file)[0]
+                    except ZODB.POSException.POSKeyError as e:
+                        zodbupdate.logs.log_missing_record(oid, e)
+                        continue
+                    pending.append((oid, position))
+                    yield oid, header.tid, data
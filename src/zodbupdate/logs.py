@@ -0,0 +1,151 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Count the warnings logged for records instead of logging each of
+them.
+
+Warnings about records are logged with their kind, and if possible
+the class and the OID of the record, as extra attributes::
+
+    logger.warning(message, extra={
+        'kind': MISSING_FACTORY, 'class_name': 'module Class', 'oid': oid})
+
+Only the first warning of each kind and class is logged. The others
+are counted, with a few example OIDs, and reported at the end.
+"""
+
+import logging
+
+import ZODB.utils
+
+
+logger = logging.getLogger('zodbupdate')
+
+# Kinds of warnings.
+MISSING_FACTORY = 'missing factory'
+MISSING_RECORD = 'missing record'
+MISSING_BLOB = 'missing blob'
+PICKLING_ERROR = 'pickling error'
+ENCODING_FALLBACK = 'encoding fallback'
+
+# Number of example OIDs kept for each kind of warning and class.
+SAMPLE_SIZE = 5
+
+# Number of kinds of warnings and classes counted separately. Once it
+# is reached, warnings for other classes are counted together.
+MAX_KEYS = 1000
+
+# Name used for those other classes, and warnings without a class.
+OTHER = '-'
+
+
+class WarningAggregator(logging.Filter):
+    """Logging filter counting warnings per kind and class. The
+    memory it uses does not depend on the number of warnings.
+    """
+
+    def __init__(self, sample_size=SAMPLE_SIZE, max_keys=MAX_KEYS):
+        super().__init__()
+        self.sample_size = sample_size
+        self.max_keys = max_keys
+        self.reset()
+
+    def reset(self):
+        # Count and example OIDs per (kind, class_name).
+        self.counts = {}
+        # Kinds and classes already seen, even if their counts were
+        # taken since.
+        self.seen = set()
+
+    def add(self, kind, class_name, count=1, oids=()):
+        """Count warnings. Return true for the first one of that kind
+        and class.
+        """
+        key = (kind, class_name or OTHER)
+        first = key not in self.seen
+        if first:
+            if len(self.seen) >= self.max_keys:
+                key = (kind, OTHER)
+                first = key not in self.seen
+            self.seen.add(key)
+        entry = self.counts.get(key)
+        if entry is None:
+            entry = self.counts[key] = [0, []]
+        entry[0] += count
+        sample = entry[1]
+        for oid in oids:
+            if len(sample) >= self.sample_size:
+                break
+            if oid not in sample:
+                sample.append(oid)
+        return first
+
+    def filter(self, record):
+        kind = getattr(record, 'kind', None)
+        if kind is None:
+            return True
+        oid = getattr(record, 'oid', None)
+        return self.add(
+            kind, getattr(record, 'class_name', None),
+            oids=() if oid is None else (oid,))
+
+    def take(self):
+        """Return the counts and reset them. This is used to send them
+        from a worker process to the parent one.
+        """
+        counts = self.counts
+        self.counts = {}
+        return counts
+
+    def merge(self, counts):
+        for (kind, class_name), (count, oids) in counts.items():
+            self.add(kind, class_name, count, oids)
+
+    def rows(self):
+        """Return a row per kind of warning and class, most frequent
+        first.
+        """
+        rows = [
+            {'kind': kind, 'class': class_name, 'count': count,
+             'oids': [ZODB.utils.oid_repr(oid) for oid in oids]}
+            for (kind, class_name), (count, oids) in self.counts.items()]
+        rows.sort(key=lambda row: (-row['count'], row['kind'], row['class']))
+        return rows
+
+    def summary(self):
+        """Return the lines of a table summarizing the warnings.
+        """
+        rows = self.rows()
+        if not rows:
+            return []
+        kind_width = max(len(row['kind']) for row in rows + [{'kind': 'kind'}])
+        class_width = max(
+            len(row['class']) for row in rows + [{'class': 'class'}])
+        line = '{:<%d}  {:<%d}  {:>10}  {}' % (kind_width, class_width)
+        lines = [line.format('kind', 'class', 'count', 'example OIDs')]
+        for row in rows:
+            lines.append(line.format(
+                row['kind'], row['class'], row['count'],
+                ' '.join(row['oids'])))
+        return lines
+
+
+aggregator = WarningAggregator()
+
+
+def log_missing_record(oid, error):
+    logger.error(
+        'Warning: Jumping record {}, '
+        'referencing missing key in database: {}'.format(
+            ZODB.utils.oid_repr(oid), str(error)),
+        extra={'kind': MISSING_RECORD, 'oid': oid})
@@ -21,8 +21,16 @@ import time
 import ZODB.config
 import ZODB.FileStorage
 import ZODB.serialize
+import ZODB.utils
 
+import zodbupdate.checkpoint
 import zodbupdate.convert
+import zodbupdate.logs
+import zodbupdate.memory
+import zodbupdate.oids
+import zodbupdate.pack
+import zodbupdate.profiling
+import zodbupdate.stats
 import zodbupdate.update
 import zodbupdate.utils
 
@@ -45,6 +53,15 @@ exclusive_group.add_argument(
 exclusive_group.add_argument(
     "-c", "--config",
     help="load storage from config file")
+output_group = parser.add_mutually_exclusive_group()
+output_group.add_argument(
+    "--output-file",
+    help=("copy the current revision of every record, updated or not, "
+          "to a new FileStorage instead of updating the storage in place"))
+output_group.add_argument(
+    "--output-config",
+    help=("copy the current revision of every record, updated or not, "
+          "to the storage of this config file (to copy blobs as well)"))
 parser.add_argument(
     "-n", "--dry-run", action="store_true",
     help="perform a trial run with no changes made")
@@ -60,13 +77,20 @@ parser.add_argument(
 parser.add_argument(
     "-o", "--oid",
     help="start with provided oid in hex format, ex: 0xaa1203")
+parser.add_argument(
+    "--oid-range", type=zodbupdate.oids.parse_range, metavar="START:END",
+    help=("only update the records with an OID from START (included) to "
+          "END (excluded), in hex format, ex: 0x00:0x10000, to split an "
+          "update between several machines (see zodbupdate-merge)"))
 parser.add_argument(
     "-d", "--debug", action="store_true",
     help="post mortem pdb on failure")
 parser.add_argument(
     "--pack", action="store_true", dest="pack",
     help=("pack the storage when done. use in conjunction of -c "
-          "if you have blobs storage"))
+          "if you have blobs storage. with --output-file, the records "
+          "not reachable from the root are found while copying, and the "
+          "copy is written again without them if there are any"))
 parser.add_argument(
     "--convert-py3", action="store_true", dest="convert_py3",
     help="convert pickle format to protocol 3 and adjust bytes")
@@ -82,28 +106,95 @@ parser.add_argument(
     " latin1. If an encoding error occurs, fallback to the given encodings "
     "and issue a warning.",
 )
-
-
-class DuplicateFilter:
-
-    def __init__(self):
-        self.reset()
-
-    def filter(self, record):
-        if record.msg in self.seen:
-            return False
-        self.seen.add(record.msg)
-        return True
-
-    def reset(self):
-        self.seen = set()
-
-
-duplicate_filter = DuplicateFilter()
+parser.add_argument(
+    "--workers", type=int, default=1,
+    help="number of worker processes used to unpickle and repickle records")
+parser.add_argument(
+    "--transaction-records", type=int,
+    help=("number of updated records after which a transaction is committed "
+          "(default: {}, or {} with --online)".format(
+              zodbupdate.update.TRANSACTION_COUNT,
+              zodbupdate.update.ONLINE_TRANSACTION_COUNT)))
+parser.add_argument(
+    "--transaction-bytes", type=int,
+    help="size of updated records after which a transaction is committed")
+parser.add_argument(
+    "--commit-latency", type=float,
+    help=("adjust the number of records per transaction so committing "
+          "takes about this many seconds"))
+parser.add_argument(
+    "--online", action="store_true",
+    help=("update a database other clients are writing to (i.e. through "
+          "ZEO): use small transactions, and load and update again the "
+          "records that conflict with another transaction"))
+parser.add_argument(
+    "--max-records-per-second", type=float,
+    help="process at most this many records per second")
+parser.add_argument(
+    "--max-commit-rate", type=float,
+    help="commit at most this many transactions per second")
+parser.add_argument(
+    "--prefetch", type=int, default=0, metavar="RECORDS",
+    help=("read up to this many records ahead, and rename them, in "
+          "separate threads while the previous ones are written"))
+parser.add_argument(
+    "--iteration", choices=["oid", "position", "sequential"], default="oid",
+    help=("read records in OID order, in the order of their position in "
+          "the file, or sequentially through the whole file (the last two "
+          "for FileStorage only)"))
+parser.add_argument(
+    "--analyze", metavar="REPORT",
+    help=("do not update anything, but write a report with the number of "
+          "records and bytes per class, how many records would be "
+          "modified and which classes are missing, in CSV (or JSON if the "
+          "file name ends with .json)"))
+parser.add_argument(
+    "--collect-oids", metavar="FILE",
+    help=("do not update anything, but save in this file the OIDs of the "
+          "records an update would modify"))
+parser.add_argument(
+    "--oids-from", metavar="FILE",
+    help="only update the records whose OIDs were saved with --collect-oids")
+parser.add_argument(
+    "--since-tid", metavar="TID",
+    help=("only update the records modified by the transactions committed "
+          "after this one (in hex format), to catch up with the changes "
+          "made since a previous update"))
+parser.add_argument(
+    "--since-checkpoint", metavar="FILE",
+    help=("only update the records modified by the transactions committed "
+          "after the end of the update that saved this checkpoint"))
+parser.add_argument(
+    "--stats-json",
+    help=("time each phase of the update, log the progress regularly and "
+          "save the statistics in this file at the end"))
+parser.add_argument(
+    "--max-memory", type=zodbupdate.memory.parse_size, metavar="SIZE",
+    help=("when the memory used gets close to this size (in bytes, or "
+          "with a K, M or G suffix), commit and drop caches"))
+parser.add_argument(
+    "--memory-report", metavar="FILE",
+    help=("trace memory allocations and write in this file, after each "
+          "commit, the memory used, the size of the main data structures "
+          "and where zodbupdate allocated the most (slows the update "
+          "down)"))
+parser.add_argument(
+    "--profile", metavar="DIR",
+    help=("run the update under cProfile, saving the statistics of each "
+          "process in this directory, along with the time spent to "
+          "unpickle, decode and repickle the records of each class"))
+parser.add_argument(
+    "--checkpoint",
+    help="save progress to this file after each committed transaction")
+parser.add_argument(
+    "--resume", action="store_true",
+    help="resume an interrupted run from the file given with --checkpoint")
 
 
 def setup_logger(verbose=False, quiet=False, handler=None):
-    logging.getLogger('zodbupdate.serialize').addFilter(duplicate_filter)
+    # Only log the first warning of each kind for each class.
+    for name in ('zodbupdate', 'zodbupdate.serialize'):
+        logging.getLogger(name).addFilter(zodbupdate.logs.aggregator)
     if quiet:
         level = logging.ERROR
     elif verbose:
@@ -137,13 +228,36 @@ def create_updater(
         default_renames=None,
         default_decoders=None,
         start_at=None,
+        end_at=None,
         convert_py3=False,
         encoding=None,
         encoding_fallbacks=None,
         dry_run=False,
-        debug=False):
+        debug=False,
+        workers=1,
+        checkpoint=None,
+        resume=False,
+        transaction_records=None,
+        transaction_bytes=None,
+        commit_latency=None,
+        iteration='oid',
+        stats=None,
+        oids=None,
+        online=False,
+        max_records_per_second=None,
+        max_commit_rate=None,
+        prefetch=0,
+        output=None,
+        pack=False,
+        memory=None,
+        profiler=None):
     if not start_at:
         start_at = '0x00'
+    if transaction_records is None:
+        if online:
+            transaction_records = zodbupdate.update.ONLINE_TRANSACTION_COUNT
+        else:
+            transaction_records = zodbupdate.update.TRANSACTION_COUNT
 
     decoders = {}
     if default_decoders:
@@ -169,10 +283,28 @@ def create_updater(
         renames=renames,
         decoders=decoders,
         start_at=start_at,
+        end_at=end_at,
         debug=debug,
         repickle_all=repickle_all,
         pickle_protocol=pickle_protocol,
         encoding=encoding,
+        workers=workers,
+        checkpoint=checkpoint,
+        resume=resume,
+        transaction_records=transaction_records,
+        transaction_bytes=transaction_bytes,
+        commit_latency=commit_latency,
+        iteration=iteration,
+        stats=stats,
+        oids=oids,
+        online=online,
+        max_records_per_second=max_records_per_second,
+        max_commit_rate=max_commit_rate,
+        prefetch=prefetch,
+        output=output,
+        pack=pack,
+        memory=memory,
+        profiler=profiler,
     )
 
 
@@ -189,58 +321,231 @@ def main():
     args = parser.parse_args()
 
     setup_logger(quiet=args.quiet, verbose=args.verbose)
+    zodbupdate.utils.check_pickle_implementation()
 
     if args.file and args.config:
         raise AssertionError(
             'Exactly one of --file or --config must be given.')
+    if args.resume and not args.checkpoint:
+        raise AssertionError('--resume requires --checkpoint.')
+    if args.resume and args.oid:
+        raise AssertionError('--resume and --oid cannot be used together.')
+    if args.iteration == 'sequential' and args.oid:
+        raise AssertionError(
+            '--oid cannot be used with a sequential iteration.')
+    if args.oid_range and args.oid:
+        raise AssertionError('--oid and --oid-range cannot be used together.')
+    if args.oid_range and args.iteration != 'oid':
+        raise AssertionError(
+            '--oid-range cannot be used with another iteration.')
+    since = [
+        option for option in (args.oids_from, args.since_tid,
+                              args.since_checkpoint)
+        if option]
+    if len(since) > 1:
+        raise AssertionError(
+            'Only one of --oids-from, --since-tid or --since-checkpoint '
+            'can be given.')
+    if since and args.iteration != 'oid':
+        raise AssertionError(
+            '--oids-from, --since-tid and --since-checkpoint cannot be used '
+            'with another iteration.')
 
     # Magic bytes need to be at the beginning so that FileStorage
     # doesn't complain.
-    if args.convert_py3 and not args.dry_run:
+    analyze = args.analyze or args.collect_oids
+    read_only = args.dry_run or analyze
+    copy = args.output_file or args.output_config
+    if copy and (read_only or args.online):
+        raise AssertionError(
+            '--output-file and --output-config cannot be used with '
+            '--dry-run, --analyze, --collect-oids or --online.')
+    if args.pack and args.output_file and (
+            args.resume or args.oid or args.oid_range or since):
+        raise AssertionError(
+            '--pack with --output-file needs to copy all the records, it '
+            'cannot be used with --resume, --oid, --oid-range, --oids-from, '
+            '--since-tid or --since-checkpoint.')
+
+    memory = None
+    if args.max_memory or args.memory_report:
+        # Before opening the storage, to trace what it allocates too.
+        memory = zodbupdate.memory.MemoryMonitor(
+            limit=args.max_memory, report=args.memory_report)
+
+    magic = None
+    if args.convert_py3 and not read_only:
+        if copy and args.file:
+            # Put the magic back at the end, the source is not modified.
+            magic = zodbupdate.utils.get_zodb_magic(args.file)
         zodbupdate.convert.update_magic_data_fs(args.file)
-    elif args.convert_py3 and args.dry_run:
+    elif args.convert_py3 and read_only and args.file:
         zodb_magic = zodbupdate.utils.get_zodb_magic(args.file)
         if zodb_magic != ZODB.FileStorage.packed_version:
             raise SystemExit(
-                'You cannot use --dry-run under Python 3 with a ZODB '
-                'created under Python 2 as --dry-run does not rewrite the '
+                'You cannot use --dry-run or --analyze under Python 3 with '
+                'a ZODB created under Python 2 as they do not rewrite the '
                 'magic header data before opening the ZODB file.')
 
-    if args.file:
-        storage = ZODB.FileStorage.FileStorage(args.file)
-    elif args.config:
-        with open(args.config) as config:
-            storage = ZODB.config.storageFromFile(config)
-    else:
-        raise AssertionError(
-            'Exactly one of --file or --config must be given.')
-
-    updater = create_updater(
-        storage,
-        start_at=args.oid,
-        convert_py3=args.convert_py3,
-        encoding=args.encoding,
-        encoding_fallbacks=args.encoding_fallbacks,
-        dry_run=args.dry_run,
-        debug=args.debug)
+    storage = output = None
+    unreachable = None
     try:
-        updater()
-    except Exception as error:
-        logging.info('An error occured', exc_info=True)
-        logging.error(f'Stopped processing, due to: {error}')
-        raise AssertionError()
-
-    implicit_renames = format_renames(
-        updater.processor.get_rules(implicit=True))
-    if implicit_renames:
-        logger.info(f'Found new rules: {implicit_renames}')
-    if args.save_renames:
-        logger.info(f'Saving rules into {args.save_renames}')
-        with open(args.save_renames, 'w') as output:
-            output.write('renames = {}'.format(
-                format_renames(updater.processor.get_rules(
-                    implicit=True, explicit=True))))
-    if args.pack:
-        logger.info('Packing storage ...')
-        storage.pack(time.time(), ZODB.serialize.referencesf)
-    storage.close()
+        if args.file:
+            # When copying, the source is not modified.
+            storage = ZODB.FileStorage.FileStorage(
+                args.file, read_only=bool(copy))
+        elif args.config:
+            with open(args.config) as config:
+                storage = ZODB.config.storageFromFile(config)
+        else:
+            raise AssertionError(
+                'Exactly one of --file or --config must be given.')
+
+        if args.output_file:
+            output = ZODB.FileStorage.FileStorage(args.output_file)
+        elif args.output_config:
+            with open(args.output_config) as config:
+                output = ZODB.config.storageFromFile(config)
+        if (output is not None and not (args.resume or since) and
+                output.lastTransaction() != ZODB.utils.z64):
+            raise SystemExit(
+                'The output storage already contains transactions, use a '
+                'new one (or --resume to continue copying to it).')
+
+        stats = None
+        if args.stats_json:
+            stats = zodbupdate.stats.Stats()
+        profiler = None
+        if args.profile:
+            profiler = zodbupdate.profiling.Profiler(args.profile)
+        oids = None
+        if args.oids_from:
+            oids = zodbupdate.oids.load(args.oids_from)
+            logger.info(f'Loaded {len(oids)} OIDs from {args.oids_from}')
+        elif args.since_tid or args.since_checkpoint:
+            if args.since_tid:
+                tid = ZODB.utils.repr_to_oid(args.since_tid)
+            else:
+                tid = zodbupdate.checkpoint.Checkpoint.load(
+                    args.since_checkpoint).tid
+                if tid is None:
+                    raise SystemExit(
+                        'The checkpoint {} has no transaction to start '
+                        'from.'.format(args.since_checkpoint))
+            oids = zodbupdate.oids.changed_since(storage, tid)
+        start_at, end_at = args.oid_range or (args.oid, None)
+        updater = create_updater(
+            storage,
+            start_at=start_at,
+            end_at=end_at,
+            convert_py3=args.convert_py3,
+            encoding=args.encoding,
+            encoding_fallbacks=args.encoding_fallbacks,
+            dry_run=args.dry_run,
+            debug=args.debug,
+            workers=args.workers,
+            checkpoint=args.checkpoint,
+            resume=args.resume,
+            transaction_records=args.transaction_records,
+            transaction_bytes=args.transaction_bytes,
+            commit_latency=args.commit_latency,
+            iteration=args.iteration,
+            stats=stats,
+            oids=oids,
+            online=args.online,
+            max_records_per_second=args.max_records_per_second,
+            max_commit_rate=args.max_commit_rate,
+            prefetch=args.prefetch,
+            output=output,
+            pack=bool(args.pack and args.output_file),
+            memory=memory,
+            profiler=profiler)
+        run = updater.analyze if analyze else updater
+        try:
+            if profiler is not None:
+                analysis = profiler.run('main', run)
+            else:
+                analysis = run()
+        except Exception as error:
+            logging.info('An error occured', exc_info=True)
+            logging.error(f'Stopped processing, due to: {error}')
+            raise AssertionError()
+
+        if args.collect_oids:
+            logger.info(
+                f'Saving {len(analysis.oids)} OIDs into {args.collect_oids}')
+            zodbupdate.oids.save(args.collect_oids, analysis.oids)
+        if args.analyze:
+            totals = analysis.totals()
+            logger.info(
+                '{} records ({} bytes) in {} classes, {} would be modified, '
+                '{} missing classes or symbols.'.format(
+                    totals['records'], totals['bytes'], len(analysis.classes),
+                    totals['changed'], len(analysis.missing)))
+            logger.info(f'Saving analysis into {args.analyze}')
+            analysis.save(args.analyze)
+
+        if stats is not None:
+            stats.report(force=True)
+            logger.info(f'Saving statistics into {args.stats_json}')
+            stats.save(args.stats_json)
+        if profiler is not None:
+            costs = profiler.costs.summary()
+            if costs:
+                logger.info(
+                    'Time spent per class:\n{}'.format('\n'.join(costs)))
+            logger.info(f'Saving profiles into {args.profile}')
+            profiler.save()
+        symbols = updater.processor.get_symbol_stats()
+        logger.debug(
+            'Symbol resolution cache: {} hits, {} misses, hottest: {}'.format(
+                sum(symbols['hits'].values()), symbols['misses'],
+                ', '.join(
+                    '{} ({})'.format(' '.join(symb_info), count)
+                    for symb_info, count in symbols['hits'].most_common(5))))
+        for symb_info, decoder_stats in sorted(
+                updater.processor.get_decoder_stats().items()):
+            if not decoder_stats['records']:
+                continue
+            logger.info(
+                'Decoded {} of {} records of {}: {}'.format(
+                    decoder_stats['changed'], decoder_stats['records'],
+                    ' '.join(symb_info), ', '.join(
+                        f'{attribute} ({count})'
+                        for attribute, count in sorted(
+                            decoder_stats['attributes'].items())) or '-'))
+            for (attribute, encoding), count in sorted(
+                    decoder_stats['fallbacks'].items()):
+                logger.warning(
+                    'Decoded {} values of attribute "{}" of {} with the '
+                    'fallback encoding "{}"'.format(
+                        count, attribute, ' '.join(symb_info), encoding))
+        warnings = zodbupdate.logs.aggregator.summary()
+        if warnings:
+            logger.warning('Warnings:\n{}'.format('\n'.join(warnings)))
+        implicit_renames = format_renames(
+            updater.processor.get_rules(implicit=True))
+        if implicit_renames:
+            logger.info(f'Found new rules: {implicit_renames}')
+        if args.save_renames:
+            logger.info(f'Saving rules into {args.save_renames}')
+            with open(args.save_renames, 'w') as rules:
+                rules.write('renames = {}'.format(
+                    format_renames(updater.processor.get_rules(
+                        implicit=True, explicit=True))))
+        if updater.references is not None:
+            # The references were collected while copying, no need to pack.
+            unreachable = updater.references.unreachable()
+        elif args.pack and not analyze:
+            logger.info('Packing storage ...')
+            updater.target.pack(time.time(), ZODB.serialize.referencesf)
+    finally:
+        if storage is not None:
+            storage.close()
+        if output is not None:
+            output.close()
+        if magic is not None and magic != ZODB.FileStorage.packed_version:
+            # Even if the copy failed, the source stays as it was.
+            zodbupdate.convert.update_magic_data_fs(args.file, magic)
+    if unreachable:
+        zodbupdate.pack.remove_records(args.output_file, unreachable)
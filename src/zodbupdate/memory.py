@@ -0,0 +1,172 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Keep an eye on the memory used by an update: commit early and drop
+caches when it gets close to a limit, and report what grows with
+tracemalloc.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+
+logger = logging.getLogger('zodbupdate')
+
+# Number of records between two measures of the memory used.
+CHECK_INTERVAL = 1000
+
+# Part of the limit from which the current transaction is committed
+# and caches are dropped.
+THRESHOLD = 0.9
+
+# Longest wait, in intervals, before trying again to relieve memory
+# when doing so didn't bring it back below the threshold.
+MAX_BACKOFF = 64
+
+# Number of source lines with the largest growth in a report.
+REPORT_LINES = 10
+
+_UNITS = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+def parse_size(value):
+    """Parse a size in bytes, with an optional K, M, G or T suffix.
+    """
+    value = value.strip().lower().rstrip('b')
+    factor = _UNITS.get(value[-1:], 1)
+    if factor != 1:
+        value = value[:-1]
+    return int(float(value) * factor)
+
+
+def current_memory():
+    """Return the resident memory of this process, in bytes. Where
+    it cannot be read, the peak resident memory is used instead.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes, except on macOS.
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemoryMonitor:
+    """Measure the memory used during an update.
+
+    With a limit (in bytes), ``check`` tells every ``interval`` records
+    if the memory used got close to it. Each time relieving memory
+    doesn't help, the wait before the next check is doubled, up to
+    ``MAX_BACKOFF`` intervals. With a report path, tracemalloc
+    is started and ``committed`` writes, after each commit, a JSON line
+    with the memory used, the size of the data structures given and
+    the source lines of zodbupdate which allocated the most since the
+    beginning.
+    """
+
+    def __init__(self, limit=None, report=None, interval=CHECK_INTERVAL,
+                 threshold=THRESHOLD):
+        self.limit = limit
+        self.report = report
+        self.interval = interval
+        self.threshold = threshold
+        self.countdown = interval
+        self.backoff = 1
+        self.warned = False
+        self.baseline = None
+        if report is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.baseline = self.__snapshot()
+            # Start with an empty report.
+            open(report, 'w').close()
+
+    def check(self):
+        """Return true if the memory used is close to the limit. The
+        memory is only measured every ``interval`` calls.
+        """
+        if self.limit is None:
+            return False
+        self.countdown -= 1
+        if self.countdown > 0:
+            return False
+        self.countdown = self.interval
+        if current_memory() < self.limit * self.threshold:
+            self.backoff = 1
+            return False
+        return True
+
+    def relieved(self):
+        """Call once caches were dropped, to warn if it wasn't enough
+        and wait longer before the next check.
+        """
+        used = current_memory()
+        if used < self.limit * self.threshold:
+            self.backoff = 1
+            return used
+        if not self.warned:
+            self.warned = True
+            logger.warning(
+                'Using {:.0f} MB of memory after dropping caches, the limit '
+                'is {:.0f} MB.'.format(used / 1e6, self.limit / 1e6))
+        # Dropping caches over and over would only slow the update down.
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        self.countdown = self.interval * self.backoff
+        return used
+
+    def __snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+
+    def committed(self, commit_count, structures):
+        """Write the memory report after a commit. ``structures`` are
+        the number of items of the data structures worth watching.
+        """
+        if self.report is None:
+            return
+        traced, peak = tracemalloc.get_traced_memory()
+        growth = self.__snapshot().compare_to(self.baseline, 'lineno')
+        package = os.path.dirname(__file__)
+        lines = []
+        for stat in growth:
+            frame = stat.traceback[0]
+            if not frame.filename.startswith(package):
+                continue
+            lines.append({
+                'file': os.path.relpath(frame.filename, package),
+                'line': frame.lineno,
+                'size': stat.size,
+                'size_diff': stat.size_diff,
+                'count_diff': stat.count_diff,
+            })
+            if len(lines) >= REPORT_LINES:
+                break
+        with open(self.report, 'a') as output:
+            json.dump({
+                'commit': commit_count,
+                'time': time.time(),
+                'memory': current_memory(),
+                'traced': traced,
+                'traced_peak': peak,
+                'structures': structures,
+                'growth': lines,
+            }, output, sort_keys=True)
+            output.write('\n')
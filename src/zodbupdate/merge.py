@@ -0,0 +1,173 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Merge the results of updates run with ``--oid-range`` on different
+ranges of OIDs of the same database: the rules saved with
+``--save-renames``, the statistics saved with ``--stats-json`` and the
+checkpoints.
+"""
+
+import argparse
+import ast
+import json
+import logging
+
+import ZODB.utils
+
+import zodbupdate.checkpoint
+import zodbupdate.main
+import zodbupdate.stats
+
+
+logger = logging.getLogger('zodbupdate')
+
+parser = argparse.ArgumentParser(
+    description=("Merge the rules, statistics and checkpoints of updates "
+                 "run on different ranges of OIDs."))
+parser.add_argument(
+    "--renames", nargs="+", metavar="FILE", default=[],
+    help="rules saved by each update with --save-renames")
+parser.add_argument(
+    "-s", "--save-renames",
+    help="save the merged rules to this file")
+parser.add_argument(
+    "--stats", nargs="+", metavar="FILE", default=[],
+    help="statistics saved by each update with --stats-json")
+parser.add_argument(
+    "--stats-json",
+    help="save the merged statistics to this file")
+parser.add_argument(
+    "--checkpoints", nargs="+", metavar="FILE", default=[],
+    help="checkpoints saved by each update with --checkpoint")
+parser.add_argument(
+    "--checkpoint",
+    help=("save the merged checkpoint to this file, to catch up later "
+          "with --since-checkpoint"))
+
+
+def load_renames(path):
+    """Read rules saved with --save-renames.
+    """
+    with open(path) as stream:
+        content = stream.read()
+    name, separator, value = content.partition('=')
+    if name.strip() != 'renames' or not separator:
+        raise SystemExit(f'{path} does not contain rules.')
+    if not value.strip():
+        # No rules were found.
+        return {}
+    return {
+        tuple(old.split(' ')): tuple(new.split(' '))
+        for old, new in ast.literal_eval(value.strip()).items()}
+
+
+def merge_renames(all_renames):
+    """Merge rules, refusing rules renaming the same class
+    differently.
+    """
+    merged = {}
+    conflicts = set()
+    for renames in all_renames:
+        for old, new in renames.items():
+            if merged.setdefault(old, new) != new:
+                conflicts.add(old)
+    if conflicts:
+        raise SystemExit('Different rules for {}'.format(
+            ', '.join(sorted(' '.join(old) for old in conflicts))))
+    return merged
+
+
+def check_ranges(checkpoints):
+    """Make sure the ranges of OIDs of the checkpoints don't overlap,
+    and warn about the OIDs covered by none of them.
+    """
+    def bounds(checkpoint):
+        first = ZODB.utils.u64(ZODB.utils.repr_to_oid(checkpoint.first_oid))
+        if checkpoint.end_oid is None:
+            return first, None
+        return first, ZODB.utils.u64(
+            ZODB.utils.repr_to_oid(checkpoint.end_oid))
+
+    ranges = sorted(bounds(checkpoint) for checkpoint in checkpoints)
+    if ranges[0][0]:
+        logger.warning(
+            'No update started at the first OID, records before '
+            '{} were not updated.'.format(ZODB.utils.oid_repr(
+                ZODB.utils.p64(ranges[0][0]))))
+    for (first, end), (next_first, next_end) in zip(ranges, ranges[1:]):
+        if end is None or end > next_first:
+            raise SystemExit(
+                'The ranges of OIDs starting at {} and {} overlap.'.format(
+                    ZODB.utils.oid_repr(ZODB.utils.p64(first)),
+                    ZODB.utils.oid_repr(ZODB.utils.p64(next_first))))
+        if end < next_first:
+            logger.warning(
+                'Records from {} to {} were not updated.'.format(
+                    ZODB.utils.oid_repr(ZODB.utils.p64(end)),
+                    ZODB.utils.oid_repr(ZODB.utils.p64(next_first))))
+    if ranges[-1][1] is not None:
+        logger.warning(
+            'No update went to the last OID, records from {} were not '
+            'updated.'.format(ZODB.utils.oid_repr(
+                ZODB.utils.p64(ranges[-1][1]))))
+
+
+def main():
+    args = parser.parse_args()
+    zodbupdate.main.setup_logger()
+    if not (args.renames or args.stats or args.checkpoints):
+        parser.error('nothing to merge')
+
+    if args.checkpoints:
+        checkpoints = [
+            zodbupdate.checkpoint.Checkpoint.load(path)
+            for path in args.checkpoints]
+        check_ranges(checkpoints)
+        merge_renames(checkpoint.rules for checkpoint in checkpoints)
+        checkpoint = zodbupdate.checkpoint.Checkpoint.combine(checkpoints)
+        logger.info(
+            '{} records processed, {} updated in {} transactions.'.format(
+                checkpoint.counts['processed'], checkpoint.counts['updated'],
+                checkpoint.counts['commits']))
+        if not checkpoint.finished:
+            logger.warning(
+                'Some of the updates are not finished, resuming from the '
+                'merged checkpoint starts again at {}.'.format(
+                    checkpoint.start_at))
+        if args.checkpoint:
+            logger.info(f'Saving checkpoint into {args.checkpoint}')
+            checkpoint.save(args.checkpoint)
+
+    if args.stats:
+        results = []
+        for path in args.stats:
+            with open(path) as stream:
+                results.append(json.load(stream))
+        stats = zodbupdate.stats.combine(results)
+        logger.info(
+            '{} records processed ({:.0f} records/s).'.format(
+                stats['counts'].get('records', 0),
+                stats['records_per_second']))
+        if args.stats_json:
+            logger.info(f'Saving statistics into {args.stats_json}')
+            with open(args.stats_json, 'w') as output:
+                json.dump(stats, output, indent=2, sort_keys=True)
+
+    if args.renames:
+        renames = merge_renames(load_renames(path) for path in args.renames)
+        logger.info(f'{len(renames)} rules.')
+        if args.save_renames:
+            logger.info(f'Saving rules into {args.save_renames}')
+            with open(args.save_renames, 'w') as output:
+                output.write('renames = {}'.format(
+                    zodbupdate.main.format_renames(renames)))
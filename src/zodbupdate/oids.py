@@ -0,0 +1,95 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Files of OIDs: the 8 bytes OIDs, sorted, one after the other.
+"""
+
+import array
+import logging
+import sys
+
+import ZODB.utils
+from ZODB.interfaces import IStorageIteration
+
+import zodbupdate.update
+
+
+logger = logging.getLogger('zodbupdate')
+
+
+def _big_endian(oids):
+    """Convert OIDs to big endian and back, so the file contains them
+    as the storage does.
+    """
+    if sys.byteorder == 'little':
+        oids.byteswap()
+
+
+def parse_range(value):
+    """Parse a range of OIDs given as ``START:END`` in hex format,
+    START being included and END excluded. Either can be left out.
+    Return them in hex format, with None for a missing END.
+    """
+    start, separator, end = value.partition(':')
+    if not separator:
+        raise ValueError(value)
+    first = ZODB.utils.repr_to_oid(start or '0x00')
+    if not end:
+        return ZODB.utils.oid_repr(first), None
+    last = ZODB.utils.repr_to_oid(end)
+    if last <= first:
+        raise ValueError(value)
+    return ZODB.utils.oid_repr(first), ZODB.utils.oid_repr(last)
+
+
+def save(path, oids):
+    """Save the given OIDs (as integers) sorted in a file.
+    """
+    oids = array.array('Q', sorted(set(oids)))
+    _big_endian(oids)
+    with open(path, 'wb') as output:
+        oids.tofile(output)
+
+
+def load(path):
+    """Return the OIDs saved in a file, as a sorted array of integers.
+    """
+    oids = array.array('Q')
+    with open(path, 'rb') as stream:
+        oids.frombytes(stream.read())
+    _big_endian(oids)
+    return oids
+
+
+def changed_since(storage, tid):
+    """Return the OIDs of the records modified by the transactions
+    committed after the given one, as a sorted array of integers.
+    Transactions committed by zodbupdate itself are ignored.
+    """
+    if not IStorageIteration.providedBy(storage):
+        raise SystemExit(
+            "Don't know how to iterate through the transactions of this "
+            "storage type")
+    note = zodbupdate.update.TRANSACTION_NOTE.encode('utf-8')
+    start = ZODB.utils.p64(ZODB.utils.u64(tid) + 1)
+    oids = set()
+    transactions = 0
+    for transaction_ in storage.iterator(start):
+        if note in transaction_.description:
+            continue
+        transactions += 1
+        oids.update(ZODB.utils.u64(record.oid) for record in transaction_)
+    logger.info(
+        'Found {} records modified by {} transactions after {}'.format(
+            len(oids), transactions, ZODB.utils.tid_repr(tid)))
+    return array.array('Q', sorted(oids))
@@ -0,0 +1,635 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Find the symbols referenced by a ZODB record by walking the opcodes
+of its pickles, without unpickling them.
+
+A ZODB record references symbols (classes, functions, interfaces):
+
+- with GLOBAL, INST and STACK_GLOBAL opcodes, those are the symbols
+  the unpickler would give to ``find_class``,
+
+- with (module, name) string tuples used as class information, in the
+  class pickle or in persistent references, for records written by old
+  versions of ZODB.
+
+To recognize the second case the opcodes are run on a small abstract
+stack, which only keeps track of strings, tuples and lists.
+
+Walking opcodes with ``pickletools`` is slower than unpickling with the
+C unpickler, so ``quick_scan_record`` avoids it. Most class pickles
+are a GLOBAL opcode, matched with a regular expression. In the state
+pickle it looks for anything that could be a GLOBAL opcode, an opcode
+followed by two lines: that can find symbols that aren't there, but
+never misses one. When these candidates matter, ``scan_state`` finds
+the GLOBAL opcodes of the state exactly, only skipping over the
+arguments of the other opcodes.
+"""
+
+import copyreg
+import io
+import pickletools
+import re
+import struct
+
+
+STRING_OPCODES = frozenset([
+    'STRING', 'BINSTRING', 'SHORT_BINSTRING',
+    'UNICODE', 'BINUNICODE', 'SHORT_BINUNICODE', 'BINUNICODE8'])
+GET_OPCODES = frozenset(['GET', 'BINGET', 'LONG_BINGET'])
+PUT_OPCODES = frozenset(['PUT', 'BINPUT', 'LONG_BINPUT'])
+EXTENSION_OPCODES = frozenset(['EXT1', 'EXT2', 'EXT4'])
+
+# Two tuples built in a row, right before a persistent reference: this
+# is how old versions of ZODB stored references with a (module, name)
+# class information, (oid, (module, name)).
+OLD_REFERENCE_PATTERN = re.compile(
+    rb'[\x86t](?:q.|r.{4}|p\d+\n)?[\x86t](?:q.|r.{4}|p\d+\n)?\Z', re.DOTALL)
+
+# The class pickle of most records: the class loaded with GLOBAL,
+# possibly in a tuple with None, as older versions of ZODB wrote it.
+CLASS_PICKLE_PATTERN = re.compile(
+    rb'(?:\x80[\x02\x03])?c([^\n]*)\n([^\n]*)\n(?:q.|p\d+\n)?'
+    rb'(?:N\x86(?:q.|p\d+\n)?)?\.', re.DOTALL)
+
+_MARK = object()
+
+# How to skip over each opcode, by opcode: its size if it is fixed,
+# minus the size of the length of its argument if the length comes
+# first, or 0 for the others: STOP, the opcodes whose argument is a
+# line and GLOBAL and INST, whose argument is two lines.
+_STEPS = [0] * 256
+_LINES = set()
+_SYMBOLS = {}
+
+
+def _fill_steps():
+    lengths = {
+        pickletools.TAKEN_FROM_ARGUMENT1: 1,
+        pickletools.TAKEN_FROM_ARGUMENT4: 4,
+        pickletools.TAKEN_FROM_ARGUMENT4U: 4,
+        pickletools.TAKEN_FROM_ARGUMENT8U: 8}
+    for opcode in pickletools.opcodes:
+        code = ord(opcode.code)
+        if opcode.name in ('GLOBAL', 'INST'):
+            _SYMBOLS[code] = opcode.name
+        elif opcode.name in ('STOP', 'FRAME'):
+            # Frames would need to be fixed if a record is rewritten.
+            continue
+        elif opcode.arg is None:
+            _STEPS[code] = 1
+        elif opcode.arg.n >= 0:
+            _STEPS[code] = 1 + opcode.arg.n
+        elif opcode.arg.n == pickletools.UP_TO_NEWLINE:
+            _LINES.add(code)
+        else:
+            _STEPS[code] = -lengths[opcode.arg.n]
+
+
+_fill_steps()
+_STOP = ord(b'.')
+
+
+class String:
+    """A string pushed on the stack, remembering the position of the
+    opcode that pushed it, and how many times it was fetched again
+    from the memo.
+    """
+
+    __slots__ = ('value', 'position', 'gets')
+
+    def __init__(self, value, position):
+        self.value = value
+        self.position = position
+        self.gets = 0
+
+
+class Global:
+    """A symbol pushed on the stack.
+    """
+
+    __slots__ = ('symb',)
+
+    def __init__(self, symb):
+        self.symb = symb
+
+
+class List(list):
+    """A list built on the stack.
+    """
+
+
+class Reference:
+    """A symbol referenced by a record.
+
+    ``opcode`` is the name of the opcode that loads it (GLOBAL, INST,
+    STACK_GLOBAL, EXT1, ...) or None for a (module, name) string
+    tuple. ``position`` is the position of that opcode (of the module
+    string for a string tuple) and ``strings`` the module and name
+    strings used by a STACK_GLOBAL or a string tuple.
+    """
+
+    __slots__ = ('symb', 'opcode', 'position', 'strings')
+
+    def __init__(self, symb, opcode=None, position=None, strings=()):
+        self.symb = symb
+        self.opcode = opcode
+        self.position = position
+        self.strings = strings
+
+
+class RecordScan:
+    """The result of scanning a ZODB record.
+
+    ``certain`` is False if the scan cannot tell for sure which
+    symbols are referenced, in which case the record must be
+    unpickled. ``klass`` is the class of the record, if it could be
+    found. ``state_start`` is the position of the state pickle.
+    ``candidates`` are the symbols found in the state pickle if it was
+    not scanned exactly.
+    """
+
+    def __init__(self):
+        self.references = []
+        self.symbols = set()
+        self.certain = True
+        self.klass = None
+        self.frames = False
+        self.state_start = None
+        self.candidates = None
+
+    def add(self, reference):
+        self.references.append(reference)
+        self.symbols.add(reference.symb)
+
+
+def _string_pair(item):
+    if (isinstance(item, tuple) and len(item) == 2 and
+            isinstance(item[0], String) and isinstance(item[1], String)):
+        return item
+    return None
+
+
+def _symbol(item):
+    """Return the symbol described by a stack item, or None.
+    """
+    if isinstance(item, Global):
+        return item.symb
+    strings = _string_pair(item)
+    if strings is not None:
+        return (strings[0].value, strings[1].value)
+    return None
+
+
+class _Scanner:
+
+    def __init__(self, result):
+        self.result = result
+        self.stack = []
+        self.memo = {}
+
+    def reference_strings(self, item):
+        strings = _string_pair(item)
+        if strings is not None:
+            self.result.add(Reference(
+                (strings[0].value, strings[1].value),
+                position=strings[0].position, strings=strings))
+        elif isinstance(item, tuple):
+            # Something __update_symb would be called with, but that we
+            # cannot make sense of.
+            self.result.certain = False
+
+    def persistent_id(self, pid):
+        # (oid, class_info) or ['m', (database_name, oid, class_info)]
+        class_info = None
+        if isinstance(pid, tuple) and len(pid) == 2:
+            class_info = pid[1]
+        elif (isinstance(pid, List) and len(pid) == 2 and
+              isinstance(pid[0], String) and pid[0].value == 'm' and
+              isinstance(pid[1], tuple) and len(pid[1]) == 3):
+            class_info = pid[1][2]
+        if class_info is not None and not isinstance(class_info, Global):
+            self.reference_strings(class_info)
+
+    def class_meta(self, class_meta):
+        # class or (class, args) where class can be a string tuple.
+        if isinstance(class_meta, Global):
+            self.result.klass = class_meta.symb
+        elif isinstance(class_meta, tuple) and len(class_meta) == 2:
+            symb, args = class_meta
+            if not isinstance(symb, Global):
+                self.reference_strings(symb)
+            self.result.klass = _symbol(symb)
+
+    def pop_mark(self):
+        stack = self.stack
+        index = len(stack) - 1
+        while index >= 0 and stack[index] is not _MARK:
+            index -= 1
+        if index < 0:
+            raise ValueError('No mark on the stack')
+        items = stack[index + 1:]
+        del stack[index:]
+        return items
+
+    def run(self, input_file, is_class_meta):
+        stack = self.stack
+        memo = self.memo
+        result = self.result
+        for opcode, arg, position in pickletools.genops(input_file):
+            name = opcode.name
+            if name in STRING_OPCODES:
+                if isinstance(arg, bytes):
+                    arg = arg.decode('latin-1')
+                stack.append(String(arg, position))
+            elif name in PUT_OPCODES:
+                memo[arg] = stack[-1]
+            elif name == 'MEMOIZE':
+                memo[len(memo)] = stack[-1]
+            elif name in GET_OPCODES:
+                item = memo.get(arg)
+                if isinstance(item, String):
+                    item.gets += 1
+                stack.append(item)
+            elif name == 'MARK':
+                stack.append(_MARK)
+            elif name == 'TUPLE':
+                stack.append(tuple(self.pop_mark()))
+            elif name in ('TUPLE1', 'TUPLE2', 'TUPLE3'):
+                size = int(name[-1])
+                items = tuple(stack[-size:])
+                del stack[-size:]
+                stack.append(items)
+            elif name == 'EMPTY_TUPLE':
+                stack.append(())
+            elif name == 'EMPTY_LIST':
+                stack.append(List())
+            elif name == 'LIST':
+                stack.append(List(self.pop_mark()))
+            elif name == 'APPEND':
+                item = stack.pop()
+                if isinstance(stack[-1], List):
+                    stack[-1].append(item)
+            elif name == 'APPENDS':
+                items = self.pop_mark()
+                if isinstance(stack[-1], List):
+                    stack[-1].extend(items)
+            elif name in ('GLOBAL', 'INST'):
+                symb = tuple(arg.split(' ', 1))
+                result.add(Reference(symb, opcode=name, position=position))
+                if name == 'INST':
+                    self.pop_mark()
+                    stack.append(None)
+                else:
+                    stack.append(Global(symb))
+            elif name == 'STACK_GLOBAL':
+                module, name_ = stack[-2:]
+                del stack[-2:]
+                if isinstance(module, String) and isinstance(name_, String):
+                    symb = (module.value, name_.value)
+                    result.add(Reference(
+                        symb, opcode=name, position=position,
+                        strings=(module, name_)))
+                    stack.append(Global(symb))
+                else:
+                    result.certain = False
+                    stack.append(None)
+            elif name in EXTENSION_OPCODES:
+                symb = copyreg._inverted_registry.get(arg)
+                if symb is None:
+                    result.certain = False
+                    stack.append(None)
+                else:
+                    result.add(
+                        Reference(symb, opcode=name, position=position))
+                    stack.append(Global(symb))
+            elif name == 'BINPERSID':
+                self.persistent_id(stack.pop())
+                stack.append(None)
+            elif name == 'DUP':
+                stack.append(stack[-1])
+            elif name == 'STOP':
+                item = stack.pop()
+                if is_class_meta:
+                    self.class_meta(item)
+                return
+            else:
+                if name == 'FRAME':
+                    result.frames = True
+                before = opcode.stack_before
+                if pickletools.markobject in before:
+                    self.pop_mark()
+                    count = before.index(pickletools.markobject)
+                else:
+                    count = len(before)
+                if count:
+                    del stack[-count:]
+                stack.extend([None] * len(opcode.stack_after))
+
+
+def scan_record(input_file):
+    """Scan the class pickle and the state pickle of a record, given
+    as a file object or as bytes.
+    """
+    if not hasattr(input_file, 'read'):
+        input_file = io.BytesIO(input_file)
+    result = RecordScan()
+    scanner = _Scanner(result)
+    try:
+        scanner.run(input_file, True)
+        result.state_start = input_file.tell()
+        scanner.run(input_file, False)
+    except (ValueError, IndexError):
+        # Not something we understand, let the unpickler deal with it.
+        result.certain = False
+    return result
+
+
+def _symbol_lines(module, name):
+    """Return the symbol loaded by a GLOBAL opcode with the given
+    lines, as pickletools reads it. Raise ValueError for lines it
+    would unescape.
+    """
+    if b'\\' in module or b'\\' in name:
+        raise ValueError('Escaped symbol')
+    return tuple('{} {}'.format(
+        module.decode('ascii'), name.decode('ascii')).split(' ', 1))
+
+
+def _scan_class(data, result, classes):
+    """Find the class of a record whose class pickle is a GLOBAL
+    opcode, remembering it in classes by class pickle. Return the
+    position of the state pickle, or None if the class pickle needs to
+    be walked.
+    """
+    match = CLASS_PICKLE_PATTERN.match(data)
+    if match is None:
+        return None
+    header = match.group()
+    known = classes.get(header) if classes is not None else None
+    if known is None:
+        try:
+            symb = _symbol_lines(match.group(1), match.group(2))
+        except ValueError:
+            return None
+        known = Reference(symb, opcode='GLOBAL', position=match.start(1) - 1)
+        if classes is not None:
+            classes[header] = known
+    result.klass = known.symb
+    result.add(known)
+    return match.end()
+
+
+def _state_references(data, position):
+    """Return the symbols loaded by the GLOBAL and INST opcodes of
+    the pickle starting at the given position. Raise ValueError (or
+    IndexError) for a pickle that cannot be read that way.
+    """
+    references = []
+    steps = _STEPS
+    find = data.find
+    while True:
+        code = data[position]
+        step = steps[code]
+        if step > 0:
+            position += step
+        elif step == -1:
+            position += 2 + data[position + 1]
+        elif step:
+            start = position + 1 - step
+            position = start + int.from_bytes(
+                data[position + 1:start], 'little')
+        elif code == _STOP:
+            return references
+        elif code in _SYMBOLS:
+            module_end = find(b'\n', position)
+            end = find(b'\n', module_end + 1)
+            if module_end == -1 or end == -1:
+                raise ValueError('No newline found')
+            references.append(Reference(
+                _symbol_lines(
+                    data[position + 1:module_end],
+                    data[module_end + 1:end]),
+                opcode=_SYMBOLS[code], position=position))
+            position = end + 1
+        elif code in _LINES:
+            end = find(b'\n', position)
+            if end == -1:
+                raise ValueError('No newline found')
+            position = end + 1
+        else:
+            raise ValueError(f'Unsupported opcode {code}')
+
+
+def scan_state(data, result):
+    """Complete the scan of a record by quick_scan_record, finding
+    exactly which symbols its state pickle references instead of the
+    candidates. Return the new scan.
+    """
+    if result.candidates is None:
+        return result
+    try:
+        references = _state_references(data, result.state_start)
+    except (ValueError, IndexError):
+        # Let pickletools tell.
+        return scan_record(data)
+    scan = RecordScan()
+    scan.klass = result.klass
+    scan.state_start = result.state_start
+    for reference in result.references + references:
+        scan.add(reference)
+    return scan
+
+
+def _has_old_references(state):
+    position = state.find(b'Q')
+    while position != -1:
+        if OLD_REFERENCE_PATTERN.search(
+                state, max(0, position - 32), position) is not None:
+            return True
+        position = state.find(b'Q', position + 1)
+    return False
+
+
+def _global_candidates(state):
+    """Find everything that looks like a GLOBAL (or INST) opcode: a
+    'c' (or 'i') followed by two lines without any whitespace.
+    Newlines are rare in binary pickles, so we work on lines rather
+    than bytes.
+    """
+    lines = state.split(b'\n')
+    # The last line is not followed by a newline.
+    last = len(lines) - 1
+    index = 0
+    while index + 1 < last:
+        line = lines[index]
+        name = lines[index + 1]
+        if line and not line[-1:].isspace() and name.split() == [name]:
+            run = line.rsplit(None, 1)[-1]
+            starts = [
+                start for start in (run.find(b'c'), run.find(b'i'))
+                if start != -1 and start + 1 < len(run)]
+            if starts:
+                yield run[min(starts) + 1:], name
+                index += 2
+                continue
+        index += 1
+
+
+def quick_scan_record(data, classes=None):
+    """Find the symbols a record, given as bytes, references. The
+    class pickle is scanned exactly. The symbols found in the state
+    pickle are a superset of the symbols it really references, unless
+    it needs an exact scan as well.
+
+    classes is a dictionary where the classes found are remembered by
+    class pickle, so the same class pickle is only read once.
+    """
+    result = RecordScan()
+    state_start = _scan_class(data, result, classes)
+    if state_start is None:
+        # Something else than a class, walk the opcodes.
+        result = RecordScan()
+        scanner = _Scanner(result)
+        input_file = io.BytesIO(data)
+    else:
+        scanner = None
+    try:
+        if scanner is not None:
+            scanner.run(input_file, True)
+            state_start = input_file.tell()
+        result.state_start = state_start
+        state = data[state_start:]
+        if (copyreg._inverted_registry or
+                (state[:1] == b'\x80' and state[1:2] >= b'\x04') or
+                _has_old_references(state)):
+            # Extensions, STACK_GLOBAL or old references, we need to
+            # look closer.
+            if scanner is None:
+                return scan_record(data)
+            scanner.run(input_file, False)
+            return result
+    except (ValueError, IndexError):
+        result.certain = False
+        return result
+    result.candidates = set()
+    for module, name in _global_candidates(state):
+        try:
+            result.candidates.add(
+                (module.decode('utf-8'), name.decode('utf-8')))
+        except UnicodeDecodeError:
+            continue
+    result.symbols.update(result.candidates)
+    return result
+
+
+class RewriteError(Exception):
+    """A record cannot be rewritten without unpickling it.
+    """
+
+
+def _string_end(data, position):
+    """Return the end of the string opcode at the given position.
+    """
+    code = data[position:position + 1]
+    if code in (b'U', b'\x8c'):
+        return position + 2 + data[position + 1]
+    if code in (b'T', b'X'):
+        size, = struct.unpack_from('<I', data, position + 1)
+        return position + 5 + size
+    if code == b'\x8d':
+        size, = struct.unpack_from('<Q', data, position + 1)
+        return position + 9 + size
+    return data.index(b'\n', position) + 1
+
+
+def _encode_string(code, value):
+    """Encode a string opcode of the same kind as the given one,
+    adjusting its length prefix (and opcode if it doesn't fit anymore).
+    """
+    if code in (b'U', b'T'):
+        raw = value.encode('latin-1')
+        if code == b'U' and len(raw) < 256:
+            return b'U' + bytes([len(raw)]) + raw
+        return b'T' + struct.pack('<I', len(raw)) + raw
+    if code in (b'\x8c', b'X', b'\x8d'):
+        raw = value.encode('utf-8')
+        if code == b'\x8c' and len(raw) < 256:
+            return b'\x8c' + bytes([len(raw)]) + raw
+        if code == b'\x8d':
+            return b'\x8d' + struct.pack('<Q', len(raw)) + raw
+        return b'X' + struct.pack('<I', len(raw)) + raw
+    if code == b'S':
+        return b"S'" + value.encode('ascii') + b"'\n"
+    return b'V' + value.encode('raw-unicode-escape') + b'\n'
+
+
+class Rewriter:
+    """Rename symbols directly in the opcodes of a record, leaving
+    everything else untouched.
+    """
+
+    def __init__(self, data, scan):
+        if not scan.certain or scan.frames:
+            # We would need to fix the frame sizes as well.
+            raise RewriteError('Cannot rewrite this record')
+        self.data = data
+        self.edits = {}
+        self.strings = {}
+        self.pairs = {}
+
+    def rename(self, reference, symb):
+        if reference.opcode in ('GLOBAL', 'INST'):
+            end = self.data.index(b'\n', self.data.index(
+                b'\n', reference.position) + 1) + 1
+            self.edits[reference.position] = (end, b''.join((
+                self.data[reference.position:reference.position + 1],
+                symb[0].encode('utf-8'), b'\n',
+                symb[1].encode('utf-8'), b'\n')))
+        elif reference.strings:
+            for string, value in zip(reference.strings, symb):
+                self.pairs.setdefault(string, set()).add(
+                    id(reference.strings))
+                if string.value == value:
+                    continue
+                if self.strings.setdefault(string, value) != value:
+                    raise RewriteError(
+                        'String used for different symbols')
+        else:
+            raise RewriteError(
+                f'Cannot rewrite a {reference.opcode} opcode')
+
+    def apply(self):
+        for string, value in self.strings.items():
+            # Every time the string is used must be for a symbol we
+            # rename, or we would modify other data too.
+            if len(self.pairs[string]) != string.gets + 1:
+                raise RewriteError('String used for other data')
+            code = self.data[string.position:string.position + 1]
+            try:
+                encoded = _encode_string(code, value)
+            except UnicodeEncodeError:
+                raise RewriteError('Cannot encode string')
+            self.edits[string.position] = (
+                _string_end(self.data, string.position), encoded)
+        # Slice a view of the record, so it is only copied once, by join.
+        data = memoryview(self.data)
+        parts = []
+        position = 0
+        for start in sorted(self.edits):
+            end, encoded = self.edits[start]
+            parts.append(data[position:start])
+            parts.append(encoded)
+            position = end
+        parts.append(data[position:])
+        return b''.join(parts)
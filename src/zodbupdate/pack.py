@@ -0,0 +1,185 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Pack a copy of a database while it is written: the references of
+the records are collected as they are copied, and the records that
+cannot be reached from the root are found at the end. The copy is then
+written again without them.
+"""
+
+import array
+import bisect
+import heapq
+import logging
+import os
+import sys
+
+import ZODB.FileStorage
+import ZODB.serialize
+import ZODB.utils
+
+
+logger = logging.getLogger('zodbupdate')
+
+# OID of the root object, from where records are reachable.
+ROOT = 0
+
+# Number of records sorted at once when they were not added in OID
+# order. The sorted chunks are then merged.
+SORT_CHUNK = 1 << 16
+
+
+def _sorted_keys(oids, bits):
+    """Return, as a sorted array, the OIDs shifted by the given
+    number of bits and combined with the index of their record. Only
+    a chunk of them at a time is sorted as a list.
+    """
+    count = len(oids)
+    chunks = [
+        array.array('Q', sorted(
+            (oids[index] << bits) | index
+            for index in range(start, min(start + SORT_CHUNK, count))))
+        for start in range(0, count, SORT_CHUNK)]
+    if len(chunks) == 1:
+        return chunks[0]
+    return array.array('Q', heapq.merge(*chunks))
+
+
+class References:
+    """The OIDs referenced by each record copied, as integers.
+
+    They are kept in flat arrays rather than in an object per record:
+    a record costs 16 bytes, plus 8 bytes per reference.
+    """
+
+    def __init__(self):
+        # OID of each record in the order they were added, where its
+        # references start in targets, and all the references.
+        self.oids = array.array('Q')
+        self.starts = array.array('Q')
+        self.targets = array.array('Q')
+
+    def __len__(self):
+        return len(self.oids)
+
+    def add(self, oid, data):
+        """Collect the references of a record, given as bytes.
+        """
+        references = array.array(
+            'Q', b''.join(ZODB.serialize.referencesf(data)))
+        if sys.byteorder == 'little':
+            references.byteswap()
+        self.oids.append(ZODB.utils.u64(oid))
+        self.starts.append(len(self.targets))
+        self.targets.extend(references)
+
+    def __positions(self):
+        """Return a function giving the position of a record from its
+        OID, or None if it was not copied. Records are usually added
+        in OID order, otherwise their OIDs are sorted first along with
+        their position, packed in one integer. Return None if they
+        don't fit in one.
+        """
+        oids = self.oids
+        if all(oids[index] < oids[index + 1]
+               for index in range(len(oids) - 1)):
+            def position(oid):
+                index = bisect.bisect_left(oids, oid)
+                if index == len(oids) or oids[index] != oid:
+                    return None
+                return index
+
+            return position
+
+        bits = max(len(oids) - 1, 1).bit_length()
+        if max(oids).bit_length() + bits > 64:
+            return None
+        keys = _sorted_keys(oids, bits)
+        mask = (1 << bits) - 1
+
+        def position(oid):
+            # The last one, if a record was copied twice.
+            index = bisect.bisect_right(keys, (oid << bits) | mask) - 1
+            if index < 0 or keys[index] >> bits != oid:
+                return None
+            return keys[index] & mask
+
+        return position
+
+    def unreachable(self, root=ROOT):
+        """Return the OIDs of the records that cannot be reached from
+        the root, as a set of integers.
+        """
+        position = self.__positions()
+        if position is None:
+            logger.warning(
+                'The OIDs of the records copied are too large to be '
+                'sorted, not packing.')
+            return set()
+        first = position(root)
+        if first is None:
+            # Not a complete database, we cannot tell.
+            logger.warning(
+                'The root object was not copied, not packing.')
+            return set()
+        starts = self.starts
+        targets = self.targets
+        count = len(self.oids)
+        seen = bytearray(count)
+        seen[first] = 1
+        pending = array.array('Q', [first])
+        while pending:
+            index = pending.pop()
+            end = starts[index + 1] if index + 1 < count else len(targets)
+            for oid in targets[starts[index]:end]:
+                other = position(oid)
+                if other is not None and not seen[other]:
+                    seen[other] = 1
+                    pending.append(other)
+        return {oid for oid in self.oids if not seen[position(oid)]}
+
+
+def remove_records(path, oids):
+    """Rewrite the FileStorage at the given path without the records
+    with the given OIDs (as integers), transaction by transaction.
+    The index is written along.
+    """
+    if not oids:
+        return
+    logger.info(f'Removing {len(oids)} unreachable records from {path}')
+    packed = path + '.pack'
+    source = ZODB.FileStorage.FileStorage(path, read_only=True)
+    destination = ZODB.FileStorage.FileStorage(packed, create=True)
+    try:
+        for transaction_ in source.iterator():
+            records = [
+                record for record in transaction_
+                if ZODB.utils.u64(record.oid) not in oids]
+            if not records:
+                continue
+            destination.tpc_begin(
+                transaction_, transaction_.tid, transaction_.status)
+            for record in records:
+                destination.restore(
+                    record.oid, record.tid, record.data, '', None,
+                    transaction_)
+            destination.tpc_vote(transaction_)
+            destination.tpc_finish(transaction_)
+    finally:
+        source.close()
+        destination.close()
+    for suffix in ('', '.index'):
+        os.replace(packed + suffix, path + suffix)
+    for suffix in ('.lock', '.tmp'):
+        if os.path.exists(packed + suffix):
+            os.remove(packed + suffix)
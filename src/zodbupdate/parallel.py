@@ -0,0 +1,161 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import collections
+import multiprocessing
+
+import zodbupdate.logs
+
+
+# Number of records sent to a worker at once. Since records are read
+# in OID order, each batch covers a contiguous range of OIDs.
+BATCH_SIZE = 1000
+
+# The ObjectRenamer used by a worker process. It is set in the parent
+# before the pool is forked, so workers inherit it (with its decoders,
+# which are closures and cannot be pickled).
+_processor = None
+
+# The zodbupdate.profiling.Profiler of the update, if any. Workers
+# save their own profile with it.
+_profiler = None
+
+
+def rename_records(processor, batch):
+    """Rename records, returning them as ``(oid, serial, new, None)``
+    where new is None if the record was not modified.
+    """
+    results = []
+    for oid, serial, data in batch:
+        results.append(
+            (oid, serial, processor.rename_record(data, oid), None))
+    return results
+
+
+def copy_records(processor, batch):
+    """Rename records, returning them as ``(oid, serial, new, data)``
+    where new is None if the record was not modified, and data is the
+    record as it was read in that case only (it is otherwise not sent
+    back).
+    """
+    results = []
+    for oid, serial, data in batch:
+        new = processor.rename_record(data, oid)
+        results.append((oid, serial, new, data if new is None else None))
+    return results
+
+
+def _start_worker():
+    if _profiler is not None:
+        _profiler.forked()
+
+
+def _run_batch(function, batch):
+    """Process a batch of records inside a worker process. Return the
+    results as well as the implicit rules found so far, the symbol
+    resolution and decoder statistics, the warnings, the timers and
+    the costs per class for this batch.
+    """
+    if _profiler is not None:
+        results = _profiler.run_worker(function, _processor, batch)
+    else:
+        results = function(_processor, batch)
+    return (
+        results,
+        _processor.get_rules(implicit=True),
+        _processor.get_symbol_stats(reset=True),
+        _processor.get_decoder_stats(reset=True),
+        zodbupdate.logs.aggregator.take(),
+        _processor.stats.take() if _processor.stats is not None else None,
+        _processor.costs.take() if _processor.costs is not None else None)
+
+
+def batches(records, size=BATCH_SIZE):
+    """Group records in lists of the given size, so they can be sent
+    to a worker.
+    """
+    batch = []
+    for oid, serial, data in records:
+        # Records might be given as views on a memory map.
+        batch.append((oid, serial, bytes(data)))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process(processor, records, workers, function,
+            batch_size=BATCH_SIZE, profiler=None):
+    """Process the given records using a pool of worker processes.
+
+    Records are read here and dispatched in batches to the workers,
+    which call function with the processor and each batch. The items
+    of the lists it returns are given back in the order the records
+    were read. Implicit rules found by the workers are merged back
+    into the given processor. With a profiler, each worker saves its
+    own profile.
+    """
+    global _processor, _profiler
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        raise SystemExit(
+            'Using multiple workers requires support for forking processes')
+    _processor = processor
+    _profiler = profiler
+    try:
+        with context.Pool(workers, initializer=_start_worker) as pool:
+            # Only keep a few batches in flight, so the storage is not
+            # read in memory faster than it can be written back.
+            pending = collections.deque()
+            for batch in batches(records, batch_size):
+                pending.append(
+                    pool.apply_async(_run_batch, (function, batch)))
+                if len(pending) >= workers * 2:
+                    yield from _collect(processor, pending.popleft())
+            while pending:
+                yield from _collect(processor, pending.popleft())
+            # Let the workers exit by themselves instead of terminating
+            # them, so they save their profile.
+            pool.close()
+            pool.join()
+    finally:
+        _processor = _profiler = None
+
+
+def rename(processor, records, workers, batch_size=BATCH_SIZE,
+           keep=False, profiler=None):
+    """Rename the given records using a pool of worker processes.
+    Results are given back as ``(oid, serial, new, data)`` where new
+    is None if the record was not modified. data is the record as it
+    was read if keep is true and it was not modified, None otherwise.
+    """
+    function = copy_records if keep else rename_records
+    return process(
+        processor, records, workers, function, batch_size, profiler)
+
+
+def _collect(processor, pending):
+    (results, rules, stats, decoder_stats, warnings, timers,
+     costs) = pending.get()
+    processor.merge_rules(rules)
+    processor.merge_symbol_stats(stats)
+    processor.merge_decoder_stats(decoder_stats)
+    zodbupdate.logs.aggregator.merge(warnings)
+    if timers is not None:
+        processor.stats.merge(timers)
+    if costs is not None:
+        processor.costs.merge(costs)
+    yield from results
@@ -0,0 +1,96 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Run the stages of an update (reading, renaming and writing records)
+in separate threads, so waiting on the storage overlaps with the work
+done on the records.
+"""
+
+import queue
+import threading
+
+
+# Number of items handed from a stage to the next one at once, to
+# limit the cost of synchronizing the threads.
+CHUNK_SIZE = 100
+
+# Seconds a stage waits for the next one before checking whether it
+# should stop.
+POLL_INTERVAL = 0.1
+
+_END = object()
+
+
+class _Failure:
+    """An error raised in a stage, given to the next one.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(items, size, chunk_size=CHUNK_SIZE):
+    """Iterate through items in a separate thread, keeping at most
+    about size items ready ahead of the consumer.
+
+    Errors raised while iterating are raised again to the consumer,
+    after the items that came before them. If the consumer stops
+    early, the thread stops as well.
+    """
+    chunk_size = max(min(chunk_size, size), 1)
+    chunks = queue.Queue(max(size // chunk_size, 1))
+    stop = threading.Event()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                chunks.put(value, timeout=POLL_INTERVAL)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def produce():
+        chunk = []
+        try:
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    if not put(chunk):
+                        return
+                    chunk = []
+        except BaseException as error:
+            if not chunk or put(chunk):
+                put(_Failure(error))
+        else:
+            if not chunk or put(chunk):
+                put(_END)
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(
+        target=produce, name='zodbupdate-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _END:
+                break
+            if isinstance(chunk, _Failure):
+                raise chunk.error
+            yield from chunk
+    finally:
+        stop.set()
+        thread.join()
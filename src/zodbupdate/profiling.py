@@ -0,0 +1,161 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Profile an update: save cProfile statistics for the main process
+and each worker, and tell which classes of records take the most time
+to unpickle, decode and repickle.
+"""
+
+import collections
+import cProfile
+import json
+import multiprocessing.util
+import os
+import time
+
+
+# Phases of the processing of a record timed per class.
+PHASES = ('unpickle', 'decode', 'repickle')
+
+# Name of the file with the time spent per class.
+CLASSES_FILE = 'classes.json'
+
+
+class ClassCosts:
+    """Wall time spent in each phase of the processing of records, per
+    class of record.
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.Counter()
+
+    def lap(self, class_name, phase, start):
+        """Account the time since start to the given class and phase.
+        Return the current time, to be used as start of the next one.
+        """
+        now = time.perf_counter()
+        key = (class_name, phase)
+        self.seconds[key] += now - start
+        self.calls[key] += 1
+        return now
+
+    def take(self):
+        """Return the timers and reset them. This is used to send
+        them from a worker process to the parent one.
+        """
+        costs = dict(self.seconds), dict(self.calls)
+        self.seconds.clear()
+        self.calls.clear()
+        return costs
+
+    def merge(self, costs):
+        seconds, calls = costs
+        for key, value in seconds.items():
+            self.seconds[key] += value
+        self.calls.update(calls)
+
+    def rows(self):
+        """Return a row per class, the most expensive first.
+        """
+        classes = {}
+        for (class_name, phase), seconds in self.seconds.items():
+            row = classes.get(class_name)
+            if row is None:
+                row = classes[class_name] = {
+                    'class': class_name, 'records': 0, 'seconds': 0.0}
+                row.update((name, 0.0) for name in PHASES)
+            row[phase] += seconds
+            row['seconds'] += seconds
+            if phase == PHASES[0]:
+                row['records'] += self.calls[class_name, phase]
+        return sorted(
+            classes.values(), key=lambda row: (-row['seconds'], row['class']))
+
+    def summary(self, limit=10):
+        """Return the lines of a table with the most expensive classes.
+        """
+        rows = self.rows()[:limit]
+        if not rows:
+            return []
+        width = max(len(row['class']) for row in rows + [{'class': 'class'}])
+        line = '{:<%d}  {:>10}' % width + '  {:>10}' * (len(PHASES) + 1)
+        lines = [line.format('class', 'records', *PHASES, 'seconds')]
+        for row in rows:
+            lines.append(line.format(row['class'], row['records'], *(
+                f'{row[name]:.3f}' for name in PHASES + ('seconds',))))
+        return lines
+
+    def save(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.rows(), output, indent=2)
+
+
+class Profiler:
+    """Run an update under cProfile, saving the statistics of each
+    process in the given directory (``main.pstats`` and
+    ``worker-<pid>.pstats``), and time records per class.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.costs = ClassCosts()
+        self.profiles = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, f'{name}.pstats')
+
+    def run(self, name, function, *args):
+        """Call function with the given arguments under the profile of
+        that name, and save the statistics of all the calls so far.
+        """
+        profile = self.profiles.get(name)
+        if profile is None:
+            profile = self.profiles[name] = cProfile.Profile()
+        try:
+            return self.__run(profile, function, args)
+        finally:
+            profile.dump_stats(self.path(name))
+
+    def run_worker(self, function, *args):
+        """Call function with the given arguments under the profile of
+        the current worker. Its statistics are only saved when the
+        worker exits.
+        """
+        name = f'worker-{os.getpid()}'
+        profile = self.profiles.get(name)
+        if profile is None:
+            profile = self.profiles[name] = cProfile.Profile()
+            multiprocessing.util.Finalize(
+                None, profile.dump_stats, args=(self.path(name),),
+                exitpriority=10)
+        return self.__run(profile, function, args)
+
+    def __run(self, profile, function, args):
+        profile.enable()
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+
+    def forked(self):
+        """Called in a worker process: stop the profiles inherited
+        from the parent process, they are saved by the parent.
+        """
+        for profile in self.profiles.values():
+            profile.disable()
+        self.profiles = {}
+
+    def save(self):
+        self.costs.save(os.path.join(self.directory, CLASSES_FILE))
@@ -12,11 +12,13 @@
 #
 ##############################################################################
 
+import collections
 import contextlib
 import importlib.util
 import io
 import logging
 import sys
+import time
 import types
 
 import zodbpickle
@@ -24,6 +26,9 @@ from ZODB.broken import Broken
 from ZODB.broken import find_global
 from ZODB.broken import rebuild
 
+from zodbupdate import convert
+from zodbupdate import logs
+from zodbupdate import opcodes
 from zodbupdate import utils
 
 
@@ -33,6 +38,12 @@ known_broken_modules = {}
 # types to skip when renaming/migrating databases
 SKIP_SYMBS = [('ZODB.blob', 'Blob')]
 
+# What we found out about a symbol, see ObjectRenamer.__update_symb.
+UNCHANGED = 'unchanged'
+RENAMED = 'renamed'
+BROKEN = 'broken'
+SKIPPED = 'skipped'
+
 
 def create_broken_module_for(symb):
     """If your pickle refer a broken class (not an instance of it, a
@@ -146,6 +157,27 @@ class ZODBReference:
         self.ref = ref
 
 
+class PickleChunks(list):
+    """File the pickler writes to, keeping the written chunks as they
+    are: they are joined once the record is pickled, instead of being
+    copied to a buffer first.
+    """
+    write = list.append
+
+
+def _class_name(class_meta):
+    """Return the name of the class of a record from its class
+    pickle, or None.
+    """
+    if isinstance(class_meta, tuple):
+        class_meta = class_meta[0]
+    if isinstance(class_meta, tuple):
+        return ' '.join(class_meta)
+    if isinstance(class_meta, type):
+        return f'{class_meta.__module__} {class_meta.__name__}'
+    return None
+
+
 class ObjectRenamer:
     """This load and save a ZODB record, modifying all references to
     renamed class according the given renaming rules:
@@ -161,12 +193,33 @@ class ObjectRenamer:
             self, renames, decoders, pickle_protocol=3, repickle_all=False,
             encoding=None):
         self.__added = dict()
+        self.__resolved = dict()
+        self.__globals = dict()
+        self.__hits = collections.Counter()
+        self.__misses = 0
+        # Classes found in the opcodes, by class pickle.
+        self.__classes = dict()
         self.__renames = renames
-        self.__decoders = decoders
+        # Decoders by symbol, and by class once it has been loaded.
+        self.__decoders = convert.compile_decoders(decoders or {})
+        self.__class_decoders = {}
         self.__changed = False
+        # OID of the record being renamed, if known, for the warnings.
+        self.__oid = None
         self.__protocol = pickle_protocol
         self.__repickle_all = repickle_all
         self.__encoding = encoding
+        # Set to False to unpickle every record instead of looking at
+        # their opcodes first.
+        self.scan_opcodes = True
+        # Set to a zodbupdate.stats.Stats to time each phase.
+        self.stats = None
+        # Set to a zodbupdate.profiling.ClassCosts to time each phase
+        # per class of record.
+        self.costs = None
+        # Pickler, reused from one record to the next.
+        self.__pickler_instance = None
+        self.__chunks = PickleChunks()
         self.__unpickle_options = {}
         if encoding:
             self.__unpickle_options = {
@@ -179,29 +232,54 @@ class ObjectRenamer:
         not. If the symbol have not been renamed explicitly, it's
         loaded and its location is checked to see if it have moved as
         well.
+
+        What we found is remembered, so the same symbol is only
+        looked up once.
         """
-        if symb_info in SKIP_SYMBS:
+        resolved = self.__resolved.get(symb_info)
+        if resolved is None:
+            self.__misses += 1
+            resolved = self.__resolved[symb_info] = self.__resolve_symb(
+                symb_info)
+        else:
+            self.__hits[symb_info] += 1
+        outcome, new_symb_info = resolved
+        if outcome is RENAMED:
+            self.__changed = True
+        elif outcome is BROKEN:
+            self.__warn_missing(symb_info)
+        elif outcome is SKIPPED:
             self.__skipped = True
+            if new_symb_info != symb_info:
+                self.__changed = True
+        return new_symb_info
+
+    def __resolve_symb(self, symb_info):
+        """Look up where a symbol should be. Return what we found out
+        with the symbol to use instead.
+        """
+        outcome, new_symb_info = self.__lookup_symb(symb_info)
+        if symb_info in SKIP_SYMBS:
+            return SKIPPED, new_symb_info
+        return outcome, new_symb_info
 
+    def __lookup_symb(self, symb_info):
         if symb_info in self.__renames:
-            self.__changed = True
-            return self.__renames[symb_info]
-        else:
-            symb = find_global(*symb_info, Broken=ZODBBroken)
-            if utils.is_broken(symb):
-                logger.warning('Warning: Missing factory for {}'.format(
-                    ' '.join(symb_info)))
-                create_broken_module_for(symb)
-            elif hasattr(symb, '__name__') and hasattr(symb, '__module__'):
-                new_symb_info = (symb.__module__, symb.__name__)
-                if new_symb_info != symb_info:
-                    logger.info('New implicit rule detected {} to {}'.format(
-                        ' '.join(symb_info), ' '.join(new_symb_info)))
-                    self.__renames[symb_info] = new_symb_info
-                    self.__added[symb_info] = new_symb_info
-                    self.__changed = True
-                    return new_symb_info
-        return symb_info
+            return RENAMED, self.__renames[symb_info]
+        symb = self.__globals[symb_info] = find_global(
+            *symb_info, Broken=ZODBBroken)
+        if utils.is_broken(symb):
+            create_broken_module_for(symb)
+            return BROKEN, symb_info
+        if hasattr(symb, '__name__') and hasattr(symb, '__module__'):
+            new_symb_info = (symb.__module__, symb.__name__)
+            if new_symb_info != symb_info:
+                logger.info('New implicit rule detected {} to {}'.format(
+                    ' '.join(symb_info), ' '.join(new_symb_info)))
+                self.__renames[symb_info] = new_symb_info
+                self.__added[symb_info] = new_symb_info
+                return RENAMED, new_symb_info
+        return UNCHANGED, symb_info
 
     def __find_global(self, *klass_info):
         """Find a class with the given name, looking for a renaming
@@ -209,7 +287,12 @@ class ObjectRenamer:
 
         Using ZODB find_global let us manage missing classes.
         """
-        return find_global(*self.__update_symb(klass_info), Broken=ZODBBroken)
+        symb_info = self.__update_symb(klass_info)
+        symb = self.__globals.get(symb_info)
+        if symb is None:
+            symb = self.__globals[symb_info] = find_global(
+                *symb_info, Broken=ZODBBroken)
+        return symb
 
     def __persistent_load(self, reference):
         """Load a persistent reference. The reference might changed
@@ -265,6 +348,9 @@ class ObjectRenamer:
     def __unpickler(self, input_file):
         """Create an unpickler with our custom global symbol loader
         and reference resolver.
+
+        Unpicklers are not reused: the C unpickler of zodbpickle
+        cannot be initialized again with another file.
         """
         return utils.Unpickler(
             input_file,
@@ -272,12 +358,25 @@ class ObjectRenamer:
             self.__find_global,
             **self.__unpickle_options)
 
-    def __pickler(self, output_file):
-        """Create a pickler able to save to the given file, objects we
-        loaded while paying attention to any reference we loaded.
+    def __pickler(self):
+        """Return a pickler able to save objects we loaded while paying
+        attention to any reference we loaded, and the emptied list of
+        chunks it writes to.
         """
-        return utils.Pickler(
-            output_file, self.__persistent_id, self.__protocol)
+        chunks = self.__chunks
+        del chunks[:]
+        pickler = self.__pickler_instance
+        if pickler is None:
+            pickler = self.__pickler_instance = utils.Pickler(
+                chunks, self.__persistent_id, self.__protocol)
+        return pickler, chunks
+
+    def __warn_missing(self, symb_info):
+        class_name = ' '.join(symb_info)
+        logger.warning(
+            f'Warning: Missing factory for {class_name}',
+            extra={'kind': logs.MISSING_FACTORY, 'class_name': class_name,
+                   'oid': self.__oid})
 
     def __update_class_meta(self, class_meta):
         """Update class information, which can contain information
@@ -286,11 +385,8 @@ class ObjectRenamer:
         if isinstance(class_meta, tuple):
             symb, args = class_meta
             if utils.is_broken(symb):
-                symb_info = (symb.__module__, symb.__name__)
-                logger.warning(
-                    'Warning: Missing factory for {}'.format(
-                        ' '.join(symb_info)))
-                return (symb_info, args)
+                # Already reported when it was loaded.
+                return ((symb.__module__, symb.__name__), args)
             elif isinstance(symb, tuple):
                 return self.__update_symb(symb), args
         return class_meta
@@ -298,21 +394,24 @@ class ObjectRenamer:
     def __decode_data(self, class_meta, data):
         if not self.__decoders:
             return
-        key = None
-        if isinstance(class_meta, type):
-            key = (class_meta.__module__, class_meta.__name__)
-        elif isinstance(class_meta, tuple):
+        if isinstance(class_meta, tuple):
             symb, args = class_meta
-            if isinstance(symb, type):
-                key = (symb.__module__, symb.__name__)
-            elif isinstance(symb, tuple):
-                key = symb
-            else:
+            if not isinstance(symb, (type, tuple)):
                 raise AssertionError('Unknown class format.')
+        elif isinstance(class_meta, type):
+            symb = class_meta
         else:
             raise AssertionError('Unknown class format.')
-        for decoder in self.__decoders.get(key, []):
-            self.__changed = decoder(data) or self.__changed
+        if isinstance(symb, type):
+            try:
+                decoder = self.__class_decoders[symb]
+            except KeyError:
+                decoder = self.__class_decoders[symb] = self.__decoders.get(
+                    (symb.__module__, symb.__name__))
+        else:
+            decoder = self.__decoders.get(symb)
+        if decoder is not None and decoder(data):
+            self.__changed = True
 
     @contextlib.contextmanager
     def __patched_encoding(self):
@@ -326,42 +425,216 @@ class ObjectRenamer:
         else:
             yield
 
+    def __is_unchanged(self, record):
+        """Tell from a scan of the record opcodes that renaming it
+        would not change anything: all the symbols it references are
+        known to stay the same, and none of them has decoders.
+        """
+        return record.certain and self.__are_unchanged(record.symbols)
+
+    def __scan(self, data):
+        """Scan the opcodes of a record. The symbols found in its state
+        are only candidates if they are all known to stay the same.
+        """
+        record = opcodes.quick_scan_record(data, self.__classes)
+        if record.candidates is not None and not self.__are_unchanged(
+                record.candidates):
+            # There might be something to rename in the state.
+            record = opcodes.scan_state(data, record)
+        return record
+
+    def __are_unchanged(self, symbols):
+        for symb_info in symbols:
+            resolved = self.__resolved.get(symb_info)
+            if resolved is None or symb_info in self.__decoders:
+                return False
+            outcome, new_symb_info = resolved
+            # A symbol to skip that is not renamed either leaves the
+            # whole record as it is, or is left as it is in the state.
+            if not (outcome is UNCHANGED or (
+                    outcome is SKIPPED and new_symb_info == symb_info)):
+                return False
+        return True
+
+    def __rewrite(self, data, scan):
+        """Rename symbols of a record directly in its pickles, without
+        unpickling it, given the scan of its opcodes. Return the new
+        record, or None if nothing changed. Raise RewriteError if it
+        cannot be done.
+        """
+        rewriter = opcodes.Rewriter(data, scan)
+        renamed = {}
+        for reference in scan.references:
+            if reference.position >= scan.state_start:
+                if self.__skipped:
+                    # do not do renames/conversions on blob records
+                    return None
+                break
+            renamed[reference.symb] = self.__update_symb(reference.symb)
+        if self.__skipped:
+            return None
+        for reference in scan.references:
+            # A symbol to skip only used in the state is renamed like
+            # the others.
+            if reference.symb not in renamed:
+                renamed[reference.symb] = self.__update_symb(reference.symb)
+        if self.__decoders and (
+                scan.klass is None or
+                renamed.get(scan.klass, scan.klass) in self.__decoders):
+            raise opcodes.RewriteError('Decoders need the record state')
+        if not self.__changed:
+            return None
+        for reference in scan.references:
+            symb_info = renamed[reference.symb]
+            if symb_info != reference.symb:
+                rewriter.rename(reference, symb_info)
+        return rewriter.apply()
+
     def rename(self, input_file):
-        """Take a ZODB record (as a file object) as input. We load it,
-        replace any reference to renamed class we know of. If any
-        modification are done, we save the record again and return it,
-        return None otherwise.
+        """Take a ZODB record (as a file object or bytes) as input. We
+        load it, replace any reference to renamed class we know of. If
+        any modification are done, we save the record again and return
+        it, return None otherwise.
+        """
+        if isinstance(input_file, io.BytesIO):
+            input_file = input_file.getvalue()
+        output = self.rename_record(input_file)
+        if output is None:
+            return None
+        return io.BytesIO(output)
+
+    def rename_record(self, data, oid=None):
+        """Same as rename, but take the record as a bytes-like object
+        and return the modified record as bytes, or None. The OID of
+        the record is only used in warnings.
+
+        The record is not copied if given as bytes, and the new record
+        is not copied once pickled.
         """
+        if not isinstance(data, bytes):
+            # Records can be given as views on a memory map.
+            data = bytes(data)
+        self.__oid = oid
         self.__changed = False
         self.__skipped = False
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        if self.scan_opcodes and not self.__repickle_all:
+            # Looking at the opcodes is enough to know that most
+            # records don't need to be unpickled, and to rename
+            # classes in the others.
+            record = self.__scan(data)
+            if self.__is_unchanged(record):
+                if stats is not None:
+                    stats.lap('scan', start)
+                return None
+            try:
+                output = self.__rewrite(data, record)
+            except opcodes.RewriteError as error:
+                logger.debug(f'Cannot rewrite record in place: {error}')
+                self.__changed = False
+                self.__skipped = False
+                if stats is not None:
+                    start = stats.lap('rewrite', start)
+            else:
+                if stats is not None:
+                    stats.lap('rewrite', start)
+                return output
 
+        costs = self.costs
+        if costs is not None:
+            started = time.perf_counter()
         with self.__patched_encoding():
-            unpickler = self.__unpickler(input_file)
+            unpickler = self.__unpickler(io.BytesIO(data))
             class_meta = unpickler.load()
+            if stats is not None:
+                start = stats.lap('unpickle_class', start)
             if self.__skipped:
                 # do not do renames/conversions on blob records
                 return None
             class_meta = self.__update_class_meta(class_meta)
 
             data = unpickler.load()
+            if stats is not None:
+                start = stats.lap('unpickle_state', start)
+            if costs is not None:
+                class_name = _class_name(class_meta)
+                started = costs.lap(class_name, 'unpickle', started)
             self.__decode_data(class_meta, data)
+            if stats is not None:
+                start = stats.lap('decode', start)
+            if costs is not None:
+                started = costs.lap(class_name, 'decode', started)
 
             if not (self.__changed or self.__repickle_all):
                 return None
 
-            output_file = io.BytesIO()
-            pickler = self.__pickler(output_file)
+            pickler, chunks = self.__pickler()
             try:
                 pickler.dump(class_meta)
                 pickler.dump(data)
             except utils.PicklingError as error:
                 logger.error(
-                    f'Error: cannot pickle modified record: {error}')
+                    f'Error: cannot pickle modified record: {error}',
+                    extra={'kind': logs.PICKLING_ERROR,
+                           'class_name': _class_name(class_meta),
+                           'oid': self.__oid})
                 # Could not pickle that record, skip it.
                 return None
-
-            output_file.truncate()
-            return output_file
+            finally:
+                # Don't keep the objects of the record alive.
+                pickler.clear_memo()
+                if stats is not None:
+                    stats.lap('repickle', start)
+                if costs is not None:
+                    costs.lap(class_name, 'repickle', started)
+
+            record = b''.join(chunks)
+            del chunks[:]
+            return record
+
+    def analyze(self, data):
+        """Tell what renaming a record would do, without modifying
+        it. Return the class of the record, as it is referenced in it
+        (None if it couldn't be found), and true if the record would
+        be modified.
+        """
+        data = bytes(data)
+        self.__changed = False
+        self.__skipped = False
+        record = self.__scan(data)
+        if self.__is_unchanged(record):
+            return record.klass, self.__repickle_all
+        scan = opcodes.scan_state(data, record)
+        if not scan.certain:
+            # Let the unpickler find the symbols.
+            with self.__patched_encoding():
+                unpickler = self.__unpickler(io.BytesIO(data))
+                unpickler.load()
+                if self.__skipped:
+                    return record.klass, False
+                unpickler.load()
+            return record.klass, bool(
+                self.__changed or self.__repickle_all or self.__decoders)
+        for reference in scan.references:
+            self.__update_symb(reference.symb)
+        if self.__skipped:
+            return scan.klass, False
+        changed = self.__changed or self.__repickle_all
+        if not changed and self.__decoders:
+            # Decoders could modify the record.
+            changed = scan.klass is None or (
+                self.__update_symb(scan.klass) in self.__decoders)
+        return scan.klass, changed
+
+    def get_missing(self):
+        """Return the symbols that were found to be missing.
+        """
+        return {
+            symb_info for symb_info, (outcome, new_symb_info)
+            in self.__resolved.items() if outcome is BROKEN}
 
     def get_rules(self, implicit=False, explicit=False):
         rules = {}
@@ -370,3 +643,71 @@ class ObjectRenamer:
         if implicit:
             rules.update(self.__added)
         return rules
+
+    def merge_rules(self, rules):
+        """Add implicit rules that have been found by another
+        renamer, for instance one running in a worker process.
+        """
+        for symb_info, new_symb_info in rules.items():
+            if symb_info not in self.__renames:
+                self.__renames[symb_info] = new_symb_info
+                self.__added[symb_info] = new_symb_info
+                self.__resolved.pop(symb_info, None)
+
+    def get_cache_sizes(self):
+        """Return the number of entries of the caches and rules kept
+        by the renamer.
+        """
+        return {
+            'resolved symbols': len(self.__resolved),
+            'class pickles': len(self.__classes),
+            'globals': len(self.__globals),
+            'class decoders': len(self.__class_decoders),
+            'symbol hits': len(self.__hits),
+            'renames': len(self.__renames),
+            'implicit renames': len(self.__added),
+            'known broken modules': len(known_broken_modules),
+        }
+
+    def drop_caches(self):
+        """Forget what was found out about symbols, and the pickler
+        used to pickle records, to free memory. Rules are kept.
+        """
+        self.__resolved.clear()
+        self.__classes.clear()
+        self.__globals.clear()
+        self.__class_decoders.clear()
+        self.__hits.clear()
+        self.__pickler_instance = None
+
+    def get_symbol_stats(self, reset=False):
+        """Return how many times symbols were found in the resolution
+        cache (per symbol), and how many times they had to be looked
+        up.
+        """
+        stats = {'hits': self.__hits, 'misses': self.__misses}
+        if reset:
+            self.__hits = collections.Counter()
+            self.__misses = 0
+        return stats
+
+    def merge_symbol_stats(self, stats):
+        """Add the resolution cache statistics of another renamer.
+        """
+        self.__hits.update(stats['hits'])
+        self.__misses += stats['misses']
+
+    def get_decoder_stats(self, reset=False):
+        """Return, for each class with decoders, how many records were
+        decoded and modified, and how many times each attribute was
+        modified.
+        """
+        return {
+            symb_info: decoder.get_stats(reset)
+            for symb_info, decoder in self.__decoders.items()}
+
+    def merge_decoder_stats(self, stats):
+        """Add the decoder statistics of another renamer.
+        """
+        for symb_info, decoder_stats in stats.items():
+            self.__decoders[symb_info].merge_stats(decoder_stats)
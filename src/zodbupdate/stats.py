@@ -0,0 +1,166 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import collections
+import json
+import logging
+import time
+
+
+logger = logging.getLogger('zodbupdate')
+
+# Seconds between two progress reports.
+REPORT_INTERVAL = 60
+
+
+class Stats:
+    """Counters and timers of an update.
+
+    Time spent in each phase of the processing of records (load,
+    unpickle, decode, repickle, store, commit ...) is accumulated with
+    ``add`` or ``lap``. Counters (records, bytes read ...) are
+    incremented with ``count``. When nobody asked for statistics, no
+    Stats object is created at all and the code being measured only
+    checks for None.
+    """
+
+    def __init__(self, total=None, interval=REPORT_INTERVAL):
+        self.total = total
+        self.interval = interval
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self.counts = collections.Counter()
+        self.started = time.monotonic()
+        self.next_report = self.started + interval
+
+    def add(self, phase, seconds):
+        self.seconds[phase] += seconds
+        self.calls[phase] += 1
+
+    def lap(self, phase, start):
+        """Account the time since start to the given phase. Return
+        the current time, to be used as start of the next one.
+        """
+        now = time.perf_counter()
+        self.seconds[phase] += now - start
+        self.calls[phase] += 1
+        return now
+
+    def count(self, name, value=1):
+        self.counts[name] += value
+
+    def timed(self, records, phase='load'):
+        """Iterate through records, accounting the time it takes to
+        get each of them to the given phase.
+        """
+        records = iter(records)
+        while True:
+            start = time.perf_counter()
+            try:
+                record = next(records)
+            except StopIteration:
+                return
+            self.lap(phase, start)
+            self.counts['bytes_read'] += len(record[2])
+            yield record
+
+    def take(self):
+        """Return the timers and reset them. This is used to send
+        them from a worker process to the parent one.
+        """
+        timers = dict(self.seconds), dict(self.calls)
+        self.seconds.clear()
+        self.calls.clear()
+        return timers
+
+    def merge(self, timers):
+        seconds, calls = timers
+        for phase, value in seconds.items():
+            self.seconds[phase] += value
+        self.calls.update(calls)
+
+    def as_dict(self):
+        elapsed = time.monotonic() - self.started
+        records = self.counts['records']
+        result = {
+            'elapsed': elapsed,
+            'total': self.total,
+            'counts': dict(self.counts),
+            'records_per_second': records / elapsed if elapsed else 0.0,
+            'bytes_per_second': (
+                self.counts['bytes_read'] / elapsed if elapsed else 0.0),
+            'eta': None,
+            'phases': {
+                phase: {'calls': self.calls[phase], 'seconds': seconds}
+                for phase, seconds in sorted(self.seconds.items())},
+        }
+        if self.total and records and result['records_per_second']:
+            result['eta'] = max(self.total - records, 0) / (
+                result['records_per_second'])
+        return result
+
+    def report(self, force=False):
+        """Log the progress of the update, if it has not been done
+        for a while.
+        """
+        now = time.monotonic()
+        if not force and now < self.next_report:
+            return
+        self.next_report = now + self.interval
+        stats = self.as_dict()
+        message = '{} records processed ({:.0f} records/s, {:.1f} MB/s)'
+        message = message.format(
+            stats['counts'].get('records', 0),
+            stats['records_per_second'],
+            stats['bytes_per_second'] / 1e6)
+        if stats['eta'] is not None:
+            message += ', about {:.0f}s left'.format(stats['eta'])
+        logger.info(message)
+        phases = stats['phases']
+        if phases:
+            logger.info('Time spent: {}'.format(', '.join(
+                '{} {:.1f}s'.format(phase, value['seconds'])
+                for phase, value in phases.items())))
+
+    def save(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.as_dict(), output, indent=2, sort_keys=True)
+
+
+def combine(results):
+    """Combine the statistics saved by updates run at the same time,
+    for instance on different ranges of OIDs, as if they were saved
+    by a single update.
+    """
+    counts = collections.Counter()
+    phases = {}
+    for result in results:
+        counts.update(result['counts'])
+        for phase, value in result['phases'].items():
+            combined = phases.setdefault(phase, {'calls': 0, 'seconds': 0.0})
+            combined['calls'] += value['calls']
+            combined['seconds'] += value['seconds']
+    elapsed = max(result['elapsed'] for result in results)
+    totals = [result['total'] for result in results if result['total']]
+    return {
+        'elapsed': elapsed,
+        'total': max(totals) if totals else None,
+        'counts': dict(counts),
+        'records_per_second': (
+            counts['records'] / elapsed if elapsed else 0.0),
+        'bytes_per_second': (
+            counts['bytes_read'] / elapsed if elapsed else 0.0),
+        'eta': None,
+        'phases': dict(sorted(phases.items())),
+    }
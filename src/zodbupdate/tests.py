@@ -12,6 +12,8 @@
 #
 ##############################################################################
 
+import io
+import json
 import logging
 import os
 import shutil
@@ -27,6 +29,7 @@ import ZODB
 import ZODB.broken
 import zope.interface
 
+import zodbupdate.logs
 import zodbupdate.main
 import zodbupdate.serialize
 
@@ -79,15 +82,691 @@ class TestsBasics(unittest.TestCase):
         self.assertTrue(decoder(data=test_data))
         self.assertEqual(test_data['testattr'], test_string)
 
+    def test_class_decoder(self):
+        from zodbupdate.convert import compile_decoders
+        from zodbupdate.convert import decode_attribute
+        from zodbupdate.convert import load_decoders
+
+        self.assertEqual({}, load_decoders())
+        decoders = compile_decoders({
+            ('module1', 'Factory'): [
+                decode_attribute('title', 'utf-8'),
+                decode_attribute('text', 'utf-8')],
+            ('module1', 'Data'): decode_attribute('text', 'utf-8'),
+        })
+        decoder = decoders['module1', 'Factory']
+        # Rules are compiled into one decoder per class.
+        decoder.add_text('body', 'utf-8')
+        decoder.add_binary('data')
+        data = {
+            'title': 'Caf\xe9'.encode(),
+            'body': 'Caf\xe9'.encode(),
+            'data': 'raw',
+        }
+        self.assertTrue(decoder(data))
+        self.assertEqual(
+            {'title': 'Caf\xe9', 'body': 'Caf\xe9', 'data': b'raw'}, data)
+        self.assertFalse(decoder(data))
+        self.assertEqual(
+            {'records': 2, 'changed': 1,
+             'attributes': {'body': 1, 'data': 1}, 'fallbacks': {}},
+            decoder.get_stats(reset=True))
+        self.assertEqual(
+            {'records': 0, 'changed': 0, 'attributes': {}, 'fallbacks': {}},
+            decoder.get_stats())
+        self.assertTrue(decoders['module1', 'Data']({'text': b'abc'}))
+
+        # Values decoded with a fallback are counted, not logged.
+        decoder.add_text('body', 'utf-8', ['latin-1'])
+        data = {'body': 'Caf\xe9'.encode('latin-1')}
+        self.assertTrue(decoder(data))
+        self.assertEqual({'body': 'Caf\xe9'}, data)
+        self.assertEqual(
+            {('body', 'latin-1'): 1}, decoder.get_stats()['fallbacks'])
+
+    def test_convert_with_fallbacks(self):
+        from zodbupdate.convert import ascii_shortcut
+        from zodbupdate.convert import convert_with_fallbacks
+
+        self.assertTrue(ascii_shortcut('cp1252'))
+        self.assertFalse(ascii_shortcut('utf8'))
+        self.assertFalse(ascii_shortcut('latin1'))
+        self.assertFalse(ascii_shortcut('utf-16'))
+        self.assertEqual(
+            'Cafe', convert_with_fallbacks(b'Cafe', 'title', 'cp1252', []))
+        self.assertEqual(
+            'Caf\u20ac',
+            convert_with_fallbacks(b'Caf\x80', 'title', 'cp1252', []))
+        fallbacks = {}
+        for value in [b'Caf\xe9', b'Caf\xe8', b'Cafe']:
+            convert_with_fallbacks(
+                value, 'title', 'utf-8', ['utf-7', 'latin-1'], fallbacks)
+        self.assertEqual({('title', 'latin-1'): 2}, fallbacks)
+
+    def test_warning_aggregator(self):
+        from zodbupdate.logs import WarningAggregator
+
+        def record(kind=None, class_name=None, oid=None):
+            record = logging.LogRecord(
+                'zodbupdate', logging.WARNING, __file__, 0, 'message', (),
+                None)
+            if kind is not None:
+                record.kind = kind
+                record.class_name = class_name
+                record.oid = oid
+            return record
+
+        aggregator = WarningAggregator(sample_size=2, max_keys=2)
+        self.assertTrue(aggregator.filter(record()))
+        self.assertTrue(aggregator.filter(record()))
+        # Only the first warning of each kind and class is logged.
+        oids = [ZODB.utils.p64(oid) for oid in range(1, 5)]
+        self.assertTrue(aggregator.filter(record('missing', 'm A', oids[0])))
+        for oid in oids[1:]:
+            self.assertFalse(aggregator.filter(record('missing', 'm A', oid)))
+        self.assertTrue(aggregator.filter(record('missing', 'm B', oids[0])))
+        # Once there are too many, others classes are counted together.
+        self.assertTrue(aggregator.filter(record('missing', 'm C', oids[1])))
+        self.assertFalse(aggregator.filter(record('missing', 'm D', oids[2])))
+
+        worker = WarningAggregator()
+        worker.filter(record('missing', 'm A', oids[3]))
+        worker.filter(record('error', None, oids[3]))
+        aggregator.merge(worker.take())
+        self.assertEqual({}, worker.counts)
+        # Only logged once by a worker, even if its counts were taken.
+        self.assertFalse(worker.filter(record('missing', 'm A', oids[3])))
+        worker.take()
+        self.assertEqual([
+            {'kind': 'missing', 'class': 'm A', 'count': 5,
+             'oids': ['0x01', '0x02']},
+            {'kind': 'missing', 'class': '-', 'count': 2,
+             'oids': ['0x02', '0x03']},
+            {'kind': 'error', 'class': '-', 'count': 1, 'oids': ['0x04']},
+            {'kind': 'missing', 'class': 'm B', 'count': 1,
+             'oids': ['0x01']},
+        ], aggregator.rows())
+        self.assertEqual([
+            'kind     class       count  example OIDs',
+            'missing  m A             5  0x01 0x02',
+            'missing  -               2  0x02 0x03',
+            'error    -               1  0x04',
+            'missing  m B             1  0x01',
+        ], aggregator.summary())
+
+    def test_quick_scan_record(self):
+        from zodbupdate.opcodes import quick_scan_record
+
+        # Text that looks like a GLOBAL is reported as a symbol, we
+        # only need a superset of the real ones.
+        record = quick_scan_record(
+            b'\x80\x03cmodule1\nFactory\nq\x00.'
+            b'\x80\x03}q\x01(X\x04\x00\x00\x00textq\x02'
+            b'X\x08\x00\x00\x00cat\ndog\nq\x03X\x04\x00\x00\x00dataq\x04'
+            b'cmodule1\nData\nq\x05)\x81q\x06u.')
+        self.assertTrue(record.certain)
+        self.assertEqual(('module1', 'Factory'), record.klass)
+        self.assertEqual(
+            {('module1', 'Factory'), ('module1', 'Data'), ('at', 'dog')},
+            record.symbols)
+
+        # Old references using a (module, name) tuple are found
+        # exactly, even when the strings come from the memo.
+        record = quick_scan_record(
+            b'\x80\x02cmodule1\nFactory\nq\x01.'
+            b'\x80\x02}q\x02(U\x05otherq\x03'
+            b'U\x08\x00\x00\x00\x00\x00\x00\x00\x01q\x04'
+            b'U\x07module2q\x05U\x0cOtherFactoryq\x06\x86q\x07\x86q\x08Q'
+            b'U\x04sameq\tU\x08\x00\x00\x00\x00\x00\x00\x00\x02q\n'
+            b'h\x05h\x06\x86q\x0b\x86q\x0cQu.')
+        self.assertTrue(record.certain)
+        self.assertEqual(
+            {('module1', 'Factory'), ('module2', 'OtherFactory')},
+            record.symbols)
+        self.assertEqual(
+            [None, None],
+            [reference.opcode for reference in record.references[1:]])
+
+    def test_scan_state(self):
+        from zodbupdate.opcodes import quick_scan_record
+        from zodbupdate.opcodes import scan_state
+
+        record = (
+            b'\x80\x03cmodule1\nFactory\nq\x00.'
+            b'\x80\x03}q\x01(X\x07\x00\x00\x00createdq\x02'
+            b'cdatetime\ndatetime\nq\x03)\x81q\x04'
+            b'X\x08\x00\x00\x00cat\ndog\nq\x05u.')
+        classes = {}
+        scan = quick_scan_record(record, classes)
+        # The class pickle is only read once.
+        self.assertEqual(
+            [b'\x80\x03cmodule1\nFactory\nq\x00.'], list(classes))
+        self.assertIs(
+            scan.references[0],
+            quick_scan_record(record, classes).references[0])
+        self.assertIn(('reatedq\x02cdatetime', 'datetime'), scan.symbols)
+        # The exact scan of the state drops what only looks like a
+        # GLOBAL.
+        scan = scan_state(record, scan)
+        self.assertTrue(scan.certain)
+        self.assertIsNone(scan.candidates)
+        self.assertEqual(('module1', 'Factory'), scan.klass)
+        self.assertEqual(
+            {('module1', 'Factory'), ('datetime', 'datetime')},
+            scan.symbols)
+        self.assertEqual(
+            [2, 42],
+            [reference.position for reference in scan.references])
+        self.assertIs(scan, scan_state(record, scan))
+
+    def test_rename_skips_unchanged_records(self):
+        from zodbupdate import utils
+        from zodbupdate.serialize import ObjectRenamer
+
+        record = (
+            b'\x80\x03cpersistent.mapping\nPersistentMapping\nq\x00.'
+            b'\x80\x03}q\x01X\x04\x00\x00\x00dataq\x02}q\x03s.')
+        loaded = []
+        original = utils.Unpickler
+
+        def Unpickler(*args, **kw):
+            loaded.append(args)
+            return original(*args, **kw)
+
+        processor = ObjectRenamer(renames={}, decoders={})
+        utils.Unpickler = Unpickler
+        try:
+            # Looking at the opcodes is enough to know that the class
+            # didn't move, the record doesn't need to be unpickled.
+            self.assertIsNone(processor.rename(io.BytesIO(record)))
+            self.assertIsNone(processor.rename(io.BytesIO(record)))
+            self.assertEqual(0, len(loaded))
+        finally:
+            utils.Unpickler = original
+
+        processor = ObjectRenamer(
+            renames={('persistent.mapping', 'PersistentMapping'):
+                     ('persistent', 'Persistent')},
+            decoders={})
+        self.assertEqual(
+            b'\x80\x03cpersistent\nPersistent\nq\x00.'
+            b'\x80\x03}q\x01X\x04\x00\x00\x00dataq\x02}q\x03s.',
+            processor.rename(io.BytesIO(record)).getvalue())
+
+    def test_rename_record(self):
+        from zodbupdate.serialize import ObjectRenamer
+
+        processor = ObjectRenamer(
+            renames={}, decoders={}, repickle_all=True, pickle_protocol=3)
+        large = (
+            b'\x80\x02cpersistent.mapping\nPersistentMapping\nq\x01.'
+            b'\x80\x02}q\x02U\x04dataq\x03}q\x04U\x03keyq\x05T' +
+            (1 << 16).to_bytes(4, 'little') + b'x' * (1 << 16) + b'ss.')
+        small = (
+            b'\x80\x02cpersistent.mapping\nPersistentMapping\nq\x01.'
+            b'\x80\x02}q\x02U\x04dataq\x03}q\x04s.')
+        # Records can be given as views, and come back as bytes.
+        output = processor.rename_record(memoryview(large))
+        self.assertIsInstance(output, bytes)
+        self.assertEqual(65618, len(output))
+        # Nothing is left from the previous record.
+        self.assertEqual(
+            b'\x80\x03cpersistent.mapping\nPersistentMapping\nq\x00.'
+            b'\x80\x03}q\x01X\x04\x00\x00\x00dataq\x02}q\x03s.',
+            processor.rename_record(small))
+        self.assertEqual(output, processor.rename_record(large))
+
+    def test_symbol_resolution_cache(self):
+        from zodbupdate import serialize
+        from zodbupdate.serialize import ObjectRenamer
+
+        record = (
+            b'\x80\x03cpersistent.mapping\nPersistentMapping\nq\x00.'
+            b'\x80\x03}q\x01X\x04\x00\x00\x00dataq\x02}q\x03s.')
+        looked_up = []
+        original = serialize.find_global
+
+        def find_global(*args, **kw):
+            looked_up.append(args)
+            return original(*args, **kw)
+
+        processor = ObjectRenamer(
+            renames={}, decoders={}, repickle_all=True)
+        serialize.find_global = find_global
+        try:
+            for count in range(3):
+                processor.rename(io.BytesIO(record))
+        finally:
+            serialize.find_global = original
+        self.assertEqual(
+            [('persistent.mapping', 'PersistentMapping')], looked_up)
+        stats = processor.get_symbol_stats(reset=True)
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(
+            {('persistent.mapping', 'PersistentMapping'): 2},
+            stats['hits'])
+        stats = processor.get_symbol_stats()
+        self.assertEqual(0, stats['misses'])
+        self.assertEqual({}, stats['hits'])
+
+    def test_transaction_sizer(self):
+        from zodbupdate.update import TransactionSizer
+
+        sizer = TransactionSizer(records=2, size=10)
+        self.assertFalse(sizer.add(b'1234'))
+        self.assertFalse(sizer.add(b'1234'))
+        self.assertTrue(sizer.add(b'12'))
+        sizer.reset()
+        self.assertTrue(sizer.add(b'1234567890'))
+
+        # Without a target latency, the number of records is fixed.
+        sizer.committed(10.0)
+        self.assertEqual(2, sizer.records)
+
+        sizer = TransactionSizer(records=100, latency=1.0)
+        for count in range(100):
+            sizer.add(b'data')
+        # Too slow, use smaller transactions.
+        sizer.committed(4.0)
+        self.assertEqual(50, sizer.records)
+        sizer.reset()
+        for count in range(50):
+            sizer.add(b'data')
+        # Fast enough, grow them.
+        sizer.committed(0.4)
+        self.assertEqual(100, sizer.records)
+
+        # Only transactions committed for their number of records are
+        # used to adjust it.
+        sizer = TransactionSizer(records=100000, size=1000, latency=1.0)
+        for count in range(4):
+            self.assertFalse(sizer.add(b'x' * 200))
+        self.assertTrue(sizer.add(b'x' * 200))
+        sizer.committed(0.01)
+        self.assertEqual(100000, sizer.records)
+
+    def test_throttle(self):
+        from zodbupdate import update
+
+        class Clock:
+            now = 100.0
+
+            def monotonic(self):
+                return self.now
+
+            def sleep(self, seconds):
+                self.now += seconds
+
+        clock = Clock()
+        original = update.time
+        update.time = clock
+        try:
+            throttle = update.Throttle(10)
+            self.assertEqual(0.0, throttle.wait())
+            self.assertAlmostEqual(0.1, throttle.wait())
+            self.assertAlmostEqual(100.1, clock.now)
+            clock.now += 0.5
+            # Slower than the limit, no need to wait.
+            self.assertEqual(0.0, throttle.wait())
+            self.assertAlmostEqual(0.1, throttle.wait())
+        finally:
+            update.time = original
+
+    def test_memory_monitor(self):
+        from zodbupdate import memory
+
+        self.assertEqual(1024, memory.parse_size('1k'))
+        self.assertEqual(3 << 29, memory.parse_size('1.5GB'))
+        self.assertEqual(1000, memory.parse_size('1000'))
+        self.assertGreater(memory.current_memory(), 0)
+
+        used = [50]
+        original = memory.current_memory
+        memory.current_memory = lambda: used[0]
+        try:
+            monitor = memory.MemoryMonitor(limit=100, interval=2)
+            self.assertEqual(
+                [False] * 4, [monitor.check() for i in '1234'])
+            used[0] = 95
+            # Only measured every other call.
+            self.assertFalse(monitor.check())
+            self.assertTrue(monitor.check())
+            self.assertFalse(monitor.warned)
+            monitor.relieved()
+            self.assertTrue(monitor.warned)
+
+            # Relieving memory didn't help, the next checks are further
+            # and further apart.
+            def checks():
+                count = 1
+                while not monitor.check():
+                    count += 1
+                monitor.relieved()
+                return count
+
+            self.assertEqual([4, 8, 16, 32, 64, 128, 128], [
+                checks() for i in range(7)])
+            # Once back below the threshold, it is checked as often as
+            # before.
+            used[0] = 50
+            self.assertFalse(any(monitor.check() for i in range(128)))
+            used[0] = 95
+            self.assertEqual(2, checks())
+            self.assertEqual(4, checks())
+        finally:
+            memory.current_memory = original
+
+    def test_class_costs(self):
+        from zodbupdate.profiling import ClassCosts
+        from zodbupdate.profiling import Profiler
+
+        costs = ClassCosts()
+        start = costs.lap('module Class', 'unpickle', 0.0)
+        costs.lap('module Class', 'decode', start)
+        other = ClassCosts()
+        other.lap('module Class', 'unpickle', start)
+        other.lap('module Other', 'unpickle', start)
+        costs.merge(other.take())
+        self.assertEqual({}, other.take()[0])
+        rows = costs.rows()
+        self.assertEqual(
+            ['module Class', 'module Other'], [row['class'] for row in rows])
+        self.assertEqual([2, 1], [row['records'] for row in rows])
+        self.assertEqual(0.0, rows[0]['repickle'])
+        self.assertAlmostEqual(
+            rows[0]['seconds'], rows[0]['unpickle'] + rows[0]['decode'])
+        summary = costs.summary(limit=1)
+        self.assertEqual(2, len(summary))
+        self.assertTrue(summary[1].startswith('module Class'))
+
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory)
+            self.assertEqual(3, profiler.run('main', sum, [1, 2]))
+            self.assertEqual(['main.pstats'], os.listdir(directory))
+
+    def test_references(self):
+        import pickle
+
+        from zodbupdate import pack
+        from zodbupdate.pack import References
+
+        def record(*oids):
+            output = io.BytesIO()
+            pickler = pickle.Pickler(output, 3)
+            # Integers stand for references to the OID.
+            pickler.persistent_id = lambda obj: (
+                (ZODB.utils.p64(obj), None) if isinstance(obj, int)
+                else None)
+            pickler.dump(('module', 'Class'))
+            pickler.dump(list(oids))
+            return output.getvalue()
+
+        records = {0: record(1, 2), 1: record(0), 2: record(1, 9),
+                   3: record(), 4: record(3)}
+        for order in ([0, 1, 2, 3, 4], [4, 2, 0, 3, 1]):
+            references = References()
+            for oid in order:
+                references.add(ZODB.utils.p64(oid), records[oid])
+            self.assertEqual(5, len(references))
+            # 9 is referenced but was not copied.
+            self.assertEqual({3, 4}, references.unreachable())
+
+        # Records added out of order, some of them twice (the last copy
+        # counts), are sorted in chunks merged afterwards.
+        original = pack.SORT_CHUNK
+        pack.SORT_CHUNK = 2
+        try:
+            references = References()
+            for oid, data in (
+                    (4, records[4]), (2, record(4)), (0, records[0]),
+                    (3, records[3]), (1, records[1]), (2, records[2])):
+                references.add(ZODB.utils.p64(oid), data)
+            self.assertEqual({3, 4}, references.unreachable())
+            references.add(ZODB.utils.p64(0), record(3))
+            self.assertEqual({1, 2, 4}, references.unreachable())
+        finally:
+            pack.SORT_CHUNK = original
+
+        references = References()
+        references.add(ZODB.utils.p64(1), records[1])
+        # Without the root, nothing is removed.
+        self.assertEqual(set(), references.unreachable())
+        references.add(ZODB.utils.p64(1 << 63), records[1])
+        references.add(ZODB.utils.p64(0), records[0])
+        # Nor when OIDs cannot be sorted.
+        self.assertEqual(set(), references.unreachable())
+
+    def test_merge(self):
+        from zodbupdate import merge
+        from zodbupdate.checkpoint import Checkpoint
+        from zodbupdate.oids import parse_range
+
+        self.assertEqual(('0x00', '0x10'), parse_range(':0x10'))
+        self.assertEqual(('0x10', None), parse_range('0x0010:'))
+        for value in ('0x10', '0x10:0x01', '0xzz:'):
+            with self.assertRaises(ValueError):
+                parse_range(value)
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for index, content in enumerate((
+                    "renames = {'a A': 'b B', 'c C': 'd D'}",
+                    "renames = {'a A': 'b B'}",
+                    'renames = ')):
+                paths.append(os.path.join(directory, f'{index}.py'))
+                with open(paths[-1], 'w') as output:
+                    output.write(content)
+            renames = [merge.load_renames(path) for path in paths]
+        self.assertEqual({}, renames[2])
+        self.assertEqual(
+            {('a', 'A'): ('b', 'B'), ('c', 'C'): ('d', 'D')},
+            merge.merge_renames(renames))
+        with self.assertRaises(SystemExit):
+            merge.merge_renames([{('a', 'A'): ('b', 'B')},
+                                 {('a', 'A'): ('c', 'C')}])
+
+        merge.check_ranges([
+            Checkpoint(first_oid='0x10'),
+            Checkpoint(end_oid='0x10')])
+        with self.assertRaises(SystemExit):
+            merge.check_ranges([
+                Checkpoint(first_oid='0x10'),
+                Checkpoint(end_oid='0x20')])
+
+        # The low range is not finished, the combined update resumes
+        # where it stopped, even if the high one went further.
+        checkpoints = [
+            Checkpoint(oid=ZODB.utils.p64(0x30), first_oid='0x20',
+                       finished=True),
+            Checkpoint(oid=ZODB.utils.p64(0x05), end_oid='0x10'),
+            Checkpoint(oid=ZODB.utils.p64(0x12), first_oid='0x10',
+                       end_oid='0x20', finished=True)]
+        combined = Checkpoint.combine(checkpoints)
+        self.assertFalse(combined.finished)
+        self.assertEqual('0x06', combined.start_at)
+        checkpoints[1].finished = True
+        self.assertEqual('0x31', Checkpoint.combine(checkpoints).start_at)
+        # Nothing was processed in the middle range yet.
+        checkpoints[2] = Checkpoint(first_oid='0x10', end_oid='0x20')
+        self.assertEqual('0x06', Checkpoint.combine(checkpoints).start_at)
+
+    def test_check_pickle_implementation(self):
+        from zodbupdate import utils
+
+        messages = []
+        handler = TestLogHandler(messages, 'zodbupdate')
+        logger = logging.getLogger('zodbupdate')
+        logger.addHandler(handler)
+        original = utils.PURE_PYTHON
+        try:
+            utils.PURE_PYTHON = False
+            self.assertTrue(utils.check_pickle_implementation())
+            self.assertEqual([], messages)
+            utils.PURE_PYTHON = True
+            self.assertFalse(utils.check_pickle_implementation())
+        finally:
+            utils.PURE_PYTHON = original
+            logger.removeHandler(handler)
+        self.assertIn('pure Python', messages[0])
+
+    def test_prefetch(self):
+        from zodbupdate.pipeline import prefetch
+
+        self.assertEqual(
+            list(range(250)), list(prefetch(iter(range(250)), 50)))
+        self.assertEqual([], list(prefetch(iter([]), 10)))
+
+        def failing():
+            yield from range(3)
+            raise ValueError('broken record')
+
+        received = []
+        with self.assertRaises(ValueError):
+            for item in prefetch(failing(), 10):
+                received.append(item)
+        # Items read before the error are given first.
+        self.assertEqual([0, 1, 2], received)
+
+        # Stopping early stops the thread and closes the items.
+        closed = []
+
+        def endless():
+            try:
+                count = 0
+                while True:
+                    yield count
+                    count += 1
+            finally:
+                closed.append(True)
+
+        items = prefetch(endless(), 10, chunk_size=2)
+        self.assertEqual([0, 1, 2], [next(items) for count in range(3)])
+        items.close()
+        self.assertEqual([True], closed)
+
+    def test_benchmark(self):
+        from zodbupdate import benchmark
+
+        directory = tempfile.mkdtemp('.zodbupdate')
+        try:
+            storage = benchmark.open_storage('filestorage', directory)
+            benchmark.generate(storage, 30, renamed=0.5, py2=True)
+            storage.close()
+            result = benchmark.run('filestorage', directory, 'rename')
+            self.assertEqual(30, result['records'])
+            self.assertLess(0, result['updated'])
+            result = benchmark.run('filestorage', directory, 'convert')
+            self.assertEqual(30, result['updated'])
+            self.assertIn('repickle', result['phases'])
+            result = benchmark.run('filestorage', directory, 'rename')
+            self.assertEqual(0, result['updated'])
+        finally:
+            shutil.rmtree(directory)
+        self.assertIn('filestorage  rename', benchmark.format_results(
+            [result]))
+
+        results = benchmark.measure_pickling(30)
+        self.assertEqual(
+            [('c', 'new'), ('c', 'reused'),
+             ('python', 'new'), ('python', 'reused')],
+            [(result['implementation'], result['pickler'])
+             for result in results])
+        self.assertEqual(30, results[0]['records'])
+        self.assertIn(
+            'c               reused',
+            benchmark.format_pickling_results(results))
+
+        results = benchmark.measure_scanning(30, renamed=0.5)
+        self.assertEqual(
+            ['unpickle', 'scan'],
+            [result['method'] for result in results])
+        self.assertEqual(30, results[1]['records'])
+        self.assertIn('scan', benchmark.format_scanning_results(results))
+
+    def test_rename_old_reference(self):
+        from zodbupdate.serialize import ObjectRenamer
+
+        record = (
+            b'\x80\x02cpersistent.mapping\nPersistentMapping\nq\x01.'
+            b'\x80\x02}q\x02U\x05otherq\x03'
+            b'U\x08\x00\x00\x00\x00\x00\x00\x00\x01q\x04'
+            b'U\x07module1q\x05U\x07OldDataq\x06\x86q\x07\x86q\x08Qs.')
+        # A reference with a (module, name) tuple as class information
+        # must not be skipped. It is renamed in place.
+        processor = ObjectRenamer(
+            renames={('module1', 'OldData'): ('module1', 'Data')},
+            decoders={})
+        self.assertEqual(
+            b'\x80\x02cpersistent.mapping\nPersistentMapping\nq\x01.'
+            b'\x80\x02}q\x02U\x05otherq\x03'
+            b'U\x08\x00\x00\x00\x00\x00\x00\x00\x01q\x04'
+            b'U\x07module1q\x05U\x04Dataq\x06\x86q\x07\x86q\x08Qs.',
+            processor.rename(io.BytesIO(record)).getvalue())
+
+        # Unless we ask to repickle everything.
+        processor = ObjectRenamer(
+            renames={('module1', 'OldData'): ('module1', 'Data')},
+            decoders={},
+            repickle_all=True)
+        self.assertEqual(
+            b'\x80\x03cpersistent.mapping\nPersistentMapping\nq\x00.'
+            b'\x80\x03}q\x01X\x05\x00\x00\x00otherq\x02'
+            b'C\x08\x00\x00\x00\x00\x00\x00\x00\x01q\x03'
+            b'X\x07\x00\x00\x00module1q\x04X\x04\x00\x00\x00Dataq\x05'
+            b'\x86q\x06\x86q\x07Qs.',
+            processor.rename(io.BytesIO(record)).getvalue())
+
+    def test_rename_in_place(self):
+        from zodbupdate.serialize import ObjectRenamer
+
+        processor = ObjectRenamer(
+            renames={('module1', 'Factory'): ('module2', 'OtherFactory')},
+            decoders={})
+        # The module string is shared with another reference to a
+        # class we don't rename, so the record is repickled.
+        record = (
+            b'\x80\x03cpersistent.mapping\nPersistentMapping\nq\x00.'
+            b'\x80\x03}q\x01(X\x01\x00\x00\x00aq\x02'
+            b'C\x08\x00\x00\x00\x00\x00\x00\x00\x01q\x03'
+            b'X\x07\x00\x00\x00module1q\x04X\x07\x00\x00\x00Factoryq\x05'
+            b'\x86q\x06\x86q\x07QX\x01\x00\x00\x00bq\x08'
+            b'C\x08\x00\x00\x00\x00\x00\x00\x00\x02q\x09'
+            b'h\x04X\x04\x00\x00\x00Dataq\x0a'
+            b'\x86q\x0b\x86q\x0cQu.')
+        output = processor.rename(io.BytesIO(record)).getvalue()
+        self.assertEqual(
+            b'\x80\x03}q\x01(X\x01\x00\x00\x00aq\x02'
+            b'C\x08\x00\x00\x00\x00\x00\x00\x00\x01q\x03'
+            b'X\x07\x00\x00\x00module2q\x04X\x0c\x00\x00\x00OtherFactoryq\x05'
+            b'\x86q\x06\x86q\x07QX\x01\x00\x00\x00bq\x08'
+            b'C\x08\x00\x00\x00\x00\x00\x00\x00\x02q\t'
+            b'X\x07\x00\x00\x00module1q\nX\x04\x00\x00\x00Dataq\x0b'
+            b'\x86q\x0c\x86q\rQu.',
+            output[output.index(b'.\x80') + 1:])
+
+        # Classes referenced with a GLOBAL opcode are changed in
+        # place, whatever the size of the new name.
+        processor = ObjectRenamer(
+            renames={('persistent.mapping', 'PersistentMapping'):
+                     ('persistent', 'Persistent')},
+            decoders={})
+        self.assertEqual(
+            b'\x80\x02cpersistent\nPersistent\nq\x01.'
+            b'\x80\x02}q\x02U\x04dataq\x03}q\x04s.',
+            processor.rename(io.BytesIO(
+                b'\x80\x02cpersistent.mapping\nPersistentMapping\nq\x01.'
+                b'\x80\x02}q\x02U\x04dataq\x03}q\x04s.')).getvalue())
+
 
 class TestLogHandler:
     level = logging.DEBUG
 
-    def __init__(self, msg_lst):
+    def __init__(self, msg_lst, name='zodbupdate.serialize'):
         self.msg_lst = msg_lst
+        self.name = name
 
     def handle(self, record):
-        if record.name == 'zodbupdate.serialize':
+        if record.name == self.name:
             self.msg_lst.append(record.msg)
 
 
@@ -195,7 +874,7 @@ class StorageUpdateMixin:
 
     def tearDown(self):
         self.logger.removeHandler(self.log_handler)
-        zodbupdate.main.duplicate_filter.reset()
+        zodbupdate.logs.aggregator.reset()
 
         if 'module1' in sys.modules:
             del sys.modules['module1']
@@ -350,8 +1029,13 @@ class Python3TestsMixin:
         self.root['test'] = test
         transaction.commit()
 
-        self.update(convert_py3=True, default_decoders={
+        updater = self.update(convert_py3=True, default_decoders={
             ('module1', 'Factory'): [decode_attribute('text', 'utf-8')]})
+        self.assertEqual(
+            {('module1', 'Factory'):
+             {'records': 1, 'changed': 1, 'attributes': {},
+              'fallbacks': {}}},
+            updater.processor.get_decoder_stats())
 
         # Protocol is 3 (x80x03) now and the string is encoded as unicode (X)
         self.assertEqual(
@@ -497,6 +1181,27 @@ class Python3TestsMixin:
             self.storage.load(test._p_oid, '')[0]
         )
 
+    def test_factory_missing_counted(self):
+        self.root['test'] = sys.modules['module1'].Factory()
+        self.root['other'] = sys.modules['module1'].Factory()
+        transaction.commit()
+        # The root references the class as well.
+        oids = sorted([
+            self.root._p_oid, self.root['test']._p_oid,
+            self.root['other']._p_oid])
+        del sys.modules['module1'].Factory
+
+        self.update()
+
+        self.assertEqual(
+            ['Warning: Missing factory for module1 Factory'],
+            self.log_messages)
+        self.assertEqual(
+            [{'kind': 'missing factory', 'class': 'module1 Factory',
+              'count': 3,
+              'oids': [ZODB.utils.oid_repr(oid) for oid in oids]}],
+            zodbupdate.logs.aggregator.rows())
+
     def test_factory_ignore_missing_persistent(self):
         # Create a ZODB with an object referencing a factory, then
         # remove the factory and update the ZODB.
@@ -634,6 +1339,563 @@ class Python3TestsMixin:
             {('module1', 'Factory'): ('module1', 'NewFactory')},
             renames)
 
+    def test_factory_renamed_with_workers(self):
+        # Same as test_factory_renamed, but the records are renamed
+        # in worker processes. The implicit rules they find are
+        # reported back.
+        for count in range(5):
+            self.root[count] = sys.modules['module1'].Factory()
+        transaction.commit()
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        updater = self.update(workers=2)
+
+        for count in range(5):
+            self.assertEqual(
+                b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+                self.storage.load(self.root[count]._p_oid, '')[0])
+        renames = updater.processor.get_rules(implicit=True)
+        self.assertEqual(
+            {('module1', 'Factory'): ('module1', 'NewFactory')},
+            renames)
+
+    def test_factory_renamed_resume(self):
+        # Resume an interrupted update: records up to the checkpoint
+        # are not looked at again, and the implicit rules found before
+        # are used for the others.
+        from zodbupdate.checkpoint import Checkpoint
+
+        for count in range(5):
+            self.root[count] = sys.modules['module1'].Factory()
+        transaction.commit()
+        oids = sorted(self.root[count]._p_oid for count in range(5))
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+        sys.modules['module1'].Factory = None
+
+        checkpoint = os.path.join(self.temp_dir, 'checkpoint.json')
+        Checkpoint(
+            oid=oids[2],
+            counts={'processed': 4, 'updated': 3, 'commits': 1},
+            rules={('module1', 'Factory'): ('module1', 'NewFactory')},
+        ).save(checkpoint)
+        started = self.storage.lastTransaction()
+        updater = self.update(checkpoint=checkpoint, resume=True)
+
+        for oid in oids[:3]:
+            self.assertEqual(
+                b'\x80\x03cmodule1\nFactory\nq\x00.\x80\x03}q\x01.',
+                self.storage.load(oid, '')[0])
+        for oid in oids[3:]:
+            self.assertEqual(
+                b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+                self.storage.load(oid, '')[0])
+        self.assertEqual(
+            {('module1', 'Factory'): ('module1', 'NewFactory')},
+            updater.processor.get_rules(implicit=True))
+
+        progress = Checkpoint.load(checkpoint)
+        self.assertTrue(progress.finished)
+        self.assertEqual(oids[4], progress.oid)
+        # The transaction from before the update, to catch up with
+        # the changes made while it ran.
+        self.assertEqual(started, progress.tid)
+        self.assertNotEqual(self.storage.lastTransaction(), progress.tid)
+        self.assertEqual(
+            {'processed': 6, 'updated': 5, 'commits': 2},
+            progress.counts)
+
+        # Nothing is left to do.
+        updater = self.update(checkpoint=checkpoint, resume=True)
+        self.assertEqual(6, updater.progress.counts['processed'])
+        self.assertEqual(started, Checkpoint.load(checkpoint).tid)
+
+    def test_factory_renamed_oid_range(self):
+        # Update two ranges of OIDs separately, as on two machines,
+        # then merge their checkpoints and statistics.
+        from ZODB.utils import oid_repr
+
+        from zodbupdate import merge
+        from zodbupdate import stats
+        from zodbupdate.checkpoint import Checkpoint
+        from zodbupdate.stats import Stats
+
+        for count in range(5):
+            self.root[count] = sys.modules['module1'].Factory()
+        transaction.commit()
+        oids = sorted(self.root[count]._p_oid for count in range(5))
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        middle = oid_repr(oids[2])
+        checkpoints = []
+        results = []
+        for start_at, end_at in (('0x00', middle), (middle, None)):
+            checkpoint = os.path.join(self.temp_dir, f'{start_at}.json')
+            checkpoints.append(checkpoint)
+            updater = self.update(
+                start_at=start_at, end_at=end_at, checkpoint=checkpoint,
+                stats=Stats())
+            results.append(updater.stats.as_dict())
+        self.assertEqual([3, 3], [
+            result['counts']['records'] for result in results])
+
+        for oid in oids:
+            self.assertEqual(
+                b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+                self.storage.load(oid, '')[0])
+
+        checkpoints = [Checkpoint.load(path) for path in checkpoints]
+        self.assertEqual(middle, checkpoints[0].end_oid)
+        self.assertEqual(oids[1], checkpoints[0].oid)
+        merge.check_ranges(checkpoints)
+        combined = Checkpoint.combine(checkpoints)
+        self.assertTrue(combined.finished)
+        self.assertEqual(oids[4], combined.oid)
+        self.assertEqual(checkpoints[0].tid, combined.tid)
+        self.assertEqual(
+            {'processed': 6, 'updated': 6, 'commits': 2}, combined.counts)
+        self.assertEqual(
+            {('module1', 'Factory'): ('module1', 'NewFactory')},
+            combined.rules)
+        self.assertEqual(6, stats.combine(results)['counts']['records'])
+
+        # The range must be the same to resume.
+        with self.assertRaises(AssertionError):
+            self.update(
+                start_at=middle, checkpoint=os.path.join(
+                    self.temp_dir, '0x00.json'), resume=True)
+
+    def test_factory_renamed_transaction_size(self):
+        for count in range(5):
+            self.root[count] = sys.modules['module1'].Factory()
+        transaction.commit()
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        updater = self.update(transaction_records=1)
+        self.assertEqual(3, updater.progress.counts['commits'])
+
+        sys.modules['module1'].OtherFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].OtherFactory.__name__ = 'OtherFactory'
+
+        # The root, referencing the factories, is updated as well.
+        updater = self.update(transaction_bytes=1)
+        self.assertEqual(6, updater.progress.counts['commits'])
+        for count in range(5):
+            self.assertEqual(
+                b'\x80\x03cmodule1\nOtherFactory\nq\x00.\x80\x03}q\x01.',
+                self.storage.load(self.root[count]._p_oid, '')[0])
+
+    def test_factory_renamed_prefetch(self):
+        from ZODB.interfaces import IMVCCStorage
+
+        for count in range(5):
+            self.root[count] = sys.modules['module1'].Factory()
+        transaction.commit()
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        # Transactions are the same as without prefetching.
+        updater = self.update(transaction_records=1, prefetch=2)
+        self.assertEqual(
+            {'processed': 6, 'updated': 6, 'commits': 3},
+            updater.progress.counts)
+        for count in range(5):
+            self.assertEqual(
+                b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+                self.storage.load(self.root[count]._p_oid, '')[0])
+
+        if IMVCCStorage.providedBy(self.storage):
+            # Records are read from their own instance of the storage.
+            instances = []
+            new_instance = self.storage.new_instance
+
+            def counted():
+                instances.append(new_instance())
+                return instances[-1]
+
+            self.storage.new_instance = counted
+            updater = zodbupdate.main.create_updater(
+                self.storage, prefetch=2)
+            self.assertEqual(6, len(list(updater.records)))
+            self.assertEqual(1, len(instances))
+            del self.storage.new_instance
+
+    def test_factory_renamed_blob_reference(self):
+        # Records referencing a blob are renamed in place, and left
+        # alone once there is nothing left to rename, without being
+        # unpickled.
+        from ZODB.blob import Blob
+
+        from zodbupdate.stats import Stats
+
+        self.root['blob'] = Blob(b'blob data')
+        self.root['test'] = sys.modules['module1'].Factory()
+        transaction.commit()
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        stats = Stats()
+        updater = self.update(stats=stats)
+        self.assertEqual(2, updater.progress.counts['updated'])
+        self.assertNotIn('unpickle_class', stats.as_dict()['phases'])
+        self.assertIsInstance(
+            self.root['test'], sys.modules['module1'].NewFactory)
+        with self.root['blob'].open() as blob:
+            self.assertEqual(b'blob data', blob.read())
+
+        stats = Stats()
+        updater = self.update(stats=stats)
+        self.assertEqual(0, updater.progress.counts['updated'])
+        phases = stats.as_dict()['phases']
+        self.assertNotIn('unpickle_class', phases)
+        # Only the first record is looked at closer, to resolve the
+        # symbols it references.
+        self.assertEqual(1, phases['rewrite']['calls'])
+
+    def test_factory_renamed_stats(self):
+        from zodbupdate.stats import Stats
+
+        for count in range(5):
+            self.root[count] = sys.modules['module1'].Factory()
+        transaction.commit()
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        stats = Stats()
+        self.update(stats=stats, convert_py3=True)
+        result = stats.as_dict()
+        self.assertEqual(6, result['counts']['records'])
+        self.assertEqual(6, result['counts']['updated'])
+        self.assertEqual(6, result['total'])
+        self.assertEqual(
+            ['commit', 'decode', 'load', 'repickle', 'store',
+             'unpickle_class', 'unpickle_state'],
+            sorted(result['phases']))
+        self.assertEqual(6, result['phases']['load']['calls'])
+        self.assertEqual(1, result['phases']['commit']['calls'])
+
+        path = os.path.join(self.temp_dir, 'stats.json')
+        stats.save(path)
+        with open(path) as stream:
+            self.assertEqual(
+                result['counts'], json.load(stream)['counts'])
+
+    def test_factory_renamed_profile(self):
+        import pstats
+
+        from zodbupdate.profiling import Profiler
+
+        for count in range(5):
+            self.root[count] = sys.modules['module1'].Factory()
+        transaction.commit()
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        for workers in (1, 2):
+            directory = os.path.join(self.temp_dir, f'profile-{workers}')
+            profiler = Profiler(directory)
+            self.update(convert_py3=True, workers=workers, profiler=profiler)
+            rows = {row['class']: row for row in profiler.costs.rows()}
+            self.assertEqual(
+                {'module1 NewFactory': 5,
+                 'persistent.mapping PersistentMapping': 1},
+                {name: row['records'] for name, row in rows.items()})
+            self.assertGreater(rows['module1 NewFactory']['repickle'], 0)
+            profiler.save()
+            self.assertIn('classes.json', os.listdir(directory))
+
+        names = sorted(os.listdir(directory))
+        self.assertEqual('classes.json', names[0])
+        self.assertTrue(all(
+            name.startswith('worker-') for name in names[1:]))
+        self.assertTrue(pstats.Stats(os.path.join(directory, names[1])))
+
+    def test_analyze(self):
+        self.root['test'] = sys.modules['module1'].Factory()
+        self.root['second'] = sys.modules['module1'].Factory()
+        self.root['other'] = sys.modules['module2'].OtherFactory()
+        transaction.commit()
+        del sys.modules['module2']
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        self.conn.close()
+        self.db.close()
+        self.storage.close()
+        self.storage = self._makeStorage()
+        expected = [
+            {'class': 'module1 Factory', 'records': 2, 'bytes': 56,
+             'changed': 2, 'missing': False},
+            {'class': 'module2 OtherFactory', 'records': 1, 'bytes': 33,
+             'changed': 0, 'missing': True},
+            {'class': 'persistent.mapping PersistentMapping', 'records': 1,
+             'bytes': 195, 'changed': 1, 'missing': False}]
+        for workers in (1, 2):
+            updater = zodbupdate.main.create_updater(
+                self.storage, workers=workers)
+            analysis = updater.analyze()
+            self.assertEqual(expected, analysis.rows())
+            self.assertEqual({('module2', 'OtherFactory')}, analysis.missing)
+
+        # Nothing was modified.
+        self.assertEqual(
+            b'\x80\x03cmodule1\nFactory\nq\x00.\x80\x03}q\x01.',
+            self.storage.load(self.root['test']._p_oid, '')[0])
+
+        path = os.path.join(self.temp_dir, 'analysis.json')
+        analysis.save(path)
+        with open(path) as stream:
+            report = json.load(stream)
+        self.assertEqual(expected, report['classes'])
+        self.assertEqual(['module2 OtherFactory'], report['missing'])
+        self.assertEqual(
+            {'records': 4, 'bytes': 284, 'changed': 3}, report['totals'])
+
+        path = os.path.join(self.temp_dir, 'analysis.csv')
+        analysis.save(path)
+        with open(path) as stream:
+            self.assertEqual(
+                ['class,records,bytes,changed,missing',
+                 'module1 Factory,2,56,2,False',
+                 'module2 OtherFactory,1,33,0,True',
+                 'persistent.mapping PersistentMapping,1,195,1,False'],
+                stream.read().splitlines())
+
+    def test_factory_renamed_collected_oids(self):
+        from persistent.mapping import PersistentMapping
+
+        from zodbupdate import oids
+
+        self.root['test'] = sys.modules['module1'].Factory()
+        self.root['second'] = sys.modules['module1'].Factory()
+        self.root['plain'] = PersistentMapping()
+        transaction.commit()
+        changed = sorted(
+            ZODB.utils.u64(self.root[name]._p_oid)
+            for name in ('test', 'second'))
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        # First pass: find the records to update.
+        self.conn.close()
+        self.db.close()
+        self.storage.close()
+        self.storage = self._makeStorage()
+        updater = zodbupdate.main.create_updater(self.storage)
+        path = os.path.join(self.temp_dir, 'oids')
+        oids.save(path, updater.analyze().oids)
+        self.assertEqual([0] + changed, list(oids.load(path)))
+        self.assertEqual(24, os.path.getsize(path))
+
+        # Second pass: only update them.
+        updater = self.update(oids=oids.load(path))
+        self.assertEqual(
+            {'processed': 3, 'updated': 3, 'commits': 1},
+            updater.progress.counts)
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+            self.storage.load(self.root['test']._p_oid, '')[0])
+
+        updater = self.update(
+            oids=oids.load(path),
+            start_at=ZODB.utils.oid_repr(ZODB.utils.p64(changed[1])))
+        self.assertEqual(1, updater.progress.counts['processed'])
+
+    def test_factory_renamed_memory(self):
+        import tracemalloc
+
+        from zodbupdate.memory import MemoryMonitor
+
+        for name in ('test', 'second', 'third'):
+            self.root[name] = sys.modules['module1'].Factory()
+        transaction.commit()
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        path = os.path.join(self.temp_dir, 'memory.json')
+        # Always over the limit: the transaction is committed early
+        # after the first record, then after the third one since
+        # dropping caches didn't help the first time.
+        memory = MemoryMonitor(limit=1, report=path, interval=1)
+        try:
+            updater = self.update(memory=memory)
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(
+            {'processed': 4, 'updated': 4, 'commits': 3},
+            updater.progress.counts)
+        self.assertEqual(4, memory.backoff)
+        self.assertTrue(memory.warned)
+        with open(path) as stream:
+            reports = [json.loads(line) for line in stream]
+        self.assertEqual([1, 2, 3], [
+            report['commit'] for report in reports])
+        structures = [report['structures'] for report in reports]
+        # Caches were dropped, but not the rules found.
+        self.assertEqual(
+            [0, 0, 1], [item['resolved symbols'] for item in structures])
+        self.assertEqual(
+            [1] * 3, [item['implicit renames'] for item in structures])
+        self.assertEqual(
+            [1, 2, 1],
+            [item['transaction records'] for item in structures])
+        self.assertGreater(reports[-1]['memory'], 0)
+
+    def test_factory_renamed_copy(self):
+        from ZODB.blob import Blob
+        from ZODB.blob import BlobStorage
+        from ZODB.FileStorage import FileStorage
+
+        self.root['test'] = sys.modules['module1'].Factory()
+        self.root['blob'] = Blob(b'blob data')
+        transaction.commit()
+        oid = self.root['test']._p_oid
+        blob_oid = self.root['blob']._p_oid
+        original = self.storage.load(oid, '')[0]
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        self.conn.close()
+        self.db.close()
+        self.storage.close()
+        self.storage = self._makeStorage()
+        output = BlobStorage(
+            os.path.join(self.temp_dir, 'output-blobs'),
+            FileStorage(os.path.join(self.temp_dir, 'Output.fs')))
+        updater = zodbupdate.main.create_updater(self.storage, output=output)
+        updater()
+        self.assertEqual(
+            {'processed': 3, 'updated': 2, 'copied': 3, 'commits': 1},
+            updater.progress.counts)
+        # The source is not modified.
+        self.assertEqual(original, self.storage.load(oid, '')[0])
+        self.storage.close()
+        self.assertEqual(3, len(output))
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+            output.load(oid, '')[0])
+        with open(output.loadBlob(blob_oid, output.lastTransaction())) as b:
+            self.assertEqual('blob data', b.read())
+        output.close()
+
+        # Same with worker processes.
+        self.storage = self._makeStorage()
+        output = FileStorage(
+            os.path.join(self.temp_dir, 'Workers.fs'),
+            blob_dir=os.path.join(self.temp_dir, 'workers-blobs'))
+        updater = zodbupdate.main.create_updater(
+            self.storage, output=output, workers=2)
+        updater()
+        self.assertEqual(3, updater.progress.counts['copied'])
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+            output.load(oid, '')[0])
+        output.close()
+
+    def test_factory_renamed_copy_pack(self):
+        from ZODB.FileStorage import FileStorage
+        from ZODB.POSException import POSKeyError
+
+        from zodbupdate.pack import remove_records
+
+        self.root['test'] = sys.modules['module1'].Factory()
+        self.root['gone'] = sys.modules['module1'].Factory()
+        self.root['gone'].child = sys.modules['module1'].Factory()
+        transaction.commit()
+        oid = self.root['test']._p_oid
+        gone = [self.root['gone']._p_oid, self.root['gone'].child._p_oid]
+        del self.root['gone']
+        transaction.commit()
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        self.conn.close()
+        self.db.close()
+        self.storage.close()
+        self.storage = self._makeStorage()
+        path = os.path.join(self.temp_dir, 'Output.fs')
+        output = FileStorage(path)
+        updater = zodbupdate.main.create_updater(
+            self.storage, output=output, pack=True)
+        updater()
+        unreachable = updater.references.unreachable()
+        self.assertEqual({ZODB.utils.u64(oid) for oid in gone}, unreachable)
+        output.close()
+        remove_records(path, unreachable)
+        self.assertTrue(os.path.exists(path + '.index'))
+        self.assertFalse(os.path.exists(path + '.pack'))
+
+        output = FileStorage(path, read_only=True)
+        self.assertEqual(2, len(output))
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+            output.load(oid, '')[0])
+        for oid in gone:
+            with self.assertRaises(POSKeyError):
+                output.load(oid, '')
+        output.close()
+
+    def test_factory_renamed_since_tid(self):
+        from zodbupdate import oids
+
+        self.root['test'] = sys.modules['module1'].Factory()
+        transaction.commit()
+        tid = self.storage.lastTransaction()
+        self.root['second'] = sys.modules['module1'].Factory()
+        transaction.commit()
+        changed = sorted(
+            ZODB.utils.u64(oid) for oid in (
+                self.root._p_oid, self.root['second']._p_oid))
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        self.conn.close()
+        self.db.close()
+        self.storage.close()
+        self.storage = self._makeStorage()
+        self.assertEqual(changed, list(oids.changed_since(self.storage, tid)))
+        updater = self.update(oids=oids.changed_since(self.storage, tid))
+        self.assertEqual(
+            {'processed': 2, 'updated': 2, 'commits': 1},
+            updater.progress.counts)
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+            self.storage.load(self.root['second']._p_oid, '')[0])
+        self.assertEqual(
+            b'\x80\x03cmodule1\nFactory\nq\x00.\x80\x03}q\x01.',
+            self.storage.load(self.root['test']._p_oid, '')[0])
+
+        # Transactions committed by zodbupdate are not caught up again
+        # (a history-free storage does not keep their description): the
+        # record only renamed by this update is not included.
+        updater = self.update()
+        self.assertEqual(1, updater.progress.counts['updated'])
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+            self.storage.load(self.root['test']._p_oid, '')[0])
+        if getattr(self.storage, 'keep_history', True):
+            self.assertEqual(
+                changed, list(oids.changed_since(self.storage, tid)))
+        self.assertEqual(
+            [], list(oids.changed_since(
+                self.storage, self.storage.lastTransaction())))
+
     def test_factory_renamed_dryrun(self):
         # Run an update with "dy run" option and see that the pickle is
         # not updated.
@@ -647,6 +1909,10 @@ class Python3TestsMixin:
         self.assertEqual(
             b'\x80\x03cmodule1\nFactory\nq\x00.\x80\x03}q\x01.',
             self.storage.load(self.root['test']._p_oid, '')[0])
+        # The transaction was aborted.
+        self.assertEqual(
+            {'processed': 2, 'updated': 2, 'commits': 0},
+            updater.progress.counts)
         renames = updater.processor.get_rules(implicit=True)
         self.assertEqual(
             {('module1', 'Factory'): ('module1', 'NewFactory')},
@@ -805,6 +2071,30 @@ class RelStorageHPMixin(RelStorageHFMixin):
                 "History-preserving RelStorage requires RelStorage 3.3")
         return storage
 
+
+class ZEOMixin:
+    """
+    Mixin to create a client of a ZEO server, started for the test and
+    serving a FileStorage.
+    """
+
+    zeo_stop = None
+
+    def _makeStorage(self):
+        import ZEO
+        from ZEO.ClientStorage import ClientStorage
+
+        if self.zeo_stop is None:
+            self.zeo_address, self.zeo_stop = ZEO.server(
+                path=os.path.join(self.temp_dir, 'Server.fs'),
+                blob_dir=os.path.join(self.temp_dir, 'server-blobs'))
+        return ClientStorage(
+            self.zeo_address,
+            blob_dir=os.path.join(self.temp_dir, 'blobs'))
+
+    def _tearDownStorage(self):
+        self.zeo_stop()
+
 ###
 # Complete test classes.
 # These are listed explicitly for ease of interactive testing from an IDE,
@@ -841,7 +2131,86 @@ class FileStoragePython3Tests(
         Python3TestsMixin,
         StorageUpdateMixin,
         unittest.TestCase):
-    pass
+
+    def test_factory_renamed_sequential(self):
+        # Records are read in file order. Only the current version of
+        # a record is renamed, and records written by the update
+        # are not read again.
+        self.root['test'] = sys.modules['module1'].Factory()
+        self.root['other'] = sys.modules['module1'].Factory()
+        transaction.commit()
+        self.root['test'].value = 42
+        transaction.commit()
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        checkpoint = os.path.join(self.temp_dir, 'checkpoint.json')
+        updater = self.update(
+            iteration='sequential', transaction_records=0,
+            checkpoint=checkpoint)
+
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.'
+            b'\x80\x03}q\x01X\x05\x00\x00\x00valueq\x02K*s.',
+            self.storage.load(self.root['test']._p_oid, '')[0])
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+            self.storage.load(self.root['other']._p_oid, '')[0])
+        self.assertEqual(
+            {'processed': 3, 'updated': 3, 'commits': 3},
+            updater.progress.counts)
+
+        # Resuming goes on from the last record processed, in the
+        # same file.
+        from zodbupdate.checkpoint import Checkpoint
+        progress = Checkpoint.load(checkpoint)
+        self.assertTrue(progress.finished)
+        self.assertEqual(updater.scanner.end, progress.end)
+        self.assertLess(progress.position, progress.end)
+        progress.finished = False
+        progress.save(checkpoint)
+        updater = self.update(
+            iteration='sequential', checkpoint=checkpoint, resume=True)
+        self.assertEqual(
+            {'processed': 3, 'updated': 3, 'commits': 3},
+            updater.progress.counts)
+
+        with self.assertRaises(AssertionError):
+            self.update(checkpoint=checkpoint, resume=True)
+
+    def test_factory_renamed_position(self):
+        # Records are looked up in the index, and read in the order
+        # of their position in the file.
+        self.root['test'] = sys.modules['module1'].Factory()
+        self.root['other'] = sys.modules['module1'].Factory()
+        transaction.commit()
+        self.root['test'].value = 42
+        transaction.commit()
+        root_oid = self.root._p_oid
+        test_oid = self.root['test']._p_oid
+        other_oid = self.root['other']._p_oid
+
+        updater = zodbupdate.update.Updater(
+            self.storage, renames={}, decoders={}, iteration='position')
+        self.assertEqual(
+            [root_oid, other_oid, test_oid],
+            [oid for oid, tid, data in updater.records])
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        # --oid still selects the records to process.
+        updater = self.update(
+            iteration='position', start_at=ZODB.utils.oid_repr(other_oid))
+        self.assertEqual(1, updater.progress.counts['processed'])
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.\x80\x03}q\x01.',
+            self.storage.load(other_oid, '')[0])
+        self.assertEqual(
+            b'\x80\x03cmodule1\nFactory\nq\x00.'
+            b'\x80\x03}q\x01X\x05\x00\x00\x00valueq\x02K*s.',
+            self.storage.load(test_oid, '')[0])
 
 
 class RelStorageHFPython3Tests(
@@ -859,6 +2228,99 @@ class RelStorageHPPython3Tests(
         unittest.TestCase):
     pass
 
+
+class ZEOPython3Tests(
+        ZEOMixin,
+        Python3TestsMixin,
+        StorageUpdateMixin,
+        unittest.TestCase):
+
+    def _commit_elsewhere(self, oid, data):
+        """Modify a record from another client of the server.
+        """
+        from ZEO.ClientStorage import ClientStorage
+        from ZODB.Connection import TransactionMetaData
+
+        storage = ClientStorage(
+            self.zeo_address,
+            blob_dir=os.path.join(self.temp_dir, 'other-blobs'))
+        try:
+            serial = storage.load(oid, '')[1]
+            t = TransactionMetaData()
+            storage.tpc_begin(t)
+            storage.store(oid, serial, data, '', t)
+            storage.tpc_vote(t)
+            storage.tpc_finish(t)
+        finally:
+            storage.close()
+
+    def _renamer_with_conflict(self, oid, data):
+        """Create an updater whose Factory record is modified by another
+        client once it has been loaded.
+        """
+        self.conn.close()
+        self.db.close()
+        self.storage.close()
+        self.storage = self._makeStorage()
+        updater = zodbupdate.main.create_updater(self.storage, online=True)
+        rename_record = updater.processor.rename_record
+        conflicts = []
+
+        def rename_and_conflict(record, record_oid=None):
+            if not conflicts and bytes(record).startswith(
+                    b'\x80\x03cmodule1\nFactory\n'):
+                conflicts.append(oid)
+                self._commit_elsewhere(oid, data)
+            return rename_record(record, record_oid)
+
+        updater.processor.rename_record = rename_and_conflict
+        return updater
+
+    def test_online_conflict(self):
+        import zodbupdate.stats
+
+        self.root['test'] = sys.modules['module1'].Factory()
+        transaction.commit()
+        oid = self.root['test']._p_oid
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        updater = self._renamer_with_conflict(
+            oid,
+            b'\x80\x03cmodule1\nFactory\nq\x00.'
+            b'\x80\x03}q\x01X\x05\x00\x00\x00valueq\x02K*s.')
+        updater.stats = zodbupdate.stats.Stats()
+        updater()
+        self.assertEqual(
+            {'processed': 2, 'updated': 2, 'commits': 1},
+            updater.progress.counts)
+        # ZEO reports the conflict when voting, so the whole transaction
+        # is done again.
+        self.assertEqual(2, updater.stats.counts['conflicts'])
+        # Records are only counted once they are committed.
+        self.assertEqual(2, updater.stats.counts['updated'])
+        # The record is updated from the revision of the other client.
+        self.assertEqual(
+            b'\x80\x03cmodule1\nNewFactory\nq\x00.'
+            b'\x80\x03}q\x01X\x05\x00\x00\x00valueq\x02K*s.',
+            self.storage.load(oid, '')[0])
+
+    def test_offline_conflict(self):
+        self.root['test'] = sys.modules['module1'].Factory()
+        transaction.commit()
+        oid = self.root['test']._p_oid
+
+        sys.modules['module1'].NewFactory = sys.modules['module1'].Factory
+        sys.modules['module1'].NewFactory.__name__ = 'NewFactory'
+
+        updater = self._renamer_with_conflict(
+            oid, b'\x80\x03cmodule1\nFactory\nq\x00.\x80\x03}q\x01.')
+        updater.online = False
+        with self.assertRaises(ZODB.POSException.ConflictError):
+            updater()
+
+
 # The above can also be done completely dynamically,
 # or even be generated with code like this:
 
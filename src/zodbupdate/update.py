@@ -12,21 +12,36 @@
 #
 ##############################################################################
 
-import io
+import gc
 import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 from struct import pack
 from struct import unpack
 
+import ZODB.blob
 import ZODB.broken
 import ZODB.POSException
 import ZODB.utils
 from ZODB.blob import BlobStorage
 from ZODB.Connection import TransactionMetaData
 from ZODB.FileStorage import FileStorage
+from ZODB.interfaces import IBlobStorage
+from ZODB.interfaces import IMVCCStorage
 from ZODB.interfaces import IStorageCurrentRecordIteration
 from ZODB.interfaces import IStorageIteration
 from ZODB.interfaces import IStorageUndoable
 
+import zodbupdate.analyze
+import zodbupdate.checkpoint
+import zodbupdate.filestorage
+import zodbupdate.logs
+import zodbupdate.pack
+import zodbupdate.parallel
+import zodbupdate.pipeline
 import zodbupdate.serialize
 import zodbupdate.utils
 
@@ -35,6 +50,89 @@ logger = logging.getLogger('zodbupdate')
 
 TRANSACTION_COUNT = 100000
 
+# Records per transaction while other clients write to the database.
+ONLINE_TRANSACTION_COUNT = 100
+
+# How many times records conflicting with another transaction are
+# updated again before giving up.
+CONFLICT_RETRIES = 5
+
+# Description of the transactions committed by an update.
+TRANSACTION_NOTE = 'Updated factory references using `zodbupdate`.'
+
+
+class Throttle:
+    """Limit how many times per second something happens, by sleeping
+    in ``wait`` when it happens too often.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = None
+
+    def wait(self):
+        """Wait until the next event is allowed. Return how long it
+        waited.
+        """
+        now = time.monotonic()
+        waited = 0.0
+        if self.next is not None and now < self.next:
+            waited = self.next - now
+            time.sleep(waited)
+            now = self.next
+        self.next = now + self.interval
+        return waited
+
+
+class TransactionSizer:
+    """Decide when to commit the current transaction, after a number
+    of records or of bytes written. If a target commit latency is
+    given, the number of records is adjusted after each commit to get
+    closer to it.
+    """
+
+    def __init__(self, records=TRANSACTION_COUNT, size=None, latency=None):
+        self.records = records
+        self.size = size
+        self.latency = latency
+        self.reset()
+
+    def reset(self):
+        self.record_count = 0
+        self.byte_count = 0
+
+    def add(self, data):
+        """Account for a record stored in the transaction. Return true
+        if the transaction should be committed.
+        """
+        self.record_count += 1
+        self.byte_count += len(data)
+        if self.record_count > self.records:
+            return True
+        return self.size is not None and self.byte_count >= self.size
+
+    def committed(self, duration):
+        """Adjust the number of records of the next transactions from
+        the time it took to commit this one, if it was committed because
+        it had that number of records.
+        """
+        if self.latency is None or duration is None:
+            return
+        if self.record_count < self.records:
+            # Committed for its size, or to free memory: it tells
+            # little about the time a full transaction takes.
+            return
+        # Commit time is roughly proportional to the number of records,
+        # but don't change it too much at once, timings are noisy.
+        ratio = self.latency / max(duration, 0.001)
+        ratio = min(max(ratio, 0.5), 2.0)
+        records = max(int(self.record_count * ratio), 1)
+        if records != self.records:
+            logger.debug(
+                'Commit took {:.2f}s, using transactions of {} '
+                'records.'.format(duration, records))
+            self.records = records
+
 
 class Updater:
     """Access a storage and perform operations on all of its records.
@@ -42,11 +140,28 @@ class Updater:
 
     def __init__(
             self, storage, dry=False, renames=None, decoders=None,
-            start_at='0x00', debug=False, repickle_all=False,
+            start_at='0x00', end_at=None, debug=False, repickle_all=False,
             pickle_protocol=zodbupdate.utils.DEFAULT_PROTOCOL,
-            encoding='ASCII'):
+            encoding='ASCII', workers=1, checkpoint=None, resume=False,
+            transaction_records=TRANSACTION_COUNT, transaction_bytes=None,
+            commit_latency=None, iteration='oid', stats=None, oids=None,
+            online=False, conflict_retries=CONFLICT_RETRIES,
+            max_records_per_second=None, max_commit_rate=None, prefetch=0,
+            output=None, pack=False, memory=None, profiler=None):
         self.dry = dry
         self.storage = storage
+        # Storage the current revision of every record is copied to,
+        # instead of updating the records in place.
+        self.output = output
+        self.output_tid = None
+        if output is not None and not hasattr(output, 'restore'):
+            raise SystemExit(
+                "Don't know how to copy records to this storage type")
+        # References of the records copied, to find the unreachable
+        # ones at the end.
+        self.references = None
+        if pack and output is not None:
+            self.references = zodbupdate.pack.References()
         self.processor = zodbupdate.serialize.ObjectRenamer(
             renames=renames,
             decoders=decoders,
@@ -55,52 +170,398 @@ class Updater:
             encoding=encoding,
         )
         self.start_at = start_at
+        # OID, in hex format, to stop before.
+        self.end_at = end_at
         self.debug = debug
+        self.workers = workers
+        self.stats = stats
+        self.processor.stats = stats
+        self.iteration = iteration
+        self.oids = oids
+        self.prefetch = prefetch
+        # A zodbupdate.memory.MemoryMonitor, to stay below a limit or
+        # report the memory used.
+        self.memory = memory
+        # A zodbupdate.profiling.Profiler, to time records per class
+        # and profile the workers.
+        self.profiler = profiler
+        if profiler is not None:
+            self.processor.costs = profiler.costs
+        self.scanner = None
+        # Records are renamed in another thread when pipelining, while
+        # conflicts are retried in this one.
+        self.rename_lock = threading.Lock()
+        self.sizer = TransactionSizer(
+            records=transaction_records,
+            size=transaction_bytes,
+            latency=commit_latency)
+        self.online = online
+        self.conflict_retries = conflict_retries
+        self.record_throttle = self.commit_throttle = None
+        if max_records_per_second:
+            self.record_throttle = Throttle(max_records_per_second)
+        if max_commit_rate:
+            self.commit_throttle = Throttle(max_commit_rate)
+        self.checkpoint = checkpoint
+        self.progress = zodbupdate.checkpoint.Checkpoint(
+            first_oid=start_at, end_oid=end_at)
+        if resume:
+            self.__resume()
+
+    def __resume(self):
+        if self.checkpoint is None:
+            raise AssertionError('Cannot resume without a checkpoint file.')
+        try:
+            self.progress = zodbupdate.checkpoint.Checkpoint.load(
+                self.checkpoint)
+        except FileNotFoundError:
+            logger.info(
+                f'No checkpoint found in {self.checkpoint}, '
+                'starting from the beginning.')
+            return
+        if (self.progress.position is None) != (self.iteration == 'oid'):
+            raise AssertionError(
+                'The checkpoint was not written with the same iteration.')
+        if self.progress.end_oid != self.end_at:
+            raise AssertionError(
+                'The checkpoint was not written with the same OID range.')
+        self.processor.merge_rules(self.progress.rules)
+        if self.iteration == 'oid':
+            self.start_at = self.progress.start_at
+        else:
+            self.start_at = self.progress.first_oid
+        logger.info(
+            'Resuming after OID {} ({} records processed, {} updated).'.format(
+                ZODB.utils.oid_repr(self.progress.oid),
+                self.progress.counts['processed'],
+                self.progress.counts['updated']))
+
+    def __save_checkpoint(self, oid, finished=False):
+        if self.checkpoint is None or self.dry:
+            return
+        self.progress.oid = oid
+        if self.scanner is not None:
+            self.progress.position = self.scanner.position
+            self.progress.end = self.scanner.end
+            self.progress.first_oid = self.start_at
+        self.progress.rules = self.processor.get_rules(implicit=True)
+        self.progress.finished = finished
+        self.progress.save(self.checkpoint)
+
+    @property
+    def target(self):
+        """Return the storage records are written to.
+        """
+        if self.output is not None:
+            return self.output
+        return self.storage
 
     def __new_transaction(self):
         t = TransactionMetaData()
-        self.storage.tpc_begin(t)
-        t.note('Updated factory references using `zodbupdate`.')
+        # Storages take the description when the transaction begins.
+        t.note(TRANSACTION_NOTE)
+        if self.output is not None:
+            # Records are restored with the transaction id as serial.
+            self.output_tid = ZODB.utils.newTid(
+                self.output.lastTransaction())
+            self.output.tpc_begin(t, self.output_tid)
+        else:
+            self.storage.tpc_begin(t)
         return t
 
     def __commit_transaction(self, t, changed, commit_count):
+        """Commit or abort the transaction. Return how long it took to
+        commit it, or None if it was aborted.
+        """
         if self.dry or not changed:
             logger.info(
                 'Dry run selected or no changes, '
                 'aborting transaction. (#{})'.format(commit_count))
-            self.storage.tpc_abort(t)
+            self.target.tpc_abort(t)
+            return None
+        logger.info(f'Committing changes (#{commit_count}).')
+        start = time.monotonic()
+        self.target.tpc_vote(t)
+        self.target.tpc_finish(t)
+        duration = time.monotonic() - start
+        if self.stats is not None:
+            self.stats.add('commit', duration)
+        return duration
+
+    def __throttle(self, throttle):
+        if throttle is None:
+            return
+        waited = throttle.wait()
+        if self.stats is not None and waited:
+            self.stats.add('throttle', waited)
+
+    def __store(self, t, oid, serial, data, conflicts):
+        """Store a record in the transaction. Return true if it was
+        stored. In online mode, records conflicting with another
+        transaction are added to conflicts instead.
+        """
+        try:
+            if self.stats is not None:
+                start = time.perf_counter()
+                self.storage.store(oid, serial, data, '', t)
+                self.stats.lap('store', start)
+                self.stats.count('bytes_written', len(data))
+            else:
+                self.storage.store(oid, serial, data, '', t)
+        except ZODB.POSException.ConflictError:
+            if not self.online:
+                raise
+            conflicts.append(oid)
+            return False
+        return True
+
+    def __copy(self, t, oid, serial, data):
+        """Copy a record, with its blob if it has one, to the output
+        storage.
+        """
+        if not isinstance(data, bytes):
+            # Records might be given as views on a memory map.
+            data = bytes(data)
+        start = time.perf_counter() if self.stats is not None else None
+        filename = None
+        if ZODB.blob.is_blob_record(data):
+            try:
+                filename = self.storage.loadBlob(oid, serial)
+            except (AttributeError, ZODB.POSException.POSKeyError):
+                logger.error(
+                    'Warning: Copying blob record {} without its '
+                    'blob.'.format(ZODB.utils.oid_repr(oid)),
+                    extra={'kind': zodbupdate.logs.MISSING_BLOB, 'oid': oid})
+        if filename is not None:
+            if not IBlobStorage.providedBy(self.output):
+                raise SystemExit(
+                    "The output storage doesn't support blobs")
+            # The output storage takes the file over, copy it.
+            fd, copy = tempfile.mkstemp(
+                prefix='zodbupdate', suffix='.tmp',
+                dir=self.output.temporaryDirectory())
+            os.close(fd)
+            shutil.copyfile(filename, copy)
+            self.output.restoreBlob(
+                oid, self.output_tid, data, copy, None, t)
         else:
-            logger.info(f'Committing changes (#{commit_count}).')
-            self.storage.tpc_vote(t)
-            self.storage.tpc_finish(t)
+            self.output.restore(oid, self.output_tid, data, '', None, t)
+        if start is not None:
+            self.stats.lap('store', start)
+            self.stats.count('bytes_written', len(data))
+
+    def __finish_transaction(self, t, stored, conflicts, commit_count):
+        """Commit the transaction where the given records were stored,
+        then update again the records that conflicted with another
+        transaction. Return how long the commit took.
+        """
+        counts = self.progress.counts
+        try:
+            duration = self.__commit_transaction(
+                t, bool(stored), commit_count)
+        except ZODB.POSException.ConflictError:
+            if not self.online:
+                raise
+            # ZEO reports conflicts when voting.
+            self.target.tpc_abort(t)
+            conflicts.extend(stored)
+            counts['updated'] -= len(stored)
+            duration = None
+        else:
+            if duration is not None:
+                # Not aborted (dry run or nothing stored).
+                counts['commits'] += 1
+            if stored and self.stats is not None and self.output is None:
+                # Records copied are counted as they are read.
+                self.stats.count('updated', len(stored))
+        if self.memory is not None and self.memory.report is not None:
+            # Measuring some structures takes time, only do it for a
+            # report.
+            self.memory.committed(commit_count, self.__structures(stored))
+        self.__throttle(self.commit_throttle)
+        if conflicts:
+            self.__retry(conflicts, commit_count)
+        return duration
+
+    def __structures(self, stored):
+        """Return the number of items of the data structures that can
+        grow during an update.
+        """
+        structures = self.processor.get_cache_sizes()
+        structures['warnings'] = len(zodbupdate.logs.aggregator.counts)
+        structures['transaction records'] = len(stored)
+        index = getattr(self.storage, '_index', None)
+        if index is not None:
+            structures['storage index'] = len(index)
+        if self.references is not None:
+            structures['references'] = len(self.references)
+        return structures
+
+    def __relieve_memory(self):
+        """Free what can be freed when the memory used is close to
+        the limit.
+        """
+        logger.info('Close to the memory limit, dropping caches.')
+        self.processor.drop_caches()
+        gc.collect()
+        if self.stats is not None:
+            self.stats.count('memory_relieved')
+
+    def __retry(self, oids, commit_count):
+        """Load the current revision of records that conflicted with
+        another transaction and update them again.
+        """
+        counts = self.progress.counts
+        for attempt in range(1, self.conflict_retries + 1):
+            logger.info(
+                'Updating again {} records after a conflict '
+                '(attempt {}).'.format(len(oids), attempt))
+            if self.stats is not None:
+                self.stats.count('conflicts', len(oids))
+            t = self.__new_transaction()
+            stored = []
+            conflicts = []
+            for oid in oids:
+                try:
+                    data, serial = self.storage.load(oid, '')
+                except ZODB.POSException.POSKeyError:
+                    # Removed in the meantime.
+                    continue
+                with self.rename_lock:
+                    new = self.processor.rename_record(data, oid)
+                if new is None:
+                    continue
+                if self.__store(t, oid, serial, new, conflicts):
+                    stored.append(oid)
+            try:
+                duration = self.__commit_transaction(
+                    t, bool(stored), commit_count)
+            except ZODB.POSException.ConflictError:
+                self.storage.tpc_abort(t)
+                conflicts.extend(stored)
+            else:
+                if duration is not None:
+                    counts['commits'] += 1
+                if stored:
+                    counts['updated'] += len(stored)
+                    if self.stats is not None:
+                        self.stats.count('updated', len(stored))
+            self.__throttle(self.commit_throttle)
+            if not conflicts:
+                return
+            oids = conflicts
+        raise ZODB.POSException.ConflictError(
+            'Could not update {} records after {} attempts: {}'.format(
+                len(oids), self.conflict_retries,
+                ', '.join(ZODB.utils.oid_repr(oid) for oid in oids)))
+
+    def __rename(self, records):
+        for oid, serial, data in records:
+            logger.debug('Processing OID {}'.format(
+                ZODB.utils.oid_repr(oid)))
+
+            with self.rename_lock:
+                new = self.processor.rename_record(data, oid)
+            yield oid, serial, new, data
 
     def __call__(self):
+        if self.progress.finished:
+            logger.info('Checkpoint says the update is already finished.')
+            return
+        if self.progress.tid is None:
+            # Changes committed from now on, even to records already
+            # processed, are caught up with --since-checkpoint. This
+            # is kept when resuming.
+            self.progress.tid = self.storage.lastTransaction()
+        counts = self.progress.counts
         commit_count = 0
+        sizer = self.sizer
+        sizer.reset()
+        stats = self.stats
+        memory = self.memory
+        # Commit as soon as possible to free memory.
+        commit_early = False
+        records = self.records
+        if stats is not None:
+            if stats.total is None:
+                try:
+                    stats.total = len(self.storage)
+                except TypeError:
+                    pass
+            records = stats.timed(records)
         try:
-            record_count = 0
+            oid = self.progress.oid
+            if self.output is not None:
+                counts.setdefault('copied', 0)
+            stored = []
+            conflicts = []
             t = self.__new_transaction()
 
-            for oid, serial, current in self.records:
-                logger.debug('Processing OID {}'.format(
-                    ZODB.utils.oid_repr(oid)))
+            if self.prefetch:
+                # Read records ahead in another thread.
+                records = zodbupdate.pipeline.prefetch(records, self.prefetch)
+            if self.workers > 1:
+                renamed = zodbupdate.parallel.rename(
+                    self.processor, records, self.workers,
+                    keep=self.output is not None, profiler=self.profiler)
+            else:
+                renamed = self.__rename(records)
+                if self.prefetch:
+                    # Rename them in another one, while they are written
+                    # here.
+                    renamed = zodbupdate.pipeline.prefetch(
+                        renamed, self.prefetch)
 
-                new = self.processor.rename(current)
-                if new is None:
+            for oid, serial, new, data in renamed:
+                counts['processed'] += 1
+                if self.scanner is not None:
+                    self.scanner.processed(oid)
+                if stats is not None:
+                    stats.count('records')
+                    stats.report()
+                self.__throttle(self.record_throttle)
+                if memory is not None and memory.check():
+                    self.__relieve_memory()
+                    commit_early = True
+                if self.output is not None:
+                    # Copy every record, modified or not.
+                    if new is None:
+                        new = data
+                    else:
+                        counts['updated'] += 1
+                        if stats is not None:
+                            stats.count('updated')
+                    self.__copy(t, oid, serial, new)
+                    if self.references is not None:
+                        self.references.add(oid, new)
+                    stored.append(oid)
+                    counts['copied'] += 1
+                elif new is None:
                     continue
+                else:
+                    logger.debug('Updated OID {}'.format(
+                        ZODB.utils.oid_repr(oid)))
+                    if not self.__store(t, oid, serial, new, conflicts):
+                        continue
+                    stored.append(oid)
+                    counts['updated'] += 1
 
-                logger.debug('Updated OID {}'.format(
-                    ZODB.utils.oid_repr(oid)))
-                self.storage.store(oid, serial, new.getvalue(), '', t)
-                record_count += 1
-
-                if record_count > TRANSACTION_COUNT:
-                    record_count = 0
+                if sizer.add(new) or commit_early:
                     commit_count += 1
-                    self.__commit_transaction(t, True, commit_count)
+                    sizer.committed(self.__finish_transaction(
+                        t, stored, conflicts, commit_count))
+                    if commit_early:
+                        commit_early = False
+                        memory.relieved()
+                    sizer.reset()
+                    stored = []
+                    conflicts = []
+                    self.__save_checkpoint(oid)
                     t = self.__new_transaction()
 
             commit_count += 1
-            self.__commit_transaction(t, record_count != 0, commit_count)
+            self.__finish_transaction(t, stored, conflicts, commit_count)
+            self.__save_checkpoint(oid, finished=True)
         except Exception as error:
             if not self.debug:
                 raise
@@ -111,30 +572,97 @@ class Updater:
             del traceback
             raise error
 
+    def analyze(self):
+        """Look at all the records and tell what an update would do,
+        without modifying anything. Return a zodbupdate.analyze.Analysis.
+        """
+        records = self.records
+        if self.stats is not None:
+            records = self.stats.timed(records)
+        if self.prefetch:
+            records = zodbupdate.pipeline.prefetch(records, self.prefetch)
+        return zodbupdate.analyze.analyze(
+            self.processor, records, self.workers)
+
     @property
     def records(self):
+        if self.prefetch and IMVCCStorage.providedBy(self.storage):
+            return self.__records_from_instance()
+        return self.__records(self.storage)
+
+    def __records_from_instance(self):
+        # Records are read in another thread, and instances of MVCC
+        # storages (RelStorage) must not be shared between threads.
+        instance = self.storage.new_instance()
+        try:
+            yield from self.__records(instance)
+        finally:
+            instance.release()
+
+    def __records(self, storage):
         next = ZODB.utils.repr_to_oid(self.start_at)
-        storage = self.storage
+        end = None
+        if self.end_at is not None:
+            end = ZODB.utils.repr_to_oid(self.end_at)
         # If we've got a BlobStorage wrapper, let's
         # actually iterate through the storage it wraps.
         if isinstance(storage, BlobStorage):
             storage = storage._BlobStorage__storage
-        if isinstance(storage, FileStorage):
+        if self.oids is not None:
+            # Only look at the given records.
+            first = ZODB.utils.u64(next)
+            for oid in self.oids:
+                if oid < first:
+                    continue
+                oid = ZODB.utils.p64(oid)
+                if end is not None and oid >= end:
+                    break
+                try:
+                    data, tid = storage.load(oid, '')
+                except ZODB.POSException.POSKeyError as e:
+                    zodbupdate.logs.log_missing_record(oid, e)
+                else:
+                    yield oid, tid, data
+        elif self.iteration != 'oid':
+            if not isinstance(storage, FileStorage):
+                raise SystemExit(
+                    'Iterating in file order requires a FileStorage')
+            if self.iteration == 'sequential':
+                # Read the current records in the order they are in the
+                # file, without looking them up one by one.
+                self.scanner = zodbupdate.filestorage.SequentialScanner(
+                    storage,
+                    start=self.progress.position,
+                    end=self.progress.end)
+            else:
+                # Look the records up in the index, but read them in
+                # the order they are in the file.
+                self.scanner = zodbupdate.filestorage.PositionScanner(
+                    storage,
+                    start=self.progress.position,
+                    end=self.progress.end,
+                    start_at=next)
+            yield from self.scanner
+        elif isinstance(storage, FileStorage):
             # Custom iterator for FileStorage. This is used to be able
             # to recover form a POSKey error.
             index = storage._index
+            try:
+                next = index.minKey(next)
+            except ValueError:
+                # No records after the one we start with.
+                return
 
             while True:
-                oid = index.minKey(next)
+                oid = next
+                if end is not None and oid >= end:
+                    break
                 try:
                     data, tid = storage.load(oid, "")
                 except ZODB.POSException.POSKeyError as e:
-                    logger.error(
-                        'Warning: Jumping record {}, '
-                        'referencing missing key in database: {}'.format(
-                            ZODB.utils.oid_repr(oid), str(e)))
+                    zodbupdate.logs.log_missing_record(oid, e)
                 else:
-                    yield oid, tid, io.BytesIO(data)
+                    yield oid, tid, data
 
                 oid_as_long, = unpack(">Q", oid)
                 next = pack(">Q", oid_as_long + 1)
@@ -147,7 +675,9 @@ class Updater:
             # Second best way to iterate through the lastest records.
             while True:
                 oid, tid, data, next = storage.record_iternext(next)
-                yield oid, tid, io.BytesIO(data)
+                if end is not None and oid >= end:
+                    break
+                yield oid, tid, data
                 if next is None:
                     break
         elif (IStorageIteration.providedBy(storage) and
@@ -155,9 +685,13 @@ class Updater:
                not storage.supportsUndo())):
             # If we can't iterate only through the recent records,
             # iterate on all. Of course doing a pack before help :).
+            if end is not None:
+                raise SystemExit(
+                    "Don't know how to iterate through a range of OIDs of "
+                    "this storage type")
             for transaction_ in storage.iterator():
                 for rec in transaction_:
-                    yield rec.oid, rec.tid, io.BytesIO(rec.data)
+                    yield rec.oid, rec.tid, rec.data
         else:
             raise SystemExit(
                 "Don't know how to iterate through this storage type")
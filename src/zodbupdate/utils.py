@@ -17,10 +17,16 @@ import sys
 
 import ZODB._compat
 import zodbpickle
-import zodbpickle.pickle as pickle
 from ZODB.broken import Broken
 
 
+try:
+    # Make sure to get the C implementation, whatever was imported before.
+    import zodbpickle.fastpickle as pickle
+except ImportError:  # pragma: no cover
+    import zodbpickle.slowpickle as pickle
+
+
 def is_broken(symb):
     """Return true if the given symbol is broken.
     """
@@ -47,6 +53,21 @@ PicklingError = pickle.PicklingError
 logger = logging.getLogger('zodbupdate')
 DEFAULT_PROTOCOL = ZODB._compat._protocol
 
+# True if zodbpickle is not using its C extension.
+PURE_PYTHON = pickle.Unpickler.__module__ != '_pickle'
+
+
+def check_pickle_implementation():
+    """Warn if records are going to be unpickled and repickled in pure
+    Python.
+    """
+    if PURE_PYTHON:
+        logger.warning(
+            'The C extension of zodbpickle is not available (or '
+            'PURE_PYTHON is set): records are unpickled and repickled '
+            'in pure Python, which is several times slower.')
+    return not PURE_PYTHON
+
 
 def Unpickler(
         input_file, persistent_load, find_global, **kw):